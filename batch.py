@@ -0,0 +1,169 @@
+import argparse
+import asyncio
+import csv
+import os
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from cohort_cache import CACHE_DIR, cache_cohorts, load_cached_cohort
+from pipeline import parse_xml, parse_option, run_analysis
+
+# default number of analyses run at a time
+N_PROCESSES = 2
+# default file the status of every job is written to
+SUMMARY_FILE = 'results/batch_summary.csv'
+
+
+# One analysis of a batch: a configuration (see config.xml) and the directory its results go to
+class Job:
+
+    # config_file: path to the configuration; results_dir: directory of the job's results
+    def __init__(self, config_file, results_dir):
+        self.config_file = config_file
+        self.results_dir = results_dir
+        self.data_file, self.subject_id, self.group_by, self.variables = parse_xml(config_file)
+        # jobs streaming their data through disk (see outofcore.py) load it themselves
+        self.out_of_core = parse_option(config_file, 'outOfCore', 'false').lower() == 'true'
+
+    # Returns key of the data the job shares with other jobs: the data file and its id column
+    def dataKey(self):
+        return (os.path.abspath(self.data_file), self.subject_id)
+
+
+# Parameter: manifest_file (path to the manifest), an xml file listing the jobs:
+#     <batch>
+#         <processes>4</processes>
+#         <summary>results/batch_summary.csv</summary>
+#         <job results="results/hippocampus">configs/hippocampus.xml</job>
+#         <job>configs/age.xml</job>
+#     </batch>
+# a job's results default to results/<name of its configuration>
+# Returns (list of Jobs, number of processes, summary file)
+def parse_manifest(manifest_file):
+    root = ET.parse(manifest_file).getroot()
+    jobs = []
+    for node in root.iter('job'):
+        config_file = node.text.strip()
+        results_dir = node.get('results') or os.path.join('results', os.path.splitext(os.path.basename(config_file))[0])
+        jobs.append(Job(config_file, results_dir))
+    processes = int(parse_option(manifest_file, 'processes', N_PROCESSES))
+    return jobs, processes, parse_option(manifest_file, 'summary', SUMMARY_FILE)
+
+
+# Parameters: config_file, results_dir (see Job); cohort_path (directory of the cached Cohort of
+# the job's data, or None to let the analysis load its own); variables (the job's variables)
+# Runs one analysis in a worker process. The cached Cohort is memory-mapped, so every job of the
+# same data reads the same pages instead of parsing or copying the file
+# Returns map from stage name to its wall time (see instrument.Trace.summary)
+def run_job(config_file, results_dir, cohort_path, variables):
+    cohort = None
+    if cohort_path is not None:
+        cohort = load_cached_cohort(cohort_path).subset(variables)
+    trace = run_analysis(config_file, results_dir, cohort)
+    trace.save(os.path.join(results_dir, 'trace.json'))
+    return trace.summary()
+
+
+# Runs the jobs of a batch: every distinct data file is parsed once (for all the variables and
+# group columns its jobs use) into the cohort cache, while the jobs of data already loaded run,
+# each analysis in a process of the pool. The asyncio event loop only waits on loading and on the
+# processes, and reports each job as it finishes; a failed job is reported without stopping the
+# others.
+class BatchRunner:
+
+    # jobs: list of Jobs; processes: number of analyses run at a time; cache_dir: cohort cache
+    def __init__(self, jobs, processes=N_PROCESSES, cache_dir=CACHE_DIR):
+        self.jobs = jobs
+        self.processes = processes
+        self.cache_dir = cache_dir
+        # self.statuses = list of (config file, results dir, status, seconds, error) per finished job
+        self.statuses = []
+
+    # Returns list of job statuses (see self.statuses), in the order the jobs finished
+    def run(self):
+        asyncio.run(self.runAll())
+        return self.statuses
+
+    # Groups the jobs by data and runs every group, and every out-of-core job, concurrently
+    async def runAll(self):
+        # jobs sharing a data file and id column, loaded together
+        shared = {}
+        separate = []
+        for job in self.jobs:
+            if job.out_of_core:
+                separate.append(job)
+            else:
+                shared.setdefault(job.dataKey(), []).append(job)
+        with ProcessPoolExecutor(self.processes) as executor:
+            tasks = [self.runShared(executor, jobs) for jobs in shared.values()]
+            tasks += [self.runJob(executor, job, None) for job in separate]
+            await asyncio.gather(*tasks)
+
+    # Parameters: executor (process pool); jobs (Jobs of one data file)
+    # Loads the data once for every job, then runs the jobs
+    async def runShared(self, executor, jobs):
+        variables = []
+        for job in jobs:
+            variables += [variable for variable in job.variables if variable not in variables]
+        group_columns = sorted(set(job.group_by for job in jobs))
+        start = time.time()
+        try:
+            paths = await asyncio.to_thread(cache_cohorts, jobs[0].data_file, jobs[0].subject_id, group_columns,
+                                            variables, self.cache_dir)
+        except Exception as error:
+            for job in jobs:
+                self.report(job, 'failed', time.time() - start, 'loading %s: %r' % (job.data_file, error))
+            return
+        print('loaded %s (%d variables, %d group columns) for %d jobs in %.1f s' % (
+            jobs[0].data_file, len(variables), len(group_columns), len(jobs), time.time() - start), flush=True)
+        await asyncio.gather(*[self.runJob(executor, job, paths[job.group_by]) for job in jobs])
+
+    # Parameters: executor (process pool); job (Job); cohort_path (see run_job)
+    # Runs the job in the pool and reports it
+    async def runJob(self, executor, job, cohort_path):
+        loop = asyncio.get_running_loop()
+        start = time.time()
+        try:
+            await loop.run_in_executor(executor, run_job, job.config_file, job.results_dir, cohort_path,
+                                       job.variables)
+        except Exception as error:
+            self.report(job, 'failed', time.time() - start, repr(error))
+        else:
+            self.report(job, 'done', time.time() - start, '')
+
+    # Parameters: job; status ('done' or 'failed'); seconds (run time); error (message, if failed)
+    # Records the job's status and prints the progress of the batch
+    def report(self, job, status, seconds, error):
+        self.statuses.append((job.config_file, job.results_dir, status, seconds, error))
+        print('[%d/%d] %s %s in %.1f s%s' % (len(self.statuses), len(self.jobs), job.config_file, status, seconds,
+                                             ': ' + error if error else ''), flush=True)
+
+
+# Parameters: statuses (see BatchRunner.run); path (csv file to write)
+# Writes the status of every job
+def write_summary(statuses, path):
+    parent = os.path.dirname(path)
+    if parent and not os.path.exists(parent):
+        os.makedirs(parent)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Config', 'Results', 'Status', 'Seconds', 'Error'])
+        writer.writerows(statuses)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run every analysis listed in a manifest, loading each data '
+                                                 'file once for all of them')
+    parser.add_argument('manifest', help='xml file listing the configurations (see parse_manifest)')
+    parser.add_argument('--processes', type=int, default=None, help='analyses run at a time (overrides the manifest)')
+    args = parser.parse_args()
+    jobs, processes, summary_file = parse_manifest(args.manifest)
+    statuses = BatchRunner(jobs, args.processes or processes).run()
+    write_summary(statuses, summary_file)
+    n_failed = sum(1 for status in statuses if status[2] != 'done')
+    print('%d jobs done, %d failed; summary in %s' % (len(statuses) - n_failed, n_failed, summary_file))
+    return 1 if n_failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
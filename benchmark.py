@@ -0,0 +1,230 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from cohort import read_cohort
+from cohort_cache import load_cohort
+from brain import Brain
+from scoring import CohortScorer
+from synthetic import write_cohort_csv
+from export import write_scores
+import plots
+import fitcache
+
+# default size grid: every combination of these numbers of subjects and regions is benchmarked
+SUBJECTS = [1000, 10000, 100000]
+REGIONS = [2, 50, 500]
+# sizes with more subjects x regions than this are skipped by default (scoring evaluates every
+# kernel at every subject, so its time grows with subjects^2 x regions)
+MAX_CELLS = 1000000
+# stages timed for every size, in pipeline order
+STAGES = ['load_csv', 'load_cached', 'group', 'divergence', 'end_ranges', 'zones', 'score', 'plot', 'export']
+# a stage whose time grows by more than this factor between two runs is reported as a regression
+REGRESSION_RATIO = 1.2
+
+
+# whether measure() traces memory allocations (tracing slows down python-heavy stages, i.e.
+# the csv export, so turn it off for timings only)
+TRACE_MEMORY = True
+
+
+# Parameters: function (called as function(*args)); args
+# Runs function once, tracing memory allocations if TRACE_MEMORY (numpy reports its buffers to
+# tracemalloc)
+# Returns (result, record): record maps 'wall' and 'cpu' (seconds, cpu summed over this process
+# and finished worker processes) and 'peak_bytes' (peak traced memory during the call, None if
+# not traced)
+def measure(function, *args):
+    if TRACE_MEMORY:
+        tracemalloc.start()
+    cpu = time.process_time() + children_cpu_time()
+    start = time.perf_counter()
+    try:
+        result = function(*args)
+        wall = time.perf_counter() - start
+        cpu = time.process_time() + children_cpu_time() - cpu
+        peak = tracemalloc.get_traced_memory()[1] if TRACE_MEMORY else None
+    finally:
+        if TRACE_MEMORY:
+            tracemalloc.stop()
+    return result, {'wall': wall, 'cpu': cpu, 'peak_bytes': peak}
+
+
+# Returns cpu time (seconds) used by the finished child processes of this process
+def children_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+# Parameters: cohort (Cohort); scorer (CohortScorer); llr (subjects x regions matrix of log
+# likelihood ratios from scorer); path (file to write, any format of export.open_writer)
+# Writes every subject's log likelihood ratios as the main pipeline's export does
+def export_ratios(cohort, scorer, llr, path):
+    write_scores(path, ['SubjectId', 'Gender'] + scorer.getRegions(), cohort.ids, cohort.groups, llr)
+
+
+# Parameters: csv_file (synthetic data file); variables (its region columns); work_dir (directory
+# for caches, plots and exports); stages (names of the stages to record); n_workers (number of
+# worker processes)
+# Runs the pipeline stages in order on csv_file (every stage needs the earlier ones, so all of them
+# run; only the selected ones are recorded)
+# Returns map from stage name to its measure() record, with 'items' (number of subjects or regions
+# the stage handled)
+def run_stages(csv_file, variables, work_dir, stages, n_workers):
+    records = {}
+    cache_dir = os.path.join(work_dir, 'cache')
+    # every run starts cold, so repeats time the fits rather than the memoized results
+    fitcache.FIT_CACHE.clear()
+    cohort, records['load_csv'] = measure(read_cohort, csv_file, 'SUBJID', 'Sex', variables)
+    records['load_csv']['items'] = len(cohort)
+    # the first load parses the file and writes the cache, the second memory-maps it
+    load_cohort(csv_file, 'SUBJID', 'Sex', variables, cache_dir)
+    cached, records['load_cached'] = measure(load_cohort, csv_file, 'SUBJID', 'Sex', variables, cache_dir)
+    records['load_cached']['items'] = len(cached)
+    (female_data, male_data), records['group'] = measure(
+        lambda: (cohort.groupData('F'), cohort.groupData('M')))
+    records['group']['items'] = len(variables)
+    brain, records['divergence'] = measure(Brain, female_data, male_data, 'fft', 1024, 'scott', n_workers)
+    records['divergence']['items'] = len(variables)
+    _, records['end_ranges'] = measure(brain.setEndPercentage, 0.25)
+    records['end_ranges']['items'] = len(brain.getTopRegions())
+    _, records['zones'] = measure(brain.classifyZones, cohort.columns(brain.getTopRegions()))
+    records['zones']['items'] = len(cohort)
+    scorer = CohortScorer(female_data, male_data, variables, n_workers)
+    llr, records['score'] = measure(scorer.logLikelihoodRatios, cohort.columns(variables))
+    records['score']['items'] = len(cohort)
+    if 'plot' in stages:
+        _, records['plot'] = measure(plots.plot_densities, brain.densityGrids(variables),
+                                     os.path.join(work_dir, 'pdfplots'), None, n_workers)
+        records['plot']['items'] = len(variables)
+    _, records['export'] = measure(export_ratios, cohort, scorer, llr, os.path.join(work_dir, 'loglikelihood.csv'))
+    records['export']['items'] = len(cohort)
+    return dict((stage, records[stage]) for stage in stages if stage in records)
+
+
+# Returns map describing the run: git commit, python and numpy versions, machine and cpu count
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+
+# Parameters: args (parsed command line, see main)
+# Benchmarks every stage on a synthetic cohort of every size in the grid, keeping the fastest of
+# args.repeat runs of each
+# Returns map with 'environment', 'parameters' and 'results' (one record per size and stage)
+def run_benchmark(args):
+    results = []
+    work_dir = tempfile.mkdtemp(prefix='dimorphism-bench-')
+    try:
+        for n_subjects in args.subjects:
+            for n_regions in args.regions:
+                if n_subjects * n_regions > args.max_cells:
+                    print('skipping %d subjects x %d regions (more than --max-cells)' % (n_subjects, n_regions))
+                    continue
+                csv_file = os.path.join(work_dir, 'cohort_%d_%d.csv' % (n_subjects, n_regions))
+                variables = write_cohort_csv(csv_file, n_subjects, n_regions, args.female_fraction,
+                                             args.missing_rate, args.seed)
+                best = {}
+                for repeat in range(args.repeat):
+                    run_dir = tempfile.mkdtemp(dir=work_dir)
+                    for stage, record in run_stages(csv_file, variables, run_dir, args.stages, args.workers).items():
+                        if stage not in best or record['wall'] < best[stage]['wall']:
+                            best[stage] = record
+                    shutil.rmtree(run_dir, ignore_errors=True)
+                for stage in args.stages:
+                    if stage in best:
+                        record = dict(stage=stage, subjects=n_subjects, regions=n_regions, **best[stage])
+                        results.append(record)
+                        print('%-12s %8d subjects %4d regions %10.4f s %10.1f MB' % (
+                            stage, n_subjects, n_regions, record['wall'], (record['peak_bytes'] or 0) / 2.0 ** 20))
+                os.remove(csv_file)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    parameters = {
+        'female_fraction': args.female_fraction,
+        'missing_rate': args.missing_rate,
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'workers': args.workers,
+        'trace_memory': TRACE_MEMORY,
+        'max_cells': args.max_cells,
+    }
+    return {'environment': environment(), 'parameters': parameters, 'results': results}
+
+
+# Parameters: old_file, new_file (results files written by run_benchmark)
+# Prints the wall time ratio new/old of every (stage, size) in both files, marking regressions
+# Returns number of regressions (ratio above REGRESSION_RATIO)
+def compare(old_file, new_file):
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    old_times = dict(((r['stage'], r['subjects'], r['regions']), r['wall']) for r in old['results'])
+    regressions = 0
+    for record in new['results']:
+        key = (record['stage'], record['subjects'], record['regions'])
+        if key not in old_times:
+            continue
+        ratio = record['wall'] / max(old_times[key], 1e-9)
+        flag = ''
+        if ratio > REGRESSION_RATIO:
+            flag = '  REGRESSION'
+            regressions += 1
+        print('%-12s %8d subjects %4d regions %10.4f s -> %10.4f s  x%.2f%s' % (
+            key + (old_times[key], record['wall'], ratio, flag)))
+    return regressions
+
+
+# Benchmarks the pipeline stages on synthetic cohorts:
+#     python benchmark.py run --subjects 1000 10000 --regions 2 50 -o bench.json
+#     python benchmark.py compare old.json new.json
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the analysis stages on synthetic cohorts')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='time and memory-profile every stage over a size grid')
+    run.add_argument('--subjects', type=int, nargs='+', default=SUBJECTS)
+    run.add_argument('--regions', type=int, nargs='+', default=REGIONS)
+    run.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    run.add_argument('--female-fraction', type=float, default=0.5)
+    run.add_argument('--missing-rate', type=float, default=0.01)
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--repeat', type=int, default=1)
+    run.add_argument('--workers', type=int, default=1)
+    run.add_argument('--max-cells', type=int, default=MAX_CELLS,
+                     help='skip sizes with more subjects x regions than this')
+    run.add_argument('--no-memory', action='store_true', help='time the stages without tracing memory')
+    run.add_argument('-o', '--output', default='bench_results.json')
+    diff = commands.add_parser('compare', help='compare the wall times of two results files')
+    diff.add_argument('old')
+    diff.add_argument('new')
+    args = parser.parse_args()
+    if args.command == 'compare':
+        return 1 if compare(args.old, args.new) else 0
+    global TRACE_MEMORY
+    TRACE_MEMORY = not args.no_memory
+    results = run_benchmark(args)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
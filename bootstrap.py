@@ -0,0 +1,87 @@
+import numpy as np
+import density
+from scoring import sorted_present, log_ratios
+
+# default number of bootstrap replicates
+N_BOOTSTRAP = 1000
+# replicates resampled together
+BATCH_SIZE = 200
+# subjects whose intervals are computed together (bounds the replicates x subjects block in memory)
+BLOCK_SIZE = 2000
+
+
+# Parameters: f, m (one region's female and male values, NaN for missing); points (values to score,
+# NaN for missing); n_boot (number of replicates); alpha (1 - coverage of the intervals);
+# seed (seed or np.random.SeedSequence of this region's replicates); grid_size, rule (see
+# density.grid_kde); batch_size, block_size (replicates and points processed together)
+# Bootstraps the log likelihood ratio of every point. The reference samples are binned once onto
+# a grid, so resampling a group with replacement is a multinomial draw of its grid counts; each
+# replicate's two densities are fitted once on the grid (by fft) and reused for every point,
+# which is scored by linear interpolation. Only the n_boot x grid_size replicate densities and
+# one n_boot x block_size block of ratios are held in memory at a time
+# Returns (lower, upper) arrays with the alpha/2 and 1-alpha/2 percentiles of every point's log
+# likelihood ratio, NaN where the point is missing; run per region by RegionPool workers
+def region_bootstrap_intervals(f, m, points, n_boot, alpha, seed, grid_size=density.GRID_SIZE, rule='scott',
+                               batch_size=BATCH_SIZE, block_size=BLOCK_SIZE):
+    f = sorted_present(f)
+    m = sorted_present(m)
+    points = np.asarray(points, dtype=float)
+    present = np.isfinite(points)
+    lower = np.full(points.shape, np.nan)
+    upper = np.full(points.shape, np.nan)
+    # grid covers the reference samples, the points and the kernel tails past them
+    tail = density.KERNEL_TAIL * max(density.kde_bandwidth(f, rule), density.kde_bandwidth(m, rule))
+    lo = min(f[0], m[0], np.min(points[present], initial=np.inf)) - tail
+    hi = max(f[-1], m[-1], np.max(points[present], initial=-np.inf)) + tail
+    grid = np.linspace(lo, hi, grid_size)
+    delta = grid[1] - grid[0]
+    f_probabilities = density.nearest_counts(f, lo, delta, grid_size) / float(len(f))
+    m_probabilities = density.nearest_counts(m, lo, delta, grid_size) / float(len(m))
+
+    # densities of every replicate, fitted once
+    rng = np.random.default_rng(seed)
+    f_densities = np.empty((n_boot, grid_size))
+    m_densities = np.empty((n_boot, grid_size))
+    for start in range(0, n_boot, batch_size):
+        size = min(batch_size, n_boot - start)
+        f_counts = rng.multinomial(len(f), f_probabilities, size)
+        m_counts = rng.multinomial(len(m), m_probabilities, size)
+        f_densities[start:start + size] = density.binned_densities(f_counts, grid, rule)
+        m_densities[start:start + size] = density.binned_densities(m_counts, grid, rule)
+
+    # score the points a block at a time against every replicate
+    indices = np.flatnonzero(present)
+    for start in range(0, len(indices), block_size):
+        block = indices[start:start + block_size]
+        position = (points[block] - lo) / delta
+        left = np.clip(np.floor(position).astype(np.intp), 0, grid_size - 2)
+        weight = position - left
+        f_pdf = f_densities[:, left] * (1 - weight) + f_densities[:, left + 1] * weight
+        m_pdf = m_densities[:, left] * (1 - weight) + m_densities[:, left + 1] * weight
+        llr = log_ratios(f_pdf, m_pdf)
+        lower[block], upper[block] = np.percentile(llr, [50.0 * alpha, 100 - 50.0 * alpha], axis=0)
+    return lower, upper
+
+
+# Parameters: scorer (CohortScorer, whose reference data, regions and worker pool are used);
+# values (subjects x regions matrix in scorer.getRegions() order, NaN for missing); n_boot (number
+# of replicates); alpha (1 - coverage, 0.05 gives 95% intervals); seed (seed of the whole
+# bootstrap: every region gets its own stream spawned from it, so results do not depend on the
+# number of workers); grid_size, rule (see region_bootstrap_intervals; rule defaults to the
+# scorer's bandwidth rule, so the intervals are of the ratios the scorer computes)
+# Returns (lower, upper): subjects x regions matrices with the percentile interval of every log
+# likelihood ratio, NaN where the value is missing
+def bootstrap_intervals(scorer, values, n_boot=N_BOOTSTRAP, alpha=0.05, seed=0, grid_size=density.GRID_SIZE,
+                        rule=None):
+    if rule is None:
+        rule = scorer.bandwidth
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    regions = scorer.getRegions()
+    seeds = np.random.SeedSequence(seed).spawn(len(regions))
+    columns = dict((region, values[:, j]) for j, region in enumerate(regions))
+    args = [(n_boot, alpha, seeds[j], grid_size, rule) for j in range(len(regions))]
+    intervals = scorer.pool.map(region_bootstrap_intervals, [scorer.female_data, scorer.male_data, columns],
+                                regions, args, memoize=True)
+    lower = np.column_stack([low for (low, high) in intervals])
+    upper = np.column_stack([high for (low, high) in intervals])
+    return lower, upper
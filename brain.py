@@ -1,16 +1,53 @@
+import os
 import numpy as np
-import matplotlib.pyplot as plt
-import scipy.stats as stats
+from scoring import sorted_present, fit_grids
+from parallel import RegionPool, N_WORKERS
+import density
+import permutation
+import plots
+
+# codes of the zones in the int8 matrices returned by Brain.classifyZones
+ZONE_FEMALE = -1
+ZONE_INTERMEDIATE = 0
+ZONE_MALE = 1
+ZONE_MISSING = -128
+# map from zone code to the zone label used by Patient.calculateRegionZones
+ZONE_LABELS = {ZONE_FEMALE: 'F', ZONE_INTERMEDIATE: 'I', ZONE_MALE: 'M'}
 
 # function to take list of brain regions to analyze (in the beginning to either take all regions
     # or just take these regions)
 class Brain():
 
-    # female_data: map from brain region (string) to its value (float) for female patients
-    # male_data: map from brain region (string) to its value (float) for male patients
-    def __init__(self, female_data, male_data):
+    # female_data: map from brain region (string) to its values (list or array of floats, NaN for
+    # missing values) for female patients, i.e. Cohort.groupData('F') (views, not copies)
+    # male_data: same for male patients
+    # method: 'fft' (densities binned on a grid and convolved by fft), 'exact' (gaussian_kde
+    # evaluated at every sample, O(N^2) per region; kept for validation) or 'gaussian' (normal
+    # densities), see density.divergence
+    # grid_size: number of grid points of the 'fft' and 'gaussian' methods
+    # bandwidth: bandwidth rule of the kernels ('scott', 'silverman', 'robust' or a float factor)
+    # n_workers: number of processes computing regions in parallel (see parallel.RegionPool)
+    def __init__(self, female_data, male_data, method='fft', grid_size=density.GRID_SIZE, bandwidth='scott',
+                 n_workers=N_WORKERS):
+        density.check_method(method)
         self.female_data = female_data
         self.male_data = male_data
+        self.method = method
+        self.grid_size = grid_size
+        self.bandwidth = bandwidth
+        self.pool = RegionPool(n_workers)
+        # self.sorted_map = map from brain region name to its (female, male) values in increasing
+        # order with missing values left out; filled in as regions become top regions, so moving
+        # the end cutoffs is an index lookup instead of a sort
+        self.sorted_map = {}
+        # self.p_value_map, self.q_value_map = maps from brain region name to its permutation test
+        # p-value and false discovery rate q-value (filled in by permutationTest)
+        self.p_value_map = {}
+        self.q_value_map = {}
+        # self.density_grid_map = map from brain region name to its (grid, female density, male
+        # density), see density_grids; kept from the 'fft' divergence pass (filled in on
+        # demand for the 'exact' method) so plots reuse the fitted densities
+        self.density_grid_map = {}
         self.n_top_regions = 10
         self.end_percentage = 1.0/3.0
         self.intermediate_percentage = 1-2*(self.end_percentage)
@@ -26,37 +63,42 @@ class Brain():
         #    example: ('M', 1, 120.4) = categorize any value >= 120.4 into male-end
         self.end_ranges_map = self.__calculateRegionScores(self.top_regions)
 
-    # Calculates divergence value (female_mean - male_mean) / (sqrt(female_var + male_var))
+    # Calculates divergence value (area between the female and male kernel density estimates)
     # for each brain region to determine the top brain regions (those with biggest abs(divergence))
     # Number of top regions is determined by self.n_top_regions
+    # The 'fft' divergence is the area between the shared binned densities (scoring.fit_grids) over
+    # the range of the pooled samples, the range the 'exact' divergence covers: within ~1e-4 of the
+    # area between the two gaussian_kde over that range, while the 'exact' trapezoid rule over the
+    # samples misses it by up to ~1e-2 with 400 samples per group (see density.grid_divergence)
     # Returns: divergence map (map from region to its divergence), divergence array (array of
     # (abs(divergence), region name) pairs, in decreasing order), and top_regions array (array or)
     # names of top regions
     def __calculateTopRegions(self):
         divergence_map = {} # map from region (string) to its statistical distance value (float)
-        regions = [] # list of region names
         divergence = [] # list of absolute value of divergence
-        for region in self.female_data.keys():
-            # data for that region
-            f = sorted(self.female_data[region])
-            m = sorted(self.male_data[region])
-            all = sorted(np.hstack((f,m)))
-
-            f_kernel = stats.gaussian_kde(f)
-            m_kernel = stats.gaussian_kde(m)
-
-            # subract one kernel from the other and integrate
-            kernel_abs_diff = abs(f_kernel.evaluate(all) - m_kernel.evaluate(all))
-            diff_area = np.trapz(kernel_abs_diff, all)
-
+        regions = list(self.female_data.keys()) # list of region names
+        # area between the two densities of every region, spread over the worker processes
+        if self.method == 'fft':
+            # keep the densities the divergences are computed on
+            fits = fit_grids(self.pool, self.female_data, self.male_data, regions, self.grid_size, self.bandwidth)
+            self.density_grid_map.update(zip(regions, density_grids(fits)))
+            diff_areas = [density.range_divergence(*(tuple(fit) + density.sample_range(self.female_data[region],
+                                                                                       self.male_data[region])))
+                          for region, fit in zip(regions, fits)]
+        elif self.method == 'gaussian':
+            grids = self.__fitGrids(regions, self.method)
+            self.density_grid_map.update(zip(regions, grids))
+            diff_areas = [density.densities_divergence(*grid) for grid in grids]
+        else:
+            diff_areas = self.pool.map(region_divergence, [self.female_data, self.male_data], regions,
+                                       (self.method, self.grid_size, self.bandwidth), memoize=True)
+        for region, diff_area in zip(regions, diff_areas):
             divergence_map[region] = diff_area
-            regions.append(region)
             divergence.append(abs(divergence_map[region]))
 
         # array of sorted (abs(divergences), region) pairs
         sorted_divergence_array = sorted(zip(divergence, regions), reverse=True)
 
-        print(sorted_divergence_array)
         # names of top regions
         top_regions = [x for (y,x) in sorted_divergence_array][:self.n_top_regions]
 
@@ -72,37 +114,35 @@ class Brain():
         # 3) score = least extreme score in that end
     # Returns a map from brain region (string) to its respective list
     def __calculateRegionScores(self, brain_regions):
+        self.__sortRegions(brain_regions)
         end_ranges = {}
         for region in brain_regions:
-            # data for that region
-            f = sorted(self.female_data[region]) # increasing order
-            m = sorted(self.male_data[region])
-            # number of regions to be counted into female-end and male-end
-            num_f = int(np.ceil(len(f)*(self.end_percentage)))
-            num_m = int(np.ceil(len(m)*(self.end_percentage)))
-            end_ranges[region] = []
-            if(self.divergence_map[region] < 0): # means average in females is larger than average in males
-                end_ranges[region].append(('M', -1, m[num_m]))
-                end_ranges[region].append(('F', 1, f[-num_f]))
-            else:
-                end_ranges[region].append(('M', 1, m[-num_m]))
-                end_ranges[region].append(('F', -1, f[num_f]))
+            f, m = self.sorted_map[region]
+            end_ranges[region] = sorted_end_ranges(f, m, self.end_percentage, female_average_larger(f, m))
         return end_ranges
 
+    # Parameter: brain_regions (list of brain regions (string))
+    # Sorts the data of every region in brain_regions that is not in self.sorted_map yet
+    def __sortRegions(self, brain_regions):
+        new_regions = [region for region in brain_regions if region not in self.sorted_map]
+        sorted_data = self.pool.map(region_sorted, [self.female_data, self.male_data], new_regions)
+        self.sorted_map.update(zip(new_regions, sorted_data))
+
     # Parameter: n (number of top regions)
     # Sets the number of top regions to be included in further analysis, resets self.top_regions
     # to include n number of top regions, and calculates region scores (distribution of male-end,
-    # female-end, intermediate) for regions that did not previously have their scores calculated
+    # female-end, intermediate) for regions that did not previously have their scores calculated.
+    # Regions that stay in the top keep their scores; regions that drop out are removed
     def setNumTopRegions(self, n):
-        past_num = self.n_top_regions
         self.n_top_regions = n
-        past_top_regions = self.top_regions
         # resets names of top regions
         self.top_regions = [x for (y,x) in self.divergence][:n]
         # might need to calculate which scores are cutoffs for female/male-end for new regions
-        new_regions = list(set(self.top_regions) - set(past_top_regions))
-        if len(new_regions) != 0:
-            self.end_ranges_map = self.__calculateRegionScores(new_regions)
+        new_regions = [region for region in self.top_regions if region not in self.end_ranges_map]
+        end_ranges_map = dict((region, self.end_ranges_map[region]) for region in self.top_regions
+                              if region in self.end_ranges_map)
+        end_ranges_map.update(self.__calculateRegionScores(new_regions))
+        self.end_ranges_map = end_ranges_map
 
     # Returns number of top regions
     def getNumTopRegions(self):
@@ -126,6 +166,24 @@ class Brain():
     def getEndPercentage(self):
         return self.end_percentage
 
+    # Parameters: percentages (list of end percentages); brain_regions (list of brain regions,
+    # defaults to the top regions)
+    # Calculates the male-end and female-end cutoffs of every region for all of the percentages at
+    # once, without changing self.end_percentage (i.e. for sensitivity curves)
+    # Returns map from brain region (string) to a len(percentages) x 2 array whose rows are the
+    # (male-end score, female-end score) at each percentage; the direction (n) of each end is the
+    # same as in getEndRanges
+    def endRangeSweep(self, percentages, brain_regions=None):
+        if brain_regions is None:
+            brain_regions = self.top_regions
+        self.__sortRegions(brain_regions)
+        percentages = np.asarray(percentages, dtype=float)
+        sweep = {}
+        for region in brain_regions:
+            f, m = self.sorted_map[region]
+            sweep[region] = sorted_end_scores(f, m, percentages, female_average_larger(f, m))
+        return sweep
+
     # Parameter: region (string)
     # Returns the divergence value for the specified brain region
     def getDivergence(self, region):
@@ -136,12 +194,205 @@ class Brain():
     def getEndRanges(self):
         return self.end_ranges_map
 
-    def drawDistribution(self, region):
-        f = self.female_data[region]
-        m = self.male_data[region]
-        plt.hist(f, bins=len(f), normed=1, histtype='stepfilled', lw=2, edgecolor="None", color="r", alpha=0.5, label="female")
-        plt.hist(m, bins=len(m), normed=1, histtype='stepfilled', lw=2, edgecolor="None", color="b", alpha=0.5, label="male")
-        plt.legend(loc="upper right")
-        plt.xlabel(region)
-        plt.ylabel('Probability')
-        plt.show()
+    # Parameters: n_permutations (number of group label permutations per region); seed (random seed)
+    # Tests every region's divergence against the null distribution of divergences under shuffled
+    # group labels (see permutation.region_permutation_test), with regions spread over the worker
+    # processes. Sets the p-values and the Benjamini-Hochberg q-values of every region
+    # Returns (p-value map, q-value map), maps from brain region (string) to its p-value / q-value
+    def permutationTest(self, n_permutations=permutation.N_PERMUTATIONS, seed=0):
+        observed, self.p_value_map, self.q_value_map = permutation.permutation_test(
+            self.female_data, self.male_data, self.female_data.keys(), self.pool, n_permutations, seed,
+            self.grid_size, self.bandwidth)
+        return self.p_value_map, self.q_value_map
+
+    # Parameter: region (string)
+    # Returns the permutation test p-value of the region (after permutationTest)
+    def getPValue(self, region):
+        return self.p_value_map[region]
+
+    # Parameter: region (string)
+    # Returns the false discovery rate q-value of the region (after permutationTest)
+    def getQValue(self, region):
+        return self.q_value_map[region]
+
+    # Parameters: values (subjects x regions matrix of floats, NaN for missing, i.e.
+    # Cohort.columns(brain_regions)); brain_regions (regions of the columns, defaults to the top regions)
+    # Classifies every value against its region's end ranges in one vectorized pass, with the same
+    # precedence as Patient.calculateRegionZones (male-end is checked first)
+    # Returns subjects x regions int8 matrix of zone codes (ZONE_MALE, ZONE_FEMALE,
+    # ZONE_INTERMEDIATE, or ZONE_MISSING for missing values)
+    def classifyZones(self, values, brain_regions=None):
+        if brain_regions is None:
+            brain_regions = self.top_regions
+        values = np.atleast_2d(np.asarray(values, dtype=float))
+        return classify_zones(values, *end_range_arrays(self.end_ranges_map, brain_regions))
+
+    # Parameters: zones (subjects x regions matrix from classifyZones); groups (optional array with
+    # the group label of every subject)
+    # Counts each subject's male-end, female-end and intermediate regions (missing regions are not
+    # counted). A subject is internally consistent if all its regions are in the same end (as in
+    # Patient.isConsistent), and a mosaic if it has both male-end and female-end regions
+    # Returns map with per-subject arrays 'male_end', 'female_end', 'intermediate', 'consistent'
+    # and 'mosaic', the proportions 'consistent_proportion' and 'mosaic_proportion' over all
+    # subjects, and if groups is given, 'groups': map from group label to its
+    # (number of subjects, consistent proportion, mosaic proportion)
+    def zoneSummary(self, zones, groups=None):
+        zones = np.asarray(zones)
+        n_male_end, n_female_end, n_intermediate, consistent, mosaic = zone_counts(zones)
+        summary = {
+            'male_end': n_male_end,
+            'female_end': n_female_end,
+            'intermediate': n_intermediate,
+            'consistent': consistent,
+            'mosaic': mosaic,
+            'consistent_proportion': float(np.mean(consistent)) if len(zones) else 0.0,
+            'mosaic_proportion': float(np.mean(mosaic)) if len(zones) else 0.0,
+        }
+        if groups is not None:
+            groups = np.asarray(groups)
+            summary['groups'] = {}
+            for group in np.unique(groups):
+                rows = groups == group
+                summary['groups'][str(group)] = (int(np.count_nonzero(rows)), float(np.mean(consistent[rows])),
+                                                 float(np.mean(mosaic[rows])))
+        return summary
+
+    # Parameter: brain_regions (list of brain regions, defaults to every region)
+    # Fits the density grids of regions that do not have one yet (only the 'exact' method leaves
+    # them out), spread over the worker processes
+    # Returns map from brain region (string) to its (grid, female density, male density)
+    def densityGrids(self, brain_regions=None):
+        if brain_regions is None:
+            brain_regions = list(self.female_data.keys())
+        new_regions = [region for region in brain_regions if region not in self.density_grid_map]
+        # the 'exact' method's grids are binned kernel densities
+        grids = self.__fitGrids(new_regions, 'fft' if self.method == 'exact' else self.method)
+        self.density_grid_map.update(zip(new_regions, grids))
+        return dict((region, self.density_grid_map[region]) for region in brain_regions)
+
+    # Parameters: brain_regions (list of brain regions); method ('fft' or 'gaussian')
+    # Returns list of (grid, female density, male density), one per region. The 'fft' densities are
+    # the shared fits of scoring.fit_grids (the ones the reference model and an 'fft' CohortScorer
+    # use), on a grid reaching KERNEL_TAIL bandwidths past the pooled samples
+    def __fitGrids(self, brain_regions, method):
+        if method != 'fft':
+            return self.pool.map(region_normal_densities, [self.female_data, self.male_data], brain_regions,
+                                 (self.grid_size,), memoize=True)
+        return density_grids(fit_grids(self.pool, self.female_data, self.male_data, brain_regions, self.grid_size,
+                                       self.bandwidth))
+
+    # Parameters: region (string); figpath (path of the figure, defaults to
+    # results/distributions/<region>.png)
+    # Saves overlaid female and male histograms of the region
+    # Returns figpath
+    def drawDistribution(self, region, figpath=None):
+        if figpath is None:
+            if not os.path.exists(plots.DISTRIBUTIONS_PATH):
+                os.makedirs(plots.DISTRIBUTIONS_PATH)
+            figpath = plots.figure_path(plots.DISTRIBUTIONS_PATH, region)
+        f = sorted_present(self.female_data[region])
+        m = sorted_present(self.male_data[region])
+        return plots.render_distribution(f, m, region, figpath)
+
+
+# Parameters: end_ranges_map (map from brain region to its [('M', n, score), ('F', n, score)] list,
+# see Brain.getEndRanges); brain_regions (list of brain regions)
+# Returns (male-end directions, male-end scores, female-end directions, female-end scores) arrays,
+# one entry per region in brain_regions
+def end_range_arrays(end_ranges_map, brain_regions):
+    m_direction = np.array([end_ranges_map[region][0][1] for region in brain_regions], dtype=np.int8)
+    m_score = np.array([end_ranges_map[region][0][2] for region in brain_regions], dtype=float)
+    f_direction = np.array([end_ranges_map[region][1][1] for region in brain_regions], dtype=np.int8)
+    f_score = np.array([end_ranges_map[region][1][2] for region in brain_regions], dtype=float)
+    return m_direction, m_score, f_direction, f_score
+
+
+# Parameters: values (subjects x regions matrix of floats, or one subject's row, NaN for missing);
+# m_direction, m_score, f_direction, f_score (arrays from end_range_arrays for the columns' regions)
+# Returns int8 matrix (or row) of zone codes, see Brain.classifyZones
+def classify_zones(values, m_direction, m_score, f_direction, f_score):
+    values = np.asarray(values, dtype=float)
+    with np.errstate(invalid='ignore'):
+        male_end = np.where(m_direction == -1, values <= m_score, values >= m_score)
+        female_end = np.where(f_direction == -1, values <= f_score, values >= f_score)
+    zones = np.full(values.shape, ZONE_INTERMEDIATE, dtype=np.int8)
+    zones[female_end] = ZONE_FEMALE
+    zones[male_end] = ZONE_MALE
+    zones[np.isnan(values)] = ZONE_MISSING
+    return zones
+
+
+# Parameter: zones (subjects x regions matrix of zone codes, see Brain.classifyZones)
+# Returns (male-end, female-end and intermediate region counts, consistent, mosaic) arrays with one
+# entry per subject, missing regions not counted: a subject is internally consistent if all its
+# regions are in the same end, and a mosaic if it has both male-end and female-end regions (see
+# Brain.zoneSummary)
+def zone_counts(zones):
+    n_male_end = np.count_nonzero(zones == ZONE_MALE, axis=1)
+    n_female_end = np.count_nonzero(zones == ZONE_FEMALE, axis=1)
+    n_intermediate = np.count_nonzero(zones == ZONE_INTERMEDIATE, axis=1)
+    consistent = (n_intermediate == 0) & ((n_male_end == 0) != (n_female_end == 0))
+    mosaic = (n_male_end > 0) & (n_female_end > 0)
+    return n_male_end, n_female_end, n_intermediate, consistent, mosaic
+
+
+# Parameters: f, m (one region's female and male values, NaN for missing); method, grid_size,
+# bandwidth (see density.divergence)
+# Returns divergence (area between the female and male densities) of the region; run per region
+# by RegionPool workers
+def region_divergence(f, m, method, grid_size, bandwidth):
+    return density.divergence(sorted_present(f), sorted_present(m), method, grid_size, bandwidth)
+
+
+# Parameters: f, m (one region's female and male values, NaN for missing); grid_size (see
+# density.normal_grid_densities)
+# Returns (grid, female density, male density) of the region's normal densities; run per region by
+# RegionPool workers
+def region_normal_densities(f, m, grid_size):
+    return density.normal_grid_densities(sorted_present(f), sorted_present(m), grid_size)
+
+
+# Parameter: grids (list of (lo, hi, female density, male density), see scoring.fit_grids)
+# Returns list of (grid, female density, male density), as density.normal_grid_densities
+def density_grids(grids):
+    return [(np.linspace(lo, hi, len(f_density)), f_density, m_density) for lo, hi, f_density, m_density in grids]
+
+
+# Parameters: f, m (one region's female and male values, NaN for missing)
+# Returns (f, m) in increasing order with missing values left out; run per region by RegionPool workers
+def region_sorted(f, m):
+    return sorted_present(f), sorted_present(m)
+
+
+# Parameters: f, m (one region's female and male values, missing values left out)
+# Returns True if the female average is larger than the male average, so the female end is the
+# top of the region's range and the male end the bottom (the divergence is an area, so it does not
+# tell which group is larger)
+def female_average_larger(f, m):
+    return bool(np.mean(f) > np.mean(m))
+
+
+# Parameters: f, m (one region's female and male values, sorted, missing values left out);
+# percentages (array of fractions of each group in its end); female_larger (True if the female
+# average is larger)
+# Returns len(percentages) x 2 array of (male-end score, female-end score), by index lookup
+def sorted_end_scores(f, m, percentages, female_larger):
+    # number of regions to be counted into female-end and male-end
+    num_f = np.ceil(len(f)*percentages).astype(int)
+    num_m = np.ceil(len(m)*percentages).astype(int)
+    if(female_larger):
+        # m[num_m] and f[-num_f]
+        return np.column_stack((m[num_m], f[(len(f) - num_f) % len(f)]))
+    # m[-num_m] and f[num_f]
+    return np.column_stack((m[(len(m) - num_m) % len(m)], f[num_f]))
+
+
+# Parameters: f, m (one region's female and male values, sorted, missing values left out);
+# end_percentage (fraction of each group in its end); female_larger (True if the female average
+# is larger)
+# Returns the region's [('M', n, score), ('F', n, score)] list (see Brain.getEndRanges)
+def sorted_end_ranges(f, m, end_percentage, female_larger):
+    m_score, f_score = sorted_end_scores(f, m, np.array([end_percentage]), female_larger)[0]
+    if(female_larger):
+        return [('M', -1, m_score), ('F', 1, f_score)]
+    return [('M', 1, m_score), ('F', -1, f_score)]
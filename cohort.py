@@ -0,0 +1,288 @@
+import csv
+import itertools
+import numpy as np
+from patient import Patient
+
+# number of csv rows parsed into arrays at a time by read_chunks
+CHUNK_SIZE = 10000
+# group labels of subjects without a group (after stripping spaces; 'NA' is what quantile_levels
+# gives a missing score)
+MISSING_GROUPS = ('', 'NA')
+
+
+# Columnar store for the whole data set: one float64 subjects x variables matrix (column-major,
+# so a variable's values for one group are a contiguous slice), a group label and an id per row.
+# Missing values are stored as NaN in the matrix.
+# Rows are kept sorted by group, so every group is a contiguous block and Brain, CohortScorer
+# and Patient can all take views of the matrix instead of copies.
+class Cohort:
+
+    # ids: subject ids (list of strings), one per row
+    # groups: group label (string) of each row (i.e. 'M' or 'F')
+    # variables: names of the brain regions (list of strings)
+    # values: subjects x columns matrix of floats, NaN for missing values
+    # columns: column of values holding each variable (defaults to one column per variable, in
+    # order), so a cohort of some of the variables can share a larger matrix (see subset)
+    def __init__(self, ids, groups, variables, values, columns=None):
+        ids = np.asarray(ids)
+        groups = np.asarray(groups)
+        values = np.asarray(values, dtype=np.float64)
+        self.variables = list(variables)
+        columns = list(range(values.shape[1])) if columns is None else list(columns)
+        if np.all(groups[:-1] <= groups[1:]) and values.flags['F_CONTIGUOUS']:
+            # already in Cohort layout (i.e. memory-mapped from cohort_cache), so keep the arrays as they are
+            self.ids = ids
+            self.groups = groups
+            self.values = values
+        else:
+            # stable sort keeps the original file order within each group
+            order = np.argsort(groups, kind='mergesort')
+            self.ids = ids[order]
+            self.groups = groups[order]
+            # reorder straight into column-major storage (a single copy of the columns in use)
+            if columns == list(range(values.shape[1])):
+                self.values = np.empty(values.shape, dtype=np.float64, order='F')
+                np.take(values, order, axis=0, out=self.values)
+            else:
+                self.values = np.empty((len(order), len(columns)), dtype=np.float64, order='F')
+                for k, column in enumerate(columns):
+                    np.take(values[:, column], order, out=self.values[:, k])
+                columns = list(range(len(columns)))
+        # self.id_index = map from subject id (string) to its row in self.values
+        self.id_index = dict((subject, i) for i, subject in enumerate(self.ids))
+        # self.variable_index = map from brain region (string) to its column in self.values
+        self.variable_index = dict(zip(self.variables, columns))
+        # self.group_slices = map from group label (string) to the block of rows of that group
+        self.group_slices = {}
+        levels, starts, counts = np.unique(self.groups, return_index=True, return_counts=True)
+        for level, start, count in zip(levels, starts, counts):
+            self.group_slices[str(level)] = slice(int(start), int(start + count))
+
+    # Returns number of subjects
+    def __len__(self):
+        return len(self.ids)
+
+    # Returns list of subject ids, in row order
+    def getIds(self):
+        return list(self.ids)
+
+    # Returns list of group labels present in the data
+    def getGroups(self):
+        return sorted(self.group_slices.keys())
+
+    # Returns list of the group labels present in the data, leaving out MISSING_GROUPS (empty,
+    # blank or 'NA' labels)
+    def getLevels(self):
+        return [group for group in self.getGroups() if group.strip() not in MISSING_GROUPS]
+
+    # Returns number of subjects whose group label is missing (see getLevels)
+    def countUnlabelled(self):
+        levels = set(self.getLevels())
+        return sum(rows.stop - rows.start for group, rows in self.group_slices.items() if group not in levels)
+
+    # Returns list of variable (brain region) names, in column order
+    def getVariables(self):
+        return self.variables
+
+    # Parameter: group (string)
+    # Returns subjects x variables view of the rows in that group
+    def groupValues(self, group):
+        return self.values[self.group_slices[group]]
+
+    # Parameter: group (string)
+    # Returns map from brain region (string) to a view of its values (NaN for missing) in that group
+    def groupData(self, group):
+        rows = self.group_slices[group]
+        return dict((variable, self.values[rows, self.variable_index[variable]]) for variable in self.variables)
+
+    # Parameter: variables (list of brain regions)
+    # Returns subjects x len(variables) matrix with columns in the requested order
+    # (a view when the order matches the stored columns)
+    def columns(self, variables):
+        indices = [self.variable_index[variable] for variable in variables]
+        if indices == list(range(self.values.shape[1])):
+            return self.values
+        return self.values[:, indices]
+
+    # Parameter: variables (list of brain regions)
+    # Returns Cohort of the same subjects with only those variables, in that order, sharing this
+    # cohort's arrays (i.e. the memory-mapped cache) and reading its columns through a column map
+    def subset(self, variables):
+        return Cohort(self.ids, self.groups, variables, self.values,
+                      [self.variable_index[variable] for variable in variables])
+
+    # Parameter: patient_id (string)
+    # Returns a Patient whose data is a view of that subject's row
+    def patient(self, patient_id):
+        i = self.id_index[patient_id]
+        return Patient(patient_id, str(self.groups[i]), SubjectData(self.variable_index, self.values[i]))
+
+    # Returns list of Patients, one per row
+    def patients(self):
+        return [self.patient(patient_id) for patient_id in self.ids]
+
+
+# Read-only map from brain region (string) to its value (float) for one subject, backed by a row
+# of the Cohort matrix
+class SubjectData:
+
+    # variable_index: map from brain region (string) to its position in row
+    # row: view of the subject's row in the Cohort matrix
+    def __init__(self, variable_index, row):
+        self.variable_index = variable_index
+        self.row = row
+
+    def __getitem__(self, region):
+        return float(self.row[self.variable_index[region]])
+
+    def __contains__(self, region):
+        return region in self.variable_index
+
+    def __iter__(self):
+        return iter(self.variable_index)
+
+    def __len__(self):
+        return len(self.variable_index)
+
+    def keys(self):
+        return list(self.variable_index.keys())
+
+    def items(self):
+        return [(region, self[region]) for region in self.variable_index]
+
+
+# Parameters: csv_file (path to csv file); subject_id, group_by (names of the id and group columns);
+# variables (names of the brain region columns to load); chunk_size (rows parsed at a time)
+# Streams csv_file and yields (ids, groups, values) for every chunk_size rows, so memory does not
+# scale with the size of the file: ids and groups are arrays of strings, values is a
+# rows x variables float64 array with NaN for missing or non-numeric cells.
+# Only the id, group and variable columns are parsed, by numpy's C parser.
+def read_chunks(csv_file, subject_id, group_by, variables, chunk_size=CHUNK_SIZE):
+    for labels, values in read_label_chunks(csv_file, [subject_id, group_by], variables, chunk_size):
+        yield labels[:, 0], labels[:, 1], values
+
+
+# Parameters: csv_file (path to csv file); label_names (names of the columns read as strings, i.e.
+# the id column and one or more group columns); variables, chunk_size (see read_chunks)
+# Yields (labels, values) for every chunk_size rows: labels is a rows x len(label_names) array of
+# strings, values the rows x variables float64 array of read_chunks
+def read_label_chunks(csv_file, label_names, variables, chunk_size=CHUNK_SIZE):
+    with open(csv_file, 'r', newline='') as f:
+        header = next(csv.reader([f.readline().rstrip('\r\n')]))
+        # precomputed column index of every field that is kept
+        label_columns = [header.index(name) for name in label_names]
+        value_columns = [header.index(variable) for variable in variables]
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if len(lines) == 0:
+                break
+            lines = [line for line in lines if line.strip()]
+            if len(lines) == 0:
+                continue
+            labels = np.loadtxt(lines, delimiter=',', quotechar='"', dtype=str, usecols=label_columns, ndmin=2)
+            yield labels, to_float(lines, value_columns)
+
+
+# Parameters: lines (list of csv lines); columns (indices of the columns to parse)
+# Returns len(lines) x len(columns) float64 array, NaN where a cell is empty or not a number
+def to_float(lines, columns):
+    try:
+        return np.loadtxt(lines, delimiter=',', quotechar='"', dtype=np.float64, usecols=columns, ndmin=2)
+    except ValueError:
+        pass
+    # empty cells are filled with 'nan' by string replacements, so chunks with missing values still
+    # go through the C parser
+    try:
+        return np.loadtxt(fill_empty(lines), delimiter=',', quotechar='"', dtype=np.float64, usecols=columns,
+                          ndmin=2)
+    except ValueError:
+        # only chunks holding text are parsed cell by cell
+        return np.loadtxt(lines, delimiter=',', quotechar='"', dtype=np.float64, usecols=columns, ndmin=2,
+                          converters=parse_float)
+
+
+# Parameter: lines (list of csv lines)
+# Returns list of the lines, without their line terminators, with 'nan' in every empty cell
+def fill_empty(lines):
+    filled = []
+    for line in lines:
+        # without its terminator, whether '\n', '\r\n' or '\r'
+        line = line.rstrip('\r\n')
+        if ',,' in line:
+            # twice, since the replacements of a run of empty cells overlap
+            line = line.replace(',,', ',nan,').replace(',,', ',nan,')
+        if line.startswith(','):
+            line = 'nan' + line
+        if line.endswith(','):
+            line += 'nan'
+        filled.append(line)
+    return filled
+
+
+# Parameters: values (array of the group column as strings, i.e. a continuous score); n_bins
+# (number of bins)
+# Returns array of level labels of equal-frequency bins of the values: 'Q1' (lowest) to 'Qn',
+# zero padded so labels sort in bin order, and 'NA' for values that are not numbers. Bins are
+# closed on the right, so values tied with an edge go to the lower bin
+def quantile_levels(values, n_bins):
+    numbers = np.array([parse_float(value) for value in values], dtype=float)
+    present = np.isfinite(numbers)
+    labels = np.full(len(numbers), 'NA', dtype='<U%d' % (len(str(n_bins)) + 1))
+    if present.any():
+        edges = np.quantile(numbers[present], np.linspace(0, 1, n_bins + 1)[1:-1])
+        bins = np.searchsorted(edges, numbers[present], side='left')
+        labels[present] = np.char.add('Q', np.char.zfill((bins + 1).astype(str), len(str(n_bins))))
+    return labels
+
+
+# Parameters: cohort (Cohort whose groups are a continuous score); n_bins (number of bins)
+# Returns Cohort with the same subjects whose groups are the quantile_levels of the score
+def bin_groups(cohort, n_bins):
+    return Cohort(cohort.ids, quantile_levels(cohort.groups, n_bins), cohort.getVariables(), cohort.values,
+                  [cohort.variable_index[variable] for variable in cohort.getVariables()])
+
+
+# Parameter: value (string)
+# Returns value as a float, or NaN if it is not a number
+def parse_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+# Parameters: same as read_chunks
+# Returns a Cohort holding the id, group and variable columns of csv_file
+def read_cohort(csv_file, subject_id, group_by, variables, chunk_size=CHUNK_SIZE):
+    ids = []
+    groups = []
+    values = []
+    for chunk_ids, chunk_groups, chunk_values in read_chunks(csv_file, subject_id, group_by, variables, chunk_size):
+        ids.append(chunk_ids)
+        groups.append(chunk_groups)
+        values.append(chunk_values)
+    if len(values) == 0:
+        return Cohort([], [], variables, np.empty((0, len(variables))))
+    return Cohort(np.concatenate(ids), np.concatenate(groups), variables, np.concatenate(values))
+
+
+# Parameters: csv_file (path to csv file); subject_id (name of the id column); group_columns (names
+# of the group columns); variables, chunk_size (see read_chunks)
+# Parses csv_file once for every group column
+# Returns map from group column to the Cohort of the subjects grouped by it
+def read_cohorts(csv_file, subject_id, group_columns, variables, chunk_size=CHUNK_SIZE):
+    group_columns = list(group_columns)
+    labels = []
+    values = []
+    for chunk_labels, chunk_values in read_label_chunks(csv_file, [subject_id] + group_columns, variables,
+                                                        chunk_size):
+        labels.append(chunk_labels)
+        values.append(chunk_values)
+    if len(values) == 0:
+        labels = np.empty((0, len(group_columns) + 1), dtype=str)
+        values = np.empty((0, len(variables)))
+    else:
+        labels = np.concatenate(labels)
+        values = np.concatenate(values)
+    return dict((group_by, Cohort(labels[:, 0], labels[:, k + 1], variables, values))
+                for k, group_by in enumerate(group_columns))
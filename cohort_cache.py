@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from cohort import Cohort, read_cohort, read_cohorts
+
+# default directory holding one sub-directory of .npy arrays per cached (data file, config) pair
+CACHE_DIR = 'cache'
+# bytes read at a time while hashing the data file
+BLOCK_SIZE = 1 << 20
+
+
+# Parameter: csv_file (path to csv file)
+# Returns sha1 hex digest of the file's contents
+def file_hash(csv_file):
+    digest = hashlib.sha1()
+    with open(csv_file, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Parameters: csv_file (path to csv file); subject_id, group_by (names of the id and group columns);
+# variables (names of the brain region columns)
+# Returns key identifying the parsed data: changes whenever the file's size, mtime or contents
+# change, or a different <subjectId>, <groups> or <variables> is selected
+def cache_key(csv_file, subject_id, group_by, variables):
+    stat = os.stat(csv_file)
+    fingerprint = {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'hash': file_hash(csv_file),
+        'subjectId': subject_id,
+        'groups': group_by,
+        'variables': list(variables),
+    }
+    return hashlib.sha1(json.dumps(fingerprint, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# Parameters: cohort (Cohort); path (directory to write)
+# Writes the cohort's ids, group labels and value matrix as .npy files, rows sorted by group and
+# the matrix column-major, so they can be memory-mapped back without reordering.
+# The directory is written under a temporary name and renamed, so a reader never sees half a cache.
+def save_cohort(cohort, path):
+    parent = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+    tmp_path = tempfile.mkdtemp(dir=parent)
+    np.save(os.path.join(tmp_path, 'ids.npy'), cohort.ids)
+    np.save(os.path.join(tmp_path, 'groups.npy'), cohort.groups)
+    np.save(os.path.join(tmp_path, 'values.npy'), np.asfortranarray(cohort.columns(cohort.getVariables())))
+    with open(os.path.join(tmp_path, 'variables.json'), 'w') as f:
+        json.dump(cohort.getVariables(), f)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another run cached the same data first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+# Parameter: path (directory written by save_cohort)
+# Returns Cohort whose arrays are memory-mapped from path (read-only, nothing is parsed or copied)
+def load_cached_cohort(path):
+    ids = np.load(os.path.join(path, 'ids.npy'), mmap_mode='r')
+    groups = np.load(os.path.join(path, 'groups.npy'), mmap_mode='r')
+    values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+    with open(os.path.join(path, 'variables.json')) as f:
+        variables = json.load(f)
+    return Cohort(ids, groups, variables, values)
+
+
+# Parameters: same as cohort.read_cohort, plus cache_dir (directory of the cache)
+# Returns Cohort for csv_file: memory-mapped from the cache when csv_file and the selected columns
+# are unchanged since an earlier run, otherwise parsed from csv_file and added to the cache
+def load_cohort(csv_file, subject_id, group_by, variables, cache_dir=CACHE_DIR):
+    path = os.path.join(cache_dir, cache_key(csv_file, subject_id, group_by, variables))
+    if os.path.exists(path):
+        return load_cached_cohort(path)
+    cohort = read_cohort(csv_file, subject_id, group_by, variables)
+    save_cohort(cohort, path)
+    return cohort
+
+
+# Parameters: csv_file (path to csv file); subject_id (name of the id column); group_columns (names
+# of the group columns); variables (names of the brain region columns); cache_dir (directory of
+# the cache)
+# Caches a Cohort of csv_file for every group column, parsing csv_file at most once for all the
+# group columns that are not cached yet
+# Returns map from group column to the directory of its cached Cohort (see load_cached_cohort)
+def cache_cohorts(csv_file, subject_id, group_columns, variables, cache_dir=CACHE_DIR):
+    paths = dict((group_by, os.path.join(cache_dir, cache_key(csv_file, subject_id, group_by, variables)))
+                 for group_by in group_columns)
+    missing = [group_by for group_by in group_columns if not os.path.exists(paths[group_by])]
+    if missing:
+        for group_by, cohort in read_cohorts(csv_file, subject_id, missing, variables).items():
+            save_cohort(cohort, paths[group_by])
+    return paths
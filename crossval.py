@@ -0,0 +1,113 @@
+import numpy as np
+from scipy import stats
+import density
+from parallel import RegionPool, N_WORKERS
+from scoring import log_ratios
+
+# default number of folds ('loo' for leave-one-out)
+N_FOLDS = 10
+
+
+# Parameters: n (number of subjects of a group); n_folds (number of folds); seed (seed of the
+# assignment); group (index of the group, so each group gets its own stream)
+# Returns array with the fold (0 to n_folds-1) of each subject: a random permutation of the
+# subjects dealt round robin, so every fold holds the same share (within one) of every group
+def fold_assignment(n, n_folds, seed, group):
+    rng = np.random.default_rng([seed, group])
+    folds = np.empty(n, dtype=np.intp)
+    folds[rng.permutation(n)] = np.arange(n) % n_folds
+    return folds
+
+
+# Parameters: f, m (one region's female and male values in subject order, NaN for missing);
+# n_folds (number of folds, or None for leave-one-out); seed (seed of the fold assignment);
+# method, rule, grid_size (see density.fit_density)
+# Returns (female llrs, male llrs): the log likelihood ratio of every subject's value under
+# densities fitted without that subject, NaN where the value is missing; run per region by
+# RegionPool workers.
+# k-fold: both densities are fitted once per fold on the other folds' subjects, and every subject
+# of the fold is scored in one batch. The folds depend only on the group sizes and the seed, so a
+# subject is held out of the same fold in every region and summed ratios stay held out.
+# Leave-one-out: both densities are fitted once on every subject, and each subject's own kernel is
+# taken out of its group's density at its value (density.leave_one_out), so the cost is that of a
+# single fit and evaluation rather than one refit per subject
+def region_cv_llrs(f, m, n_folds, seed, method='exact', rule='scott', grid_size=density.GRID_SIZE):
+    f = np.asarray(f, dtype=float)
+    m = np.asarray(m, dtype=float)
+    f_present = np.isfinite(f)
+    m_present = np.isfinite(m)
+    f_llr = np.full(len(f), np.nan)
+    m_llr = np.full(len(m), np.nan)
+    if n_folds is None:
+        f_density, m_density = density.fit_pair(f[f_present], m[m_present], method, rule, grid_size)
+        f_llr[f_present] = log_ratios(f_density.leaveOneOut(), m_density.evaluate(f[f_present]))
+        m_llr[m_present] = log_ratios(f_density.evaluate(m[m_present]), m_density.leaveOneOut())
+        return f_llr, m_llr
+    f_folds = fold_assignment(len(f), n_folds, seed, 0)
+    m_folds = fold_assignment(len(m), n_folds, seed, 1)
+    for fold in range(n_folds):
+        f_test = f_present & (f_folds == fold)
+        m_test = m_present & (m_folds == fold)
+        if not (f_test.any() or m_test.any()):
+            continue
+        f_density, m_density = density.fit_pair(f[f_present & ~f_test], m[m_present & ~m_test], method, rule,
+                                                      grid_size)
+        f_llr[f_test] = log_ratios(f_density.evaluate(f[f_test]), m_density.evaluate(f[f_test]))
+        m_llr[m_test] = log_ratios(f_density.evaluate(m[m_test]), m_density.evaluate(m[m_test]))
+    return f_llr, m_llr
+
+
+# Parameters: female_data, male_data (maps from brain region (string) to its values in subject
+# order, NaN for missing, i.e. Cohort.groupData('F') and Cohort.groupData('M')); regions (list of
+# brain regions); n_folds (number of folds, or None for leave-one-out); seed (seed of the folds);
+# method, bandwidth, grid_size (see density.fit_density); n_workers (see parallel.RegionPool)
+# Returns (female llrs, male llrs): subjects x regions matrices of held-out log likelihood ratios
+# (see region_cv_llrs), rows in the order of each group's data
+def cross_validate(female_data, male_data, regions, n_folds=N_FOLDS, seed=0, method='exact', bandwidth='scott',
+                   grid_size=density.GRID_SIZE, n_workers=N_WORKERS):
+    regions = list(regions)
+    results = RegionPool(n_workers).map(region_cv_llrs, [female_data, male_data], regions,
+                                        (n_folds, seed, method, bandwidth, grid_size), memoize=True)
+    n_f = len(female_data[regions[0]]) if regions else 0
+    n_m = len(male_data[regions[0]]) if regions else 0
+    # the shared memory rows of the worker processes are padded to the longest region
+    f_llr = np.column_stack([f_llr[:n_f] for f_llr, m_llr in results]) if regions else np.empty((0, 0))
+    m_llr = np.column_stack([m_llr[:n_m] for f_llr, m_llr in results]) if regions else np.empty((0, 0))
+    return f_llr, m_llr
+
+
+# Parameters: f_scores, m_scores (arrays of female and male scores, larger meaning more male)
+# Returns area under the ROC curve of the scores separating male from female subjects (the
+# probability a random male subject scores higher than a random female one, ties counting half),
+# or NaN if either group is empty
+def roc_auc(f_scores, m_scores):
+    if len(f_scores) == 0 or len(m_scores) == 0:
+        return np.nan
+    ranks = stats.rankdata(np.concatenate([f_scores, m_scores]))
+    m_ranks = np.sum(ranks[len(f_scores):])
+    return (m_ranks - len(m_scores) * (len(m_scores) + 1) / 2.0) / (len(f_scores) * len(m_scores))
+
+
+# Parameters: f_scores, m_scores (arrays of female and male scores, NaN for missing)
+# Returns (subjects, accuracy, AUC) of classifying subjects with a score above 0 as male, over
+# the subjects whose score is present
+def classification(f_scores, m_scores):
+    f_scores = f_scores[np.isfinite(f_scores)]
+    m_scores = m_scores[np.isfinite(m_scores)]
+    n = len(f_scores) + len(m_scores)
+    if n == 0:
+        return 0, np.nan, np.nan
+    correct = np.count_nonzero(f_scores <= 0) + np.count_nonzero(m_scores > 0)
+    return n, correct / float(n), roc_auc(f_scores, m_scores)
+
+
+# Parameters: f_llr, m_llr (held-out log likelihood ratio matrices, see cross_validate); regions
+# (their column names)
+# Returns list of (region, subjects, accuracy, AUC) rows: one per region, then 'Sum' for the sum of
+# every subject's present ratios (subjects with no present value left out)
+def classification_summary(f_llr, m_llr, regions):
+    rows = [(region,) + classification(f_llr[:, j], m_llr[:, j]) for j, region in enumerate(regions)]
+    f_sum = np.where(np.isfinite(f_llr).any(axis=1), np.nansum(f_llr, axis=1), np.nan)
+    m_sum = np.where(np.isfinite(m_llr).any(axis=1), np.nansum(m_llr, axis=1), np.nan)
+    rows.append(('Sum',) + classification(f_sum, m_sum))
+    return rows
@@ -0,0 +1,452 @@
+import numpy as np
+from scipy import stats
+
+# np.trapz was renamed np.trapezoid in numpy 2.0
+trapezoid = getattr(np, 'trapezoid', None) or np.trapz
+
+# default number of grid points the binned densities are evaluated on
+GRID_SIZE = 1024
+# the gaussian kernel is truncated this many bandwidths from its centre
+KERNEL_TAIL = 5.0
+# density estimators: 'exact' (gaussian_kde, O(n) per evaluated point), 'fft' (kernel density
+# binned on a grid and convolved by fft, O(1) per point by interpolation), 'gaussian' (parametric
+# normal density, O(1) per point)
+METHODS = ('exact', 'fft', 'gaussian')
+# the interquartile range of a normal distribution in standard deviations
+IQR_SIGMAS = 1.349
+
+
+# Parameters: n (number of samples); rule ('scott', 'silverman', 'robust', or a float used as the
+# factor)
+# Returns the bandwidth factor gaussian_kde uses for that rule: the kernel's standard deviation
+# is the factor times the sample's spread (the standard deviation, or for 'robust' the smaller of
+# the standard deviation and the interquartile range / IQR_SIGMAS, see robust_spread)
+def bandwidth_factor(n, rule='scott'):
+    if rule == 'scott':
+        return n ** (-1.0 / 5)
+    if rule == 'silverman':
+        return (n * 3.0 / 4.0) ** (-1.0 / 5)
+    if rule == 'robust':
+        # Silverman's rule of thumb
+        return 0.9 * n ** (-1.0 / 5)
+    return float(rule)
+
+
+# Parameters: std (standard deviation of the samples); q1, q3 (their first and third quartiles)
+# Returns the spread the 'robust' rule scales its bandwidth by: a few outliers widen the standard
+# deviation but not the interquartile range, and a sample with a narrow core keeps a narrow kernel
+def robust_spread(std, q1, q3):
+    iqr = (q3 - q1) / IQR_SIGMAS
+    return np.where(iqr > 0, np.minimum(std, iqr), std)
+
+
+# Parameters: x (array of samples); rule (see bandwidth_factor)
+# Returns standard deviation of the gaussian kernel gaussian_kde(x, bw_method=kde_factor(x, rule))
+# uses (the same as gaussian_kde(x, bw_method=rule) for 'scott', 'silverman' and factors)
+def kde_bandwidth(x, rule='scott'):
+    std = np.std(x, ddof=1)
+    if rule == 'robust':
+        std = float(robust_spread(std, *np.percentile(x, [25, 75])))
+    return std * bandwidth_factor(len(x), rule)
+
+
+# Parameters: x (array of samples); rule (see bandwidth_factor)
+# Returns bw_method to pass gaussian_kde for that rule (a factor of the standard deviation for
+# the rules gaussian_kde does not know)
+def kde_factor(x, rule='scott'):
+    if rule in ('scott', 'silverman'):
+        return rule
+    std = np.std(x, ddof=1)
+    return kde_bandwidth(x, rule) / std if std > 0 else bandwidth_factor(len(x), rule)
+
+
+# Parameters: x (array of samples, all within [lo, lo + (grid_size-1)*delta]); lo (first grid point);
+# delta (grid spacing); grid_size (number of grid points)
+# Returns array of grid_size weights: every sample is split between its two neighbouring grid
+# points in proportion to its distance from each (linear binning)
+def linear_binning(x, lo, delta, grid_size):
+    position = (np.asarray(x, dtype=float) - lo) / delta
+    index = np.clip(np.floor(position).astype(np.intp), 0, grid_size - 2)
+    weight = position - index
+    counts = np.bincount(index, weights=1 - weight, minlength=grid_size)
+    counts += np.bincount(index + 1, weights=weight, minlength=grid_size)
+    return counts[:grid_size]
+
+
+# Parameters: bandwidth (standard deviation of the kernel); delta (grid spacing);
+# grid_size (number of grid points); n_fft (length of the fft, at least 2*grid_size)
+# Returns real fft of the gaussian kernel sampled every delta, wrapped around for circular
+# convolution (see gaussian_kernels_fft)
+def gaussian_kernel_fft(bandwidth, delta, grid_size, n_fft):
+    return gaussian_kernels_fft(np.array([bandwidth], dtype=float), delta, grid_size, n_fft)[0]
+
+
+# Parameters: bandwidths (array of kernel standard deviations); delta, grid_size, n_fft (see
+# gaussian_kernel_fft)
+# Returns len(bandwidths) x (n_fft/2 + 1) array with the real fft of every kernel, sampled every
+# delta and wrapped around for circular convolution. Offsets past the grid (or KERNEL_TAIL
+# bandwidths) are dropped, since no two grid points are further apart than that. A zero
+# bandwidth gives a spike at the grid point itself
+def gaussian_kernels_fft(bandwidths, delta, grid_size, n_fft):
+    bandwidths = np.asarray(bandwidths, dtype=float)[:, None]
+    offsets = np.arange(grid_size) * delta
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = np.exp(-0.5 * (offsets / bandwidths) ** 2) / (bandwidths * np.sqrt(2 * np.pi))
+        values[offsets > KERNEL_TAIL * bandwidths] = 0
+    spike = (bandwidths <= 0)[:, 0]
+    values[spike] = 0
+    values[spike, 0] = 1.0 / delta
+    kernels = np.zeros((len(bandwidths), n_fft))
+    kernels[:, :grid_size] = values
+    kernels[:, n_fft - grid_size + 1:] = values[:, :0:-1]
+    return np.fft.rfft(kernels, axis=1)
+
+
+# Parameters: counts (array of grid_size bin weights, or a matrix with one row of weights per
+# density); kernels (fft of the kernel of each row, from gaussian_kernels_fft); n (number of samples
+# of each row); n_fft (length of the fft)
+# Returns densities on the grid: the bin weights convolved with the kernels, divided by n
+def convolve_counts(counts, kernels, n, n_fft):
+    counts = np.asarray(counts, dtype=float)
+    grid_size = counts.shape[-1]
+    density = np.fft.irfft(np.fft.rfft(counts, n_fft, axis=-1) * kernels, n_fft, axis=-1)[..., :grid_size]
+    return np.maximum(density / np.asarray(n, dtype=float)[..., None], 0)
+
+
+# Parameter: grid_size (number of grid points)
+# Returns fft length used to convolve grid_size points without wrap-around (a power of two)
+def fft_size(grid_size):
+    return 1 << int(np.ceil(np.log2(2 * grid_size)))
+
+
+# Parameters: x (array of samples); lo, hi (ends of the grid, covering every sample);
+# grid_size (number of grid points); rule (bandwidth rule, see bandwidth_factor)
+# Returns (grid, density): the gaussian kernel density estimate of x on grid_size evenly spaced
+# points from lo to hi, computed by binning x onto the grid and convolving with the kernel by fft.
+# O(n + grid_size log grid_size) instead of the O(n * points) of gaussian_kde.evaluate
+def grid_kde(x, lo, hi, grid_size=GRID_SIZE, rule='scott'):
+    x = np.asarray(x, dtype=float)
+    grid = np.linspace(lo, hi, grid_size)
+    delta = grid[1] - grid[0]
+    n_fft = fft_size(grid_size)
+    counts = linear_binning(x, lo, delta, grid_size)
+    kernel = gaussian_kernel_fft(kde_bandwidth(x, rule), delta, grid_size, n_fft)
+    return grid, convolve_counts(counts, kernel, len(x), n_fft)
+
+
+# Parameters: x (array of samples); lo (first grid point); delta (grid spacing); grid_size (number
+# of grid points)
+# Returns array of grid_size counts of the samples nearest to each grid point
+def nearest_counts(x, lo, delta, grid_size):
+    index = np.clip(np.rint((np.asarray(x, dtype=float) - lo) / delta).astype(np.intp), 0, grid_size - 1)
+    return np.bincount(index, minlength=grid_size)
+
+
+# Parameters: counts (k x grid_size matrix of sample counts per grid point, one row per sample set);
+# grid (grid points); rule (bandwidth rule)
+# Returns k x grid_size matrix with the kernel density estimate of every row on the grid, each
+# row's bandwidth taken from its own binned samples, all rows convolved by fft at once
+def binned_densities(counts, grid, rule='scott'):
+    delta = grid[1] - grid[0]
+    n_fft = fft_size(len(grid))
+    # centring the grid keeps the variance sums well conditioned
+    centred = grid - np.mean(grid)
+    counts = np.asarray(counts, dtype=float)
+    n = counts.sum(axis=1)
+    mean = counts.dot(centred) / n
+    variance = np.maximum(counts.dot(centred ** 2) - n * mean ** 2, 0) / (n - 1)
+    spread = np.sqrt(variance)
+    if rule == 'robust':
+        # quartiles to the nearest grid point, from the cumulative counts
+        cumulative = np.cumsum(counts, axis=1)
+        q1 = grid[np.argmax(cumulative >= 0.25 * n[:, None], axis=1)]
+        q3 = grid[np.argmax(cumulative >= 0.75 * n[:, None], axis=1)]
+        spread = robust_spread(spread, q1, q3)
+    bandwidths = spread * bandwidth_factor(n, rule)
+    kernels = gaussian_kernels_fft(bandwidths, delta, len(grid), n_fft)
+    return convolve_counts(counts, kernels, n, n_fft)
+
+
+# Parameters: densities (regions x grid_size matrix, one density per row); lo, delta (arrays with
+# the first grid point and the grid spacing of every row); values (array whose last axis has one
+# value per row, i.e. subjects x regions, NaN for missing)
+# Returns array shaped like values with every value's density linearly interpolated on its row's
+# grid (values past the ends of a grid get the density at that end, missing values get 0)
+def interpolate_grid(densities, lo, delta, values):
+    values = np.asarray(values, dtype=float)
+    missing = ~np.isfinite(values)
+    grid_size = densities.shape[1]
+    position = np.clip((np.where(missing, lo, values) - lo) / delta, 0, grid_size - 1)
+    left = np.minimum(position.astype(np.intp), grid_size - 2)
+    weight = position - left
+    rows = np.arange(densities.shape[0])
+    pdf = densities[rows, left] * (1 - weight) + densities[rows, left + 1] * weight
+    pdf[missing] = 0
+    return pdf
+
+
+# Parameters: f, m (arrays of samples, missing values already left out)
+# Returns area between the gaussian kernel density estimates of f and m, evaluated at every pooled
+# sample and integrated with the trapezoid rule (O(n^2), the reference implementation)
+def exact_divergence(f, m, rule='scott'):
+    all = np.sort(np.hstack((f, m)))
+    f_kernel = stats.gaussian_kde(f, bw_method=kde_factor(f, rule))
+    m_kernel = stats.gaussian_kde(m, bw_method=kde_factor(m, rule))
+    # subract one kernel from the other and integrate
+    kernel_abs_diff = abs(f_kernel.evaluate(all) - m_kernel.evaluate(all))
+    return trapezoid(kernel_abs_diff, all)
+
+
+# Parameters: x (array of samples); points (array of values)
+# Returns density of the normal distribution with the mean and standard deviation of x at every
+# point (0 everywhere if x has fewer than two samples or no spread)
+def normal_density(x, points):
+    points = np.asarray(points, dtype=float)
+    if len(x) < 2 or np.std(x) == 0:
+        return np.zeros(points.shape)
+    return stats.norm.pdf(points, np.mean(x), np.std(x, ddof=1))
+
+
+# Parameters: f, m (arrays of samples, missing values already left out); grid_size (number of grid
+# points)
+# Returns (grid, f density, m density): normal_density of f and m on one grid over the range of the
+# pooled samples (the grid has a single point if all samples are equal)
+def normal_grid_densities(f, m, grid_size=GRID_SIZE):
+    lo, hi = sample_range(f, m)
+    if hi == lo:
+        return np.array([lo]), np.zeros(1), np.zeros(1)
+    grid = np.linspace(lo, hi, grid_size)
+    return grid, normal_density(f, grid), normal_density(m, grid)
+
+
+# Parameters: f, m (arrays of samples, missing values left out or NaN)
+# Returns (lo, hi): smallest and largest present value of the pooled samples, (0, 0) if there is
+# none
+def sample_range(f, m):
+    present = [x[np.isfinite(x)] for x in (np.asarray(f, dtype=float), np.asarray(m, dtype=float))]
+    present = [x for x in present if len(x)]
+    if not present:
+        return 0.0, 0.0
+    return min(np.min(x) for x in present), max(np.max(x) for x in present)
+
+
+# Parameter: x (array of samples, missing values already left out)
+# Returns True if a kernel can be fitted to x (at least two samples, with some spread)
+def fittable(x):
+    return len(x) >= 2 and np.std(x) > 0
+
+
+# Parameters: samples (list of arrays of samples, missing values already left out); rule
+# (bandwidth rule)
+# Returns (lo, hi): ends of a grid covering every sample and KERNEL_TAIL bandwidths past them, so
+# densities fitted on it are about 0 at both ends (-0.5 to 0.5 if there are no samples)
+def tail_range(samples, rule='scott'):
+    present = [x for x in samples if fittable(x)]
+    tail = KERNEL_TAIL * max([kde_bandwidth(x, rule) for x in present] + [0.0])
+    ends = [(np.min(x), np.max(x)) for x in samples if len(x)]
+    if not ends:
+        return -0.5, 0.5
+    lo = min(end[0] for end in ends) - tail
+    hi = max(end[1] for end in ends) + tail
+    if hi == lo:
+        lo, hi = lo - 0.5, hi + 0.5
+    return lo, hi
+
+
+# Parameters: f, m (arrays of samples, missing values already left out); grid_size (number of grid
+# points); rule (bandwidth rule)
+# Returns (lo, hi, f density, m density): grid_kde of f and m on one grid from tail_range of both
+# samples, all zeros for a sample a kernel cannot be fitted to (see fittable). This is the costly
+# part of fitting a pair of GridDensity, and what fit_pair and the reference model share
+def pair_grids(f, m, grid_size=GRID_SIZE, rule='scott'):
+    lo, hi = tail_range([f, m], rule)
+    densities = [grid_kde(x, lo, hi, grid_size, rule)[1] if fittable(x) else np.zeros(grid_size) for x in (f, m)]
+    return lo, hi, densities[0], densities[1]
+
+
+# Parameters: f, m (arrays of samples, missing values already left out); grid_size (number of grid
+# points); rule (bandwidth rule)
+# Returns area between the binned kernel density estimates of f and m (pair_grids) over the range
+# of the pooled samples, the range exact_divergence integrates over (see range_divergence).
+# Tolerance: with the default grid_size the binned densities are within ~1e-4 of gaussian_kde
+# (relative to the peak), and the divergence is within ~1e-4 (absolute; the divergence is between
+# 0 and 2) of the area between the two gaussian_kde integrated finely over the same range.
+# exact_divergence is the coarser of the two: its trapezoid rule over the unevenly spaced samples
+# misses that area by up to ~1e-2 with 400 samples per group, and ~5e-3 with a thousand or more,
+# mostly in the sparse tails (more for heavily skewed groups)
+def grid_divergence(f, m, grid_size=GRID_SIZE, rule='scott'):
+    return range_divergence(*(pair_grids(f, m, grid_size, rule) + sample_range(f, m)))
+
+
+# Parameters: lo, hi, f_density, m_density (densities on a grid of evenly spaced points from lo to
+# hi, as returned by pair_grids); start, stop (range to integrate over, within [lo, hi])
+# Returns area between the two densities from start to stop, both linearly interpolated between
+# the grid points (0 if the range is empty)
+def range_divergence(lo, hi, f_density, m_density, start, stop):
+    if stop <= start:
+        return 0.0
+    grid = np.linspace(lo, hi, len(f_density))
+    inside = (grid > start) & (grid < stop)
+    points = np.concatenate(([start], grid[inside], [stop]))
+    return trapezoid(abs(np.interp(points, grid, f_density) - np.interp(points, grid, m_density)), points)
+
+
+# Parameters: grid, f_density, m_density (as returned by normal_grid_densities)
+# Returns area between the two densities
+def densities_divergence(grid, f_density, m_density):
+    if len(grid) < 2:
+        return 0.0
+    return trapezoid(abs(f_density - m_density), grid)
+
+
+# Parameters: f, m (arrays of samples, missing values already left out); method (one of METHODS);
+# grid_size, rule (see grid_divergence)
+# Returns area between the density estimates of f and m, computed with the selected method
+def divergence(f, m, method='fft', grid_size=GRID_SIZE, rule='scott'):
+    check_method(method)
+    if method == 'exact':
+        return exact_divergence(f, m, rule)
+    if method == 'fft':
+        return grid_divergence(f, m, grid_size, rule)
+    return densities_divergence(*normal_grid_densities(f, m, grid_size))
+
+
+# Parameter: method (name of a density estimator)
+# Raises ValueError if method is not one of METHODS
+def check_method(method):
+    if method not in METHODS:
+        raise ValueError("unknown density method '%s' (expected one of %s)" % (method, ', '.join(METHODS)))
+
+
+# Kernel density estimate of a sample, evaluated exactly at every point with gaussian_kde
+# (O(n) per point)
+class KernelDensity:
+
+    # x: array of samples, missing values already left out; rule: bandwidth rule
+    # factor: bandwidth factor of the kernel, in place of the rule's (i.e. one already fitted to x)
+    def __init__(self, x, rule='scott', factor=None):
+        self.kernel = stats.gaussian_kde(x, bw_method=kde_factor(x, rule) if factor is None else factor)
+
+    # Returns the bandwidth factor of the kernel (its standard deviation over that of the samples)
+    def getFactor(self):
+        return float(self.kernel.factor)
+
+    # Parameter: points (array of values, all present)
+    # Returns array of the density at every point
+    def evaluate(self, points):
+        return self.kernel.evaluate(points)
+
+    # Returns array of the density at each of the fitted samples with that sample's own kernel
+    # removed (see leave_one_out)
+    def leaveOneOut(self):
+        x = self.kernel.dataset[0]
+        return leave_one_out(self.evaluate(x), len(x), np.sqrt(self.kernel.covariance[0, 0]))
+
+
+# Kernel density estimate of a sample binned on a grid and convolved by fft (see grid_kde), then
+# evaluated by linear interpolation on the grid: O(n + grid_size log grid_size) to fit and O(1)
+# per point, within ~1e-4 of gaussian_kde relative to the peak (see grid_divergence)
+class GridDensity:
+
+    # x: array of samples, missing values already left out; rule: bandwidth rule
+    # lo, hi: ends of the grid (default to tail_range of x); points past them have density 0
+    # grid_size: number of grid points
+    # density: grid_kde of x on that grid, if it is already fitted (i.e. by pair_grids)
+    def __init__(self, x, rule='scott', lo=None, hi=None, grid_size=GRID_SIZE, density=None):
+        if lo is None or hi is None:
+            lo, hi = tail_range([x], rule)
+        grid = np.linspace(lo, hi, grid_size)
+        if density is None:
+            grid, density = grid_kde(x, lo, hi, grid_size, rule)
+        self.density = density
+        self.x = x
+        self.bandwidth = kde_bandwidth(x, rule)
+        self.lo = lo
+        self.hi = hi
+        self.delta = grid[1] - grid[0]
+
+    # Parameter: points (array of values, all present)
+    # Returns array of the density at every point
+    def evaluate(self, points):
+        points = np.asarray(points, dtype=float)
+        pdf = interpolate_grid(self.density[None], np.array([self.lo]), np.array([self.delta]), points[:, None])[:, 0]
+        pdf[(points < self.lo) | (points > self.hi)] = 0
+        return pdf
+
+    # Returns array of the density at each of the fitted samples with that sample's own kernel
+    # removed (see leave_one_out)
+    def leaveOneOut(self):
+        return leave_one_out(self.evaluate(self.x), len(self.x), self.bandwidth)
+
+
+# Normal density with the sample's mean and standard deviation, for a parametric fit, or for
+# samples too small or too concentrated for a kernel density (O(1) per point)
+class NormalDensity:
+
+    # x: array of samples, missing values already left out
+    def __init__(self, x):
+        self.x = x
+
+    # Parameter: points (array of values, all present)
+    # Returns array of the density at every point
+    def evaluate(self, points):
+        return normal_density(self.x, points)
+
+    # Returns array of the density at each of the fitted samples under the normal density of the
+    # other samples, whose mean and standard deviation are updated from the sums of all samples
+    def leaveOneOut(self):
+        x = self.x
+        n = len(x)
+        if n < 3 or np.std(x) == 0:
+            return np.zeros(n)
+        centre = np.mean(x)
+        centred = x - centre
+        mean = (np.sum(centred) - centred) / (n - 1)
+        variance = (np.sum(centred ** 2) - centred ** 2 - (n - 1) * mean ** 2) / (n - 2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pdf = stats.norm.pdf(centred, mean, np.sqrt(variance))
+        return np.nan_to_num(pdf)
+
+
+# Parameters: pdf (array of a kernel density estimate at each of its n samples); n (number of
+# samples); bandwidth (standard deviation of the kernel)
+# Returns array of the density at each sample with that sample's own kernel taken out of the sum:
+# (n * pdf - K(0)) / (n - 1), without refitting. The bandwidth stays the one fitted on all n
+# samples, which changes it by a factor of about 1 + 1/(5n)
+def leave_one_out(pdf, n, bandwidth):
+    if n < 2 or bandwidth <= 0:
+        return np.zeros(len(pdf))
+    own = 1.0 / (bandwidth * np.sqrt(2 * np.pi))
+    return np.maximum((n * np.asarray(pdf, dtype=float) - own) / (n - 1), 0)
+
+
+# Parameters: x (array of samples, NaN or float("inf") for missing); method (one of METHODS);
+# rule (bandwidth rule); lo, hi, grid_size (grid of the 'fft' method, see GridDensity); density
+# (the 'fft' density of x on that grid, if already fitted)
+# Returns fitted density of the present samples of x, with evaluate(points) and leaveOneOut()
+# (the density at each present sample, in order, fitted without it). Samples with fewer
+# than two present values or no spread, which a kernel cannot be fitted to, get a NormalDensity
+# (0 everywhere)
+def fit_density(x, method='exact', rule='scott', lo=None, hi=None, grid_size=GRID_SIZE, density=None):
+    check_method(method)
+    x = np.asarray(x, dtype=float)
+    x = x[np.isfinite(x)]
+    if method == 'gaussian' or not fittable(x):
+        return NormalDensity(x)
+    if method == 'fft':
+        return GridDensity(x, rule, lo, hi, grid_size, density)
+    return KernelDensity(x, rule)
+
+
+# Parameters: f, m (female and male samples, missing values left out); method, rule, grid_size
+# (see fit_density); grids (pair_grids of f and m, if already fitted)
+# Returns (female density, male density), the 'fft' ones on one grid over both samples and
+# KERNEL_TAIL bandwidths past them (see pair_grids)
+def fit_pair(f, m, method='exact', rule='scott', grid_size=GRID_SIZE, grids=None):
+    if method != 'fft':
+        return fit_density(f, method, rule), fit_density(m, method, rule)
+    if grids is None:
+        grids = pair_grids(f, m, grid_size, rule)
+    lo, hi, f_density, m_density = grids
+    return (fit_density(f, method, rule, lo, hi, grid_size, f_density),
+            fit_density(m, method, rule, lo, hi, grid_size, m_density))
@@ -0,0 +1,151 @@
+import csv
+import gzip
+import json
+import os
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # Parquet output is only available with pyarrow installed
+    pyarrow = None
+
+# subjects scored and written at a time by write_scores
+BLOCK_SIZE = 10000
+
+
+# Parameters: ids (array of subject ids, strings); groups (array of group labels)
+# Returns array of row indices that sorts the subjects by group, then by id: numerically when every
+# id is an integer (compared exactly, so long ids like 603061555716 keep their order), otherwise
+# as strings. Sorting an index leaves the scores where they are
+def export_order(ids, groups):
+    ids = np.asarray(ids).astype(str)
+    groups = np.asarray(groups).astype(str)
+    if len(ids) and np.all(np.char.isdigit(np.char.lstrip(ids, '-'))) and np.all(np.char.str_len(ids) < 19):
+        key = ids.astype(np.int64)
+    else:
+        key = ids
+    return np.lexsort((key, groups))
+
+
+# Writes rows of (subject id, group, one float per column) as csv, gzip-compressed when the path
+# ends in .gz. Missing values are written as 'NA', floats with their shortest exact repr
+class CsvWriter:
+
+    # path: path of the file; header: column names (id, group, then one per score column)
+    def __init__(self, path, header):
+        if path.endswith('.gz'):
+            self.file = gzip.open(path, 'wt', newline='', compresslevel=6)
+        else:
+            self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(header)
+
+    # Parameters: ids, groups (arrays of strings, one per row); values (rows x columns float matrix,
+    # NaN for missing)
+    # Appends the rows to the file
+    def writeBlock(self, ids, groups, values):
+        values = np.asarray(values, dtype=float)
+        missing = np.isnan(values)
+        cells = values.astype(object)
+        cells[missing] = 'NA'
+        self.writer.writerows([[subject, group] + row for subject, group, row in
+                               zip(np.asarray(ids).tolist(), np.asarray(groups).tolist(), cells.tolist())])
+
+    def close(self):
+        self.file.close()
+
+
+# Writes the scores as a rows x columns float64 .npy matrix (NaN for missing), with the ids and groups
+# of the rows in a <name>_ids.csv sidecar and the column names in <name>_columns.json. The matrix
+# is a memory-mapped file filled block by block, so it can be memory-mapped back with
+# np.load(path, mmap_mode='r') without parsing
+class NpyWriter:
+
+    # path: path of the .npy file; header: column names (id, group, then one per score column);
+    # n_rows: number of rows that will be written
+    def __init__(self, path, header, n_rows):
+        stem = path[:-len('.npy')]
+        self.matrix = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=(n_rows, len(header) - 2))
+        with open(stem + '_columns.json', 'w') as f:
+            json.dump(header[2:], f)
+        self.ids = CsvWriter(stem + '_ids.csv', header[:2])
+        self.start = 0
+
+    # Parameters: see CsvWriter.writeBlock
+    def writeBlock(self, ids, groups, values):
+        self.matrix[self.start:self.start + len(ids)] = values
+        self.ids.writer.writerows(zip(np.asarray(ids).tolist(), np.asarray(groups).tolist()))
+        self.start += len(ids)
+
+    def close(self):
+        self.matrix.flush()
+        del self.matrix
+        self.ids.close()
+
+
+# Writes the scores as a Parquet file (one row group per block), with typed string id and group
+# columns and a float64 column per score, null where the value is missing. Needs pyarrow
+class ParquetWriter:
+
+    # path: path of the .parquet file; header: column names (id, group, then one per score column)
+    def __init__(self, path, header):
+        if pyarrow is None:
+            raise ValueError("writing %s needs pyarrow (pip install pyarrow), or use a .csv, .csv.gz or "
+                             ".npy output" % path)
+        self.header = header
+        fields = [pyarrow.field(name, pyarrow.string()) for name in header[:2]]
+        fields += [pyarrow.field(name, pyarrow.float64()) for name in header[2:]]
+        self.schema = pyarrow.schema(fields)
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    # Parameters: see CsvWriter.writeBlock
+    def writeBlock(self, ids, groups, values):
+        values = np.asarray(values, dtype=float)
+        columns = [pyarrow.array(np.asarray(ids).astype(str)), pyarrow.array(np.asarray(groups).astype(str))]
+        for j in range(values.shape[1]):
+            columns.append(pyarrow.array(values[:, j], mask=np.isnan(values[:, j])))
+        self.writer.write_table(pyarrow.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+# Parameters: path (output file: .csv, .csv.gz, .npy or .parquet); header (column names: id,
+# group, then one per score column); n_rows (number of rows, needed by the .npy format)
+# Returns writer for the format of path, with writeBlock(ids, groups, values) and close()
+def open_writer(path, header, n_rows):
+    parent = os.path.dirname(path)
+    if parent and not os.path.exists(parent):
+        os.makedirs(parent)
+    if path.endswith('.npy'):
+        return NpyWriter(path, header, n_rows)
+    if path.endswith('.parquet'):
+        return ParquetWriter(path, header)
+    if path.endswith('.csv') or path.endswith('.csv.gz'):
+        return CsvWriter(path, header)
+    raise ValueError("unknown output format '%s' (expected .csv, .csv.gz, .npy or .parquet)" % path)
+
+
+# Parameters: path (output file, see open_writer); header (column names: id, group, then one per
+# score column); ids, groups (arrays with the id and group of every subject); values
+# (subjects x columns matrix the scores are computed from, i.e. Cohort.columns); score (function
+# from a block of rows of values to the block's scores, i.e. CohortScorer.logLikelihoodRatios, or
+# None if values already are the scores); order (row indices in output order, defaults to
+# export_order); block_size (rows scored at a time)
+# Scores the subjects a block at a time in output order and streams every block to the file, so
+# the formatted rows (and, with a score function, the scores) of all subjects are never held in
+# memory at once
+# Returns number of rows written
+def write_scores(path, header, ids, groups, values, score=None, order=None, block_size=BLOCK_SIZE):
+    if order is None:
+        order = export_order(ids, groups)
+    writer = open_writer(path, header, len(order))
+    try:
+        for start in range(0, len(order), block_size):
+            rows = order[start:start + block_size]
+            writer.writeBlock(ids[rows], groups[rows], values[rows] if score is None else score(values[rows]))
+    finally:
+        writer.close()
+    return len(order)
@@ -0,0 +1,137 @@
+import collections
+import hashlib
+import os
+import tempfile
+import numpy as np
+
+# default memory cap of the in-process layer
+MAX_BYTES = 256 << 20
+# bump when a memoized function changes what it returns, so results cached on disk by older code
+# are not reused
+KEY_VERSION = 1
+
+
+# Memoizes per-region density fits (and the other per-region functions run through
+# RegionPool.map(..., memoize=True)), keyed on a hash of the function, the region's sample vectors
+# and the remaining arguments (bandwidth rule, grid size, seeds, ...). Results are kept in an
+# in-process LRU layer capped at max_bytes, and optionally saved as .npz files under cache_dir.
+# Every stage fits its binned densities through scoring.fit_grids, so Brain, the reference model,
+# the plots and the scorer share one fit per (group, region) sample, and reruns on unchanged data
+# skip the fitting altogether.
+# Cached arrays are read-only, since every caller shares them.
+class FitCache:
+
+    # max_bytes: memory cap of the in-process layer (0 disables it)
+    # cache_dir: directory of the on-disk layer (None disables it)
+    def __init__(self, max_bytes=MAX_BYTES, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        # self.entries = map from key to (result, size in bytes), least recently used first
+        self.entries = collections.OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    # Returns True if results are cached in memory or on disk
+    def isEnabled(self):
+        return self.max_bytes > 0 or self.cache_dir is not None
+
+    # Parameters: function (the memoized function); rows (the region's values from every table);
+    # args (the other arguments of the call)
+    # Returns hex key of the call
+    def key(self, function, rows, args):
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(('%d %s.%s' % (KEY_VERSION, function.__module__, function.__name__)).encode('utf-8'))
+        for row in rows:
+            row = np.ascontiguousarray(row, dtype=np.float64)
+            digest.update(str(row.shape).encode('utf-8'))
+            digest.update(row.tobytes())
+        digest.update(repr(tuple(args)).encode('utf-8'))
+        return digest.hexdigest()
+
+    # Parameter: key (from key())
+    # Returns the cached result, or None if it is in neither layer
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+        if self.cache_dir is not None:
+            path = self.path(key)
+            if os.path.exists(path):
+                with np.load(path) as saved:
+                    items = [saved['arr_%d' % i] for i in range(len(saved.files) - 1)]
+                    result = tuple(read_only(item) if item.ndim else item.item() for item in items)
+                    if not saved['is_tuple']:
+                        result = result[0]
+                self.remember(key, result)
+                self.hits += 1
+                return result
+        self.misses += 1
+        return None
+
+    # Parameters: key (from key()); result (a number, an array, or a tuple of numbers and arrays)
+    # Caches result in both layers
+    # Returns result, with its arrays made read-only
+    def put(self, key, result):
+        is_tuple = isinstance(result, tuple)
+        originals = result if is_tuple else (result,)
+        items = [read_only(np.array(item)) for item in originals]
+        # numbers are kept as they are, arrays as the read-only copies
+        result = tuple(item if np.ndim(original) else original for original, item in zip(originals, items))
+        if not is_tuple:
+            result = result[0]
+        self.remember(key, result)
+        if self.cache_dir is not None:
+            path = self.path(key)
+            parent = os.path.dirname(path)
+            if not os.path.exists(parent):
+                os.makedirs(parent)
+            # written under a temporary name and renamed, so a reader never sees half a file
+            f, tmp_path = tempfile.mkstemp(dir=parent, suffix='.npz')
+            with os.fdopen(f, 'wb') as tmp:
+                np.savez(tmp, *items, is_tuple=is_tuple)
+            os.replace(tmp_path, path)
+        return result
+
+    # Parameters: key; result
+    # Adds result to the in-process layer, evicting the least recently used results over max_bytes
+    def remember(self, key, result):
+        size = sum(np.asarray(item).nbytes for item in (result if isinstance(result, tuple) else (result,)))
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.n_bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (result, size)
+        self.n_bytes += size
+        while self.n_bytes > self.max_bytes:
+            self.n_bytes -= self.entries.popitem(last=False)[1][1]
+
+    # Parameter: key
+    # Returns path of the key's file in the on-disk layer
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npz')
+
+    # Empties the in-process layer (the on-disk layer is kept)
+    def clear(self):
+        self.entries.clear()
+        self.n_bytes = 0
+
+
+# Parameter: array (numpy array)
+# Returns array, flagged read-only
+def read_only(array):
+    array.flags.writeable = False
+    return array
+
+
+# cache shared by every RegionPool.map(..., memoize=True) call of this process
+FIT_CACHE = FitCache()
+
+
+# Parameters: max_bytes, cache_dir (see FitCache)
+# Replaces the shared cache with one of the given size and directory
+def configure(max_bytes=MAX_BYTES, cache_dir=None):
+    global FIT_CACHE
+    FIT_CACHE = FitCache(max_bytes, cache_dir)
+    return FIT_CACHE
@@ -0,0 +1,159 @@
+import cProfile
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+# logger every stage record is sent to (as one JSON object per message, at INFO level)
+logger = logging.getLogger('dimorphism.stages')
+
+# default directory of the cProfile dumps of profiled stages
+PROFILE_DIR = 'results/profiles'
+
+
+# Returns peak resident set size (bytes) of this process so far and of its largest finished child
+# process (the peaks of the whole run, not of a stage)
+def peak_rss():
+    # ru_maxrss is in kilobytes on linux and in bytes on macos
+    scale = 1 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return own, children
+
+
+# Resets the peak resident set size the kernel reports for this process (VmHWM) to its current
+# resident set size, so stage_peak_rss() measures from here (linux only)
+# Returns True if the peak was reset
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+# Returns peak resident set size (bytes) of this process since the last reset_peak_rss (linux only)
+def stage_peak_rss():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    raise OSError('VmHWM is not in /proc/self/status')
+
+
+# Returns cpu time (seconds) used by this process and its finished child processes
+def cpu_time():
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+# Parameters: record (stage record yielded by Trace.stage); name (name of the part of the stage);
+# function (function the stage calls, possibly many times)
+# Returns function wrapped to add the wall and cpu time of every call to record['parts'][name]
+# (with the number of calls), so a stage can report how much of its time went into a callback,
+# i.e. scoring the blocks of subjects it streams to a file
+def timed(record, name, function):
+    def timed_function(*args):
+        wall = time.perf_counter()
+        cpu = cpu_time()
+        try:
+            return function(*args)
+        finally:
+            part = record.setdefault('parts', {}).setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+            part['wall'] += time.perf_counter() - wall
+            part['cpu'] += cpu_time() - cpu
+            part['calls'] += 1
+    return timed_function
+
+
+# Records wall time, cpu time, peak memory and item counts of every stage of a run. A stage is
+# timed with
+#     with trace.stage('divergence') as record:
+#         ...
+#         record['items'] = number of regions
+# and its record is appended to trace.records and logged to the 'dimorphism.stages' logger (a
+# stage that raises is recorded too, with the exception in 'error').
+# 'peak_rss' is the stage's own peak resident set size where the kernel can reset the peak at the
+# start of a stage (linux). Elsewhere only the peak of the whole process is known, so 'peak_rss' is
+# that peak so far and 'peak_rss_growth' how much the stage raised it (0 for a stage that stayed
+# under an earlier stage's peak). 'peak_rss_children' is the largest peak of any worker process
+# that has finished so far in the run, on every platform.
+# Stages listed in the profiled stages also run under cProfile, dumped to <profile_dir>/<stage>.prof
+# (view with python -m pstats or snakeviz). Tracing costs a few system calls per stage.
+class Trace:
+
+    # profiled_stages: names of the stages to profile ('all' profiles every stage)
+    # profile_dir: directory of the cProfile dumps
+    def __init__(self, profiled_stages=(), profile_dir=PROFILE_DIR):
+        self.records = []
+        self.start = time.time()
+        self.setProfiledStages(profiled_stages, profile_dir)
+
+    # Parameters: profiled_stages, profile_dir (see __init__)
+    # Sets the stages run under cProfile from now on
+    def setProfiledStages(self, profiled_stages, profile_dir=PROFILE_DIR):
+        self.profiled_stages = set(profiled_stages)
+        self.profile_dir = profile_dir
+
+    # Parameter: name (name of the stage)
+    # Returns True if the stage runs under cProfile
+    def isProfiled(self, name):
+        return name in self.profiled_stages or 'all' in self.profiled_stages
+
+    # Parameters: name (name of the stage); items (number of items the stage handles, if known
+    # beforehand; can also be set on the yielded record)
+    # Context manager timing the body of the with statement as one stage
+    # Yields the stage's record (map), which the body may add fields to
+    @contextmanager
+    def stage(self, name, items=None):
+        record = {'stage': name, 'items': items}
+        profiler = cProfile.Profile() if self.isProfiled(name) else None
+        stage_peak = reset_peak_rss()
+        start_peak = None if stage_peak else peak_rss()[0]
+        wall = time.perf_counter()
+        cpu = cpu_time()
+        record['start'] = time.time() - self.start
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        except BaseException as error:
+            record['error'] = repr(error)
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            record['wall'] = time.perf_counter() - wall
+            record['cpu'] = cpu_time() - cpu
+            record['peak_rss'], record['peak_rss_children'] = peak_rss()
+            if stage_peak:
+                record['peak_rss'] = stage_peak_rss()
+            else:
+                record['peak_rss_growth'] = record['peak_rss'] - start_peak
+            if profiler is not None:
+                if not os.path.exists(self.profile_dir):
+                    os.makedirs(self.profile_dir)
+                record['profile'] = os.path.join(self.profile_dir, name + '.prof')
+                profiler.dump_stats(record['profile'])
+            self.records.append(record)
+            logger.info(json.dumps(record))
+
+    # Returns map from stage name to its total wall time (seconds), in the order the stages first ran
+    def summary(self):
+        totals = {}
+        for record in self.records:
+            totals[record['stage']] = totals.get(record['stage'], 0.0) + record['wall']
+        return totals
+
+    # Parameter: path (path of the JSON trace file)
+    # Writes every stage record, with the process id and the command line of the run
+    def save(self, path):
+        parent = os.path.dirname(path)
+        if parent and not os.path.exists(parent):
+            os.makedirs(parent)
+        with open(path, 'w') as f:
+            json.dump({'pid': os.getpid(), 'argv': sys.argv, 'stages': self.records}, f, indent=1)
@@ -0,0 +1,206 @@
+import csv
+import numpy as np
+import density
+from brain import ZONE_LABELS, ZONE_MISSING, classify_zones, end_range_arrays
+from cohort import parse_float
+from scoring import fit_grids, log_ratios
+
+# version of the file layout written by ReferenceModel.save
+MODEL_VERSION = 1
+# format of the scores written by score_stream: 10 significant digits, well past the accuracy of
+# the grid densities, and several times faster to format than the shortest repr of a float
+FLOAT_FORMAT = '%.10g'
+
+
+# Fitted reference cohort, reduced to what scoring a new subject needs: the female and male density
+# of every region sampled on a grid, the divergence ranking, and the end ranges of the top regions.
+# Saved as one compressed .npz file, so new subjects are scored without reloading or refitting the
+# reference cohort. Scoring a value is a linear interpolation on its region's grid, so one subject
+# is scored against every region in a few vectorized operations.
+# The grids reach KERNEL_TAIL bandwidths past the reference samples; values further out score as
+# if they were at the end of the grid. Within the grid, densities agree with gaussian_kde to
+# within ~1e-4 of the peak (see density.grid_divergence): log likelihood ratios agree with
+# CohortScorer to ~1e-3, except far in a tail where one group's density is near zero and the
+# truncated kernels (density.KERNEL_TAIL) shift large ratios by a few percent
+class ReferenceModel:
+
+    # subject_id: name of the subject id column in the data files
+    # regions: list of brain regions (column order of every matrix this model produces)
+    # lo, delta: arrays with the first grid point and the grid spacing of every region
+    # f_density, m_density: regions x grid_size matrices with the female and male densities
+    # divergence: array with the divergence of every region (see Brain.getDivergence)
+    # top_regions: list of the top regions, in decreasing order of divergence
+    # end_ranges: (male-end directions, male-end scores, female-end directions, female-end scores)
+    # arrays of the top regions, see brain.end_range_arrays
+    def __init__(self, subject_id, regions, lo, delta, f_density, m_density, divergence, top_regions, end_ranges):
+        self.subject_id = subject_id
+        self.regions = [str(region) for region in regions]
+        self.lo = np.asarray(lo, dtype=float)
+        self.delta = np.asarray(delta, dtype=float)
+        self.f_density = np.asarray(f_density, dtype=float)
+        self.m_density = np.asarray(m_density, dtype=float)
+        self.divergence = np.asarray(divergence, dtype=float)
+        self.top_regions = [str(region) for region in top_regions]
+        self.end_ranges = tuple(np.asarray(array) for array in end_ranges)
+        self.region_index = dict((region, j) for j, region in enumerate(self.regions))
+        # column of every top region in self.regions
+        self.top_columns = np.array([self.region_index[region] for region in self.top_regions], dtype=np.intp)
+
+    # Returns list of regions
+    def getRegions(self):
+        return self.regions
+
+    # Returns list of top regions
+    def getTopRegions(self):
+        return self.top_regions
+
+    # Parameter: region (string)
+    # Returns the divergence value of the region
+    def getDivergence(self, region):
+        return float(self.divergence[self.region_index[region]])
+
+    # Parameter: values (subjects x regions matrix, or one subject's row, in getRegions() order,
+    # NaN or float("inf") for missing)
+    # Returns (female pdf, male pdf, missing mask) with the same shape as values, 0 where missing
+    def densities(self, values):
+        values = np.asarray(values, dtype=float)
+        f_pdf = density.interpolate_grid(self.f_density, self.lo, self.delta, values)
+        m_pdf = density.interpolate_grid(self.m_density, self.lo, self.delta, values)
+        return f_pdf, m_pdf, ~np.isfinite(values)
+
+    # Parameter: values (see densities)
+    # Returns log likelihood ratios log(male pdf / female pdf), NaN where the value is missing
+    # (as CohortScorer.logLikelihoodRatios)
+    def logLikelihoodRatios(self, values):
+        return log_ratios(*self.densities(values))
+
+    # Parameter: values (see densities)
+    # Returns posterior probabilities of being male (prior of 0.5), NaN where the value is missing
+    # (as CohortScorer.posteriorProbs)
+    def posteriorProbs(self, values):
+        return posteriors(*self.densities(values))
+
+    # Parameter: values (see densities)
+    # Returns (log likelihood ratios, posterior probabilities) from one evaluation of the densities
+    def scores(self, values):
+        f_pdf, m_pdf, missing = self.densities(values)
+        return log_ratios(f_pdf, m_pdf, missing), posteriors(f_pdf, m_pdf, missing)
+
+    # Parameter: values (see densities)
+    # Returns int8 zone codes of the top region columns of values (see Brain.classifyZones)
+    def classifyZones(self, values):
+        values = np.asarray(values, dtype=float)
+        return classify_zones(values[..., self.top_columns], *self.end_ranges)
+
+    # Parameter: path (path of the .npz file to write)
+    # Saves the model (compressed, no pickled objects)
+    def save(self, path):
+        np.savez_compressed(path, version=MODEL_VERSION, subject_id=self.subject_id, regions=self.regions,
+                            lo=self.lo, delta=self.delta, f_density=self.f_density, m_density=self.m_density,
+                            divergence=self.divergence, top_regions=np.array(self.top_regions, dtype=str),
+                            m_direction=self.end_ranges[0], m_score=self.end_ranges[1],
+                            f_direction=self.end_ranges[2], f_score=self.end_ranges[3])
+
+
+# Parameters: f_pdf, m_pdf, missing (see ReferenceModel.densities)
+# Returns posterior probabilities of being male (prior of 0.5), NaN where the value is missing
+def posteriors(f_pdf, m_pdf, missing):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        prob = m_pdf / (f_pdf + m_pdf)
+    prob[missing] = np.nan
+    return prob
+
+
+# Parameter: path (path of a file written by ReferenceModel.save)
+# Returns the ReferenceModel saved in path
+def load_model(path):
+    with np.load(path) as arrays:
+        if int(arrays['version']) != MODEL_VERSION:
+            raise ValueError("%s is a version %d model (expected %d)" % (path, int(arrays['version']), MODEL_VERSION))
+        end_ranges = (arrays['m_direction'], arrays['m_score'], arrays['f_direction'], arrays['f_score'])
+        return ReferenceModel(str(arrays['subject_id']), list(arrays['regions']), arrays['lo'], arrays['delta'],
+                              arrays['f_density'], arrays['m_density'], arrays['divergence'],
+                              list(arrays['top_regions']), end_ranges)
+
+
+# Parameters: brain (fitted Brain, whose data, worker pool, divergences and end ranges are used);
+# subject_id (name of the subject id column); regions (list of brain regions, defaults to every
+# region, sorted)
+# Returns ReferenceModel of the brain's cohort
+def build_model(brain, subject_id, regions=None):
+    if regions is None:
+        regions = sorted(brain.female_data.keys())
+    # the densities Brain's 'fft' divergences and plots are computed from (see scoring.fit_grids)
+    grids = fit_grids(brain.pool, brain.female_data, brain.male_data, regions, brain.grid_size, brain.bandwidth)
+    lo = np.array([grid[0] for grid in grids])
+    delta = np.array([(grid[1] - grid[0]) / (brain.grid_size - 1) for grid in grids])
+    f_density = np.vstack([grid[2] for grid in grids])
+    m_density = np.vstack([grid[3] for grid in grids])
+    divergence = np.array([brain.getDivergence(region) for region in regions])
+    top_regions = [region for region in brain.getTopRegions() if region in regions]
+    end_ranges = end_range_arrays(brain.getEndRanges(), top_regions)
+    return ReferenceModel(subject_id, regions, lo, delta, f_density, m_density, divergence, top_regions, end_ranges)
+
+
+# Parameters: model (ReferenceModel); lines (iterable of csv lines, i.e. an open file or
+# sys.stdin, starting with the header); output (file the scores are written to)
+# Scores the subjects of lines one row at a time as they arrive: writes a header, then for every
+# subject its id, the log likelihood ratio and the posterior probability of every region, and the
+# zone ('M', 'F', 'I') of every top region ('NA' where the value is missing or not a number).
+# Each row's densities are evaluated once for both scores, and the row is formatted as one string
+# (see format_values) instead of cell by cell.
+# output is flushed after every row, so a reader of a pipe sees each score as soon as it is computed
+# Returns number of subjects scored
+def score_stream(model, lines, output):
+    reader = csv.reader(lines)
+    header = next(reader)
+    id_column = header.index(model.subject_id)
+    # precomputed column of every region in the input rows
+    columns = [header.index(region) for region in model.getRegions()]
+    writer = csv.writer(output)
+    writer.writerow([model.subject_id] + [region + '_llr' for region in model.getRegions()] +
+                    [region + '_posterior' for region in model.getRegions()] +
+                    [region + '_zone' for region in model.getTopRegions()])
+    output.flush()
+    # text of every zone code
+    zone_text = dict(ZONE_LABELS)
+    zone_text[ZONE_MISSING] = 'NA'
+    n_subjects = 0
+    for row in reader:
+        if len(row) == 0:
+            continue
+        values = parse_row(row, columns)
+        llr, prob = model.scores(values)
+        cells = [csv_field(row[id_column]), format_values(llr), format_values(prob)]
+        cells += [zone_text[zone] for zone in model.classifyZones(values).tolist()]
+        output.write(','.join(cells) + writer.dialect.lineterminator)
+        output.flush()
+        n_subjects += 1
+    return n_subjects
+
+
+# Parameters: row (list of csv cells); columns (indices of the cells to read)
+# Returns array of the cells as floats, NaN where a cell is empty or not a number. Parsed in one
+# conversion unless a cell holds text
+def parse_row(row, columns):
+    cells = np.array([row[column] for column in columns])
+    try:
+        return np.where(np.char.str_len(np.char.strip(cells)) == 0, 'nan', cells).astype(np.float64)
+    except ValueError:
+        return np.array([parse_float(cell) for cell in cells.tolist()])
+
+
+# Parameter: values (array of floats)
+# Returns the values as one csv string with FLOAT_DIGITS significant digits, 'NA' in place of NaN,
+# formatted by a single % operation rather than cell by cell
+def format_values(values):
+    # NaN is the only value %g formats as 'nan'
+    return (','.join([FLOAT_FORMAT] * len(values)) % tuple(values.tolist())).replace('nan', 'NA')
+
+
+# Parameter: text (string)
+# Returns text as a csv cell, quoted if it holds a delimiter, quote or line break
+def csv_field(text):
+    if any(character in text for character in ',"\r\n'):
+        return '"' + text.replace('"', '""') + '"'
+    return text
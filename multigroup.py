@@ -0,0 +1,129 @@
+import numpy as np
+import density
+from parallel import RegionPool, N_WORKERS
+from scoring import EPSILON, sorted_present
+
+
+# Densities of every region for any number of groups (levels of a categorical column, i.e. site x
+# sex strata or quantile bins of a continuous score, see cohort.bin_groups), for comparing every
+# pair of levels. Each level's density of a region is fitted once, on a grid shared by all levels
+# of that region, so fitting costs O(k) per region for k levels; the k x k divergences and any
+# pair's log likelihood ratios are then differences of the fitted densities, with no refitting per
+# pair. The grids reach KERNEL_TAIL bandwidths past the pooled samples (see model.ReferenceModel),
+# so divergences include the densities' tails (Brain's cover the range of the pooled samples).
+# Memory: regions x k x grid_size floats for the densities.
+class GroupDensities:
+
+    # group_data: map from level (string) to its data, a map from brain region (string) to its
+    # values (NaN for missing), i.e. Cohort.groupData(level) for every level
+    # regions: list of brain regions (defaults to every region of the first level, sorted)
+    # grid_size: number of grid points of every region's densities
+    # bandwidth: bandwidth rule of the kernels ('scott', 'silverman' or a float factor)
+    # n_workers: number of processes fitting regions in parallel (see parallel.RegionPool)
+    def __init__(self, group_data, regions=None, grid_size=density.GRID_SIZE, bandwidth='scott',
+                 n_workers=N_WORKERS):
+        self.levels = sorted(group_data.keys())
+        if regions is None:
+            regions = sorted(group_data[self.levels[0]].keys())
+        self.regions = list(regions)
+        self.level_index = dict((level, i) for i, level in enumerate(self.levels))
+        self.region_index = dict((region, j) for j, region in enumerate(self.regions))
+        self.pool = RegionPool(n_workers)
+        fits = self.pool.map(region_level_densities, [group_data[level] for level in self.levels], self.regions,
+                             (grid_size, bandwidth), memoize=True)
+        # self.lo, self.delta = arrays with the first grid point and grid spacing of every region
+        self.lo = np.array([fit[0] for fit in fits])
+        self.delta = np.array([fit[1] for fit in fits])
+        # self.densities = regions x levels x grid_size array, all zeros for a level a kernel
+        # cannot be fitted to in a region (fewer than two values, or no spread)
+        self.densities = np.stack([fit[2] for fit in fits]) if fits else np.empty((0, len(self.levels), grid_size))
+        # self.divergences = regions x levels x levels array of the area between every pair of
+        # level densities, NaN for pairs with an empty level
+        self.divergences = np.stack([fit[3] for fit in fits]) if fits else np.empty((0,) + (len(self.levels),) * 2)
+
+    # Returns list of levels, sorted (the level order of every array this class returns)
+    def getLevels(self):
+        return self.levels
+
+    # Returns list of regions (the column order of every matrix this class returns)
+    def getRegions(self):
+        return self.regions
+
+    # Parameter: region (string)
+    # Returns levels x levels matrix of the divergences between every pair of levels in the region
+    def divergenceMatrix(self, region):
+        return self.divergences[self.region_index[region]]
+
+    # Returns list of (region, level a, level b, divergence) for every region and every pair of
+    # levels a < b, in decreasing order of divergence
+    def pairDivergences(self):
+        pairs = []
+        for a in range(len(self.levels)):
+            for b in range(a + 1, len(self.levels)):
+                for j, region in enumerate(self.regions):
+                    pairs.append((region, self.levels[a], self.levels[b], float(self.divergences[j, a, b])))
+        return sorted(pairs, key=lambda pair: -pair[3] if np.isfinite(pair[3]) else np.inf)
+
+    # Parameters: level_a, level_b (levels); n (number of regions)
+    # Returns the n regions with the largest divergence between the two levels, in decreasing order
+    def topRegions(self, level_a, level_b, n=10):
+        divergence = self.divergences[:, self.level_index[level_a], self.level_index[level_b]]
+        order = np.argsort(-np.nan_to_num(divergence, nan=-np.inf), kind='mergesort')
+        return [self.regions[j] for j in order[:n]]
+
+    # Parameters: values (subjects x regions matrix in getRegions() order, NaN for missing);
+    # levels (levels to evaluate, defaults to every level)
+    # Returns subjects x regions x len(levels) array with the log density (log(pdf + EPSILON)) of
+    # every value under each level, NaN where the value is missing
+    def logDensities(self, values, levels=None):
+        if levels is None:
+            levels = self.levels
+        values = np.atleast_2d(np.asarray(values, dtype=float))
+        missing = ~np.isfinite(values)
+        log_pdf = np.empty(values.shape + (len(levels),))
+        for i, level in enumerate(levels):
+            pdf = density.interpolate_grid(self.densities[:, self.level_index[level]], self.lo, self.delta, values)
+            log_pdf[..., i] = np.log(pdf + EPSILON)
+        log_pdf[missing] = np.nan
+        return log_pdf
+
+    # Parameter: values (see logDensities)
+    # Returns subjects x (regions * levels) matrix of the log densities of every value under each
+    # level, the levels of a region in adjacent columns (as written to level_loglikelihood.csv)
+    def logDensityRows(self, values):
+        log_pdf = self.logDensities(values)
+        return log_pdf.reshape(len(log_pdf), -1)
+
+    # Parameters: values (see logDensities); level_a, level_b (levels)
+    # Returns subjects x regions matrix of log likelihood ratios log(pdf of level_b / pdf of
+    # level_a), NaN where the value is missing (for levels 'F' and 'M' this is the same ratio as
+    # CohortScorer.logLikelihoodRatios, up to the grid approximation)
+    def logLikelihoodRatios(self, values, level_a, level_b):
+        log_pdf = self.logDensities(values, [level_a, level_b])
+        return log_pdf[..., 1] - log_pdf[..., 0]
+
+
+# Parameters: the region's values for each of the k levels (NaN for missing), then grid_size and
+# rule (see density.grid_kde)
+# Fits every level's density once on a grid covering all levels' samples and KERNEL_TAIL
+# bandwidths past them (see density.tail_range), then takes the area between every pair of
+# densities. A level a kernel cannot be fitted to in the region (see density.fittable) gets a zero
+# density and NaN divergences
+# Returns (lo, delta, k x grid_size densities, k x k divergences); run per region by RegionPool
+# workers, with one table per level
+def region_level_densities(*arguments):
+    grid_size, rule = arguments[-2:]
+    samples = [sorted_present(values) for values in arguments[:-2]]
+    fitted = np.array([density.fittable(x) for x in samples], dtype=bool)
+    if not fitted.any():
+        return 0.0, 1.0, np.zeros((len(samples), grid_size)), np.full((len(samples), len(samples)), np.nan)
+    lo, hi = density.tail_range([x for x, fit in zip(samples, fitted) if fit], rule)
+    delta = (hi - lo) / (grid_size - 1)
+    densities = np.zeros((len(samples), grid_size))
+    for i, x in enumerate(samples):
+        if fitted[i]:
+            densities[i] = density.grid_kde(x, lo, hi, grid_size, rule)[1]
+    divergences = density.trapezoid(abs(densities[:, None, :] - densities[None, :, :]), dx=delta, axis=2)
+    divergences[~fitted, :] = np.nan
+    divergences[:, ~fitted] = np.nan
+    return lo, delta, densities, divergences
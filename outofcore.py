@@ -0,0 +1,186 @@
+import csv
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from cohort import read_chunks, CHUNK_SIZE, MISSING_GROUPS
+from cohort_cache import CACHE_DIR, cache_key
+from brain import zone_counts
+from parallel import MappedColumns
+from export import open_writer, export_order
+
+# version of the directory layout written by build_disk_cohort (part of the cache directory name,
+# so directories written in an older layout are rebuilt)
+DISK_VERSION = 2
+# subjects scored and written at a time by score_blocks
+BLOCK_SIZE = 10000
+
+
+# Cohort kept on disk for data sets larger than memory. The csv file is streamed once into a
+# column-major subjects x variables .npy file, rows sorted by group, then id (as the in-memory
+# export writes them), and each group's values of every region are sorted into a column of that
+# group's own .npy file. Only subject ids and group labels (one entry per subject) are held in
+# memory: a region's sorted values are read when a density is fitted, and subjects are read back a
+# block of rows at a time for scoring.
+class DiskCohort:
+
+    # path: directory written by build_disk_cohort
+    def __init__(self, path):
+        self.path = path
+        self.ids = np.load(os.path.join(path, 'ids.npy'))
+        self.groups = np.load(os.path.join(path, 'groups.npy'))
+        self.values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+        with open(os.path.join(path, 'variables.json')) as f:
+            self.variables = json.load(f)
+        # self.variable_index = map from brain region (string) to its column in every .npy file
+        self.variable_index = dict((variable, j) for j, variable in enumerate(self.variables))
+
+    # Returns number of subjects
+    def __len__(self):
+        return len(self.ids)
+
+    # Returns list of group labels present in the data
+    def getGroups(self):
+        return sorted(str(group) for group in np.unique(self.groups))
+
+    # Returns list of the group labels present in the data, leaving out missing labels (see
+    # Cohort.getLevels)
+    def getLevels(self):
+        return [group for group in self.getGroups() if group.strip() not in MISSING_GROUPS]
+
+    # Returns number of subjects whose group label is missing
+    def countUnlabelled(self):
+        return int(np.count_nonzero(np.isin(np.char.strip(self.groups.astype(str)), MISSING_GROUPS)))
+
+    # Returns list of variable (brain region) names, in column order
+    def getVariables(self):
+        return self.variables
+
+    # Parameter: group (string)
+    # Returns MappedColumns map from brain region (string) to that group's values of the region in
+    # increasing order, NaN (missing values) last. The values are not in subject order: this is
+    # the sample of each region Brain, CohortScorer and the permutation test fit densities to
+    def sortedGroupData(self, group):
+        return MappedColumns(os.path.join(self.path, 'sorted_%s.npy' % group), self.variable_index)
+
+    # Parameters: variables (list of brain regions); block_size (subjects per block)
+    # Yields (ids, groups, values) for every block_size subjects in stored order (by group, then id),
+    # values being the block's subjects x len(variables) matrix (NaN for missing), read from disk
+    # block by block
+    def rowBlocks(self, variables, block_size=BLOCK_SIZE):
+        columns = [self.variable_index[variable] for variable in variables]
+        for start in range(0, len(self.ids), block_size):
+            stop = min(start + block_size, len(self.ids))
+            yield self.ids[start:stop], self.groups[start:stop], np.asarray(self.values[start:stop])[:, columns]
+
+
+# Parameters: csv_file, subject_id, group_by, variables, chunk_size (see cohort.read_chunks);
+# path (directory to write)
+# Streams csv_file into a DiskCohort at path, parsing the file once: every chunk of values is
+# appended to a row-major file that grows with the data, then gathered a block of rows at a time
+# into a column-major memory-mapped .npy file with the rows sorted by group, then id (see
+# export.export_order), and every region's column is read once and each group's values sorted into
+# sorted_<group>.npy. Memory holds one chunk of rows, one column and the ids and group labels, never
+# the subjects x variables table. The directory is written under a temporary name and renamed (see
+# cohort_cache.save_cohort)
+def build_disk_cohort(csv_file, subject_id, group_by, variables, path, chunk_size=CHUNK_SIZE):
+    parent = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+    tmp_path = tempfile.mkdtemp(dir=parent)
+    rows_file = os.path.join(tmp_path, 'rows.f64')
+    ids = []
+    groups = []
+    with open(rows_file, 'wb') as f:
+        for chunk_ids, chunk_groups, chunk_values in read_chunks(csv_file, subject_id, group_by, variables, chunk_size):
+            f.write(np.ascontiguousarray(chunk_values, dtype=np.float64).tobytes())
+            ids.append(chunk_ids)
+            groups.append(chunk_groups)
+    ids = np.concatenate(ids) if ids else np.array([], dtype=str)
+    groups = np.concatenate(groups) if groups else np.array([], dtype=str)
+    # rows in the order the in-memory export writes them, so every group is a contiguous block
+    order = export_order(ids, groups)
+    ids = ids[order]
+    groups = groups[order]
+    values = np.lib.format.open_memmap(os.path.join(tmp_path, 'values.npy'), mode='w+', dtype=np.float64,
+                                       shape=(len(ids), len(variables)), fortran_order=True)
+    if len(ids) and len(variables):
+        rows = np.memmap(rows_file, dtype=np.float64, mode='r', shape=(len(ids), len(variables)))
+        for start in range(0, len(ids), chunk_size):
+            values[start:start + chunk_size] = rows[order[start:start + chunk_size]]
+        del rows
+    values.flush()
+    os.remove(rows_file)
+    np.save(os.path.join(tmp_path, 'ids.npy'), ids)
+    np.save(os.path.join(tmp_path, 'groups.npy'), groups)
+    with open(os.path.join(tmp_path, 'variables.json'), 'w') as f:
+        json.dump(list(variables), f)
+
+    # rows of every group, and that group's sorted values of every region
+    group_rows = dict((str(group), np.flatnonzero(groups == group)) for group in np.unique(groups))
+    sorted_values = dict((group, np.lib.format.open_memmap(
+        os.path.join(tmp_path, 'sorted_%s.npy' % group), mode='w+', dtype=np.float64,
+        shape=(len(rows), len(variables)), fortran_order=True)) for group, rows in group_rows.items())
+    for j in range(len(variables)):
+        column = np.asarray(values[:, j])
+        for group, rows in group_rows.items():
+            # np.sort puts NaN last
+            sorted_values[group][:, j] = np.sort(column[rows])
+    for array in sorted_values.values():
+        array.flush()
+    del values, sorted_values
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another run built the same data first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+# Parameters: same as cohort_cache.load_cohort
+# Returns DiskCohort for csv_file, built under cache_dir on the first run and reopened (without
+# reading csv_file again) while the file and the selected columns are unchanged
+def load_disk_cohort(csv_file, subject_id, group_by, variables, cache_dir=CACHE_DIR):
+    path = os.path.join(cache_dir, 'disk%d-' % DISK_VERSION + cache_key(csv_file, subject_id, group_by, variables))
+    if not os.path.exists(path):
+        build_disk_cohort(csv_file, subject_id, group_by, variables, path)
+    return DiskCohort(path)
+
+
+# Parameters: cohort (DiskCohort); model (model.ReferenceModel of the cohort); ratio_file, zone_file
+# (paths of the csv files to write); block_size (subjects scored at a time)
+# Streams the subjects through the model a block at a time, appending every subject's log
+# likelihood ratios to ratio_file (any format of export.open_writer, rows by group, then id, as
+# export.write_scores orders them), and counts every group's internally consistent and mosaic brains
+# over the model's top regions (see brain.zone_counts), written to zone_file
+# Returns number of subjects scored
+def score_blocks(cohort, model, ratio_file, zone_file, block_size=BLOCK_SIZE):
+    regions = model.getRegions()
+    # map from group label to its [subjects, consistent, mosaic] counts
+    counts = {}
+    writer = open_writer(ratio_file, ['SubjectId', 'Gender'] + regions, len(cohort))
+    try:
+        for ids, groups, values in cohort.rowBlocks(regions, block_size):
+            writer.writeBlock(ids, groups, model.logLikelihoodRatios(values))
+            consistent, mosaic = zone_counts(model.classifyZones(values))[3:]
+            for group in np.unique(groups):
+                rows = groups == group
+                total = counts.setdefault(str(group), [0, 0, 0])
+                total[0] += int(np.count_nonzero(rows))
+                total[1] += int(np.count_nonzero(consistent[rows]))
+                total[2] += int(np.count_nonzero(mosaic[rows]))
+    finally:
+        writer.close()
+    with open(zone_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Group', 'Subjects', 'Consistent', 'Mosaic'])
+        n_subjects = n_consistent = n_mosaic = 0
+        for group in sorted(counts):
+            subjects, consistent, mosaic = counts[group]
+            writer.writerow([group, subjects, consistent / float(subjects), mosaic / float(subjects)])
+            n_subjects += subjects
+            n_consistent += consistent
+            n_mosaic += mosaic
+        writer.writerow(['All', n_subjects, n_consistent / float(max(n_subjects, 1)),
+                         n_mosaic / float(max(n_subjects, 1))])
+    return n_subjects
@@ -0,0 +1,187 @@
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import fitcache
+
+# default number of worker processes (None = one per cpu core)
+N_WORKERS = 1
+
+# map from shared memory block name to (SharedMemory, array) for the blocks a worker process has
+# attached, so each block is mapped once per worker rather than once per region
+_attached = {}
+
+
+# Copy of a numpy array in a shared memory block, which worker processes attach to by name
+# instead of receiving the data pickled with every task
+class SharedArray:
+
+    # array: numpy array to copy into shared memory
+    def __init__(self, array):
+        array = np.ascontiguousarray(array)
+        self.shape = array.shape
+        self.dtype = array.dtype.str
+        self.shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+        self.array[...] = array
+
+    # Returns (name, shape, dtype) tuple a worker passes to attach()
+    def handle(self):
+        return (self.shm.name, self.shape, self.dtype)
+
+    # Releases the shared memory block
+    def close(self):
+        del self.array
+        self.shm.close()
+        self.shm.unlink()
+
+
+# Parameter: handle (tuple returned by SharedArray.handle)
+# Returns the shared array as a numpy array (attached once per worker process)
+def attach(handle):
+    name, shape, dtype = handle
+    if name not in _attached:
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # python < 3.13 registers the block again with the resource tracker the worker shares
+            # with its parent, which is harmless: the owner unlinks and unregisters it once
+            shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    return _attached[name][1]
+
+
+# Column-major values matrix saved as a .npy file, read as a map from brain region (string) to its
+# column. Only the columns that are asked for are read from disk, and RegionPool workers map the
+# file themselves instead of receiving a copy in shared memory, so tables larger than memory can be
+# spread over worker processes (see outofcore.py)
+class MappedColumns:
+
+    # path: .npy file of a (rows x columns) matrix, saved in fortran order so a column is contiguous
+    # columns: map from brain region (string) to its column in the matrix
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = columns
+        self.array = None
+
+    # Returns (path, column of each region) tuple a worker passes to attach_mapped()
+    def handle(self, regions):
+        return (self.path, [self.columns[region] for region in regions])
+
+    def __getitem__(self, region):
+        if self.array is None:
+            self.array = np.load(self.path, mmap_mode='r')
+        return self.array[:, self.columns[region]]
+
+    def __contains__(self, region):
+        return region in self.columns
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __len__(self):
+        return len(self.columns)
+
+    def keys(self):
+        return list(self.columns.keys())
+
+    # MappedColumns sent to a worker are re-opened there rather than pickled with their map
+    def __getstate__(self):
+        return {'path': self.path, 'columns': self.columns, 'array': None}
+
+
+# Parameter: path (.npy file of a MappedColumns table)
+# Returns the file memory-mapped read-only (mapped once per worker process)
+def attach_mapped(path):
+    if path not in _attached:
+        _attached[path] = (None, np.load(path, mmap_mode='r'))
+    return _attached[path][1]
+
+
+# Parameters: data (map from brain region (string) to its values); regions (list of brain regions)
+# Returns regions x max(len(values)) float matrix with one row per region, padded with NaN
+def region_matrix(data, regions):
+    width = max([len(data[region]) for region in regions] + [0])
+    matrix = np.full((len(regions), width), np.nan)
+    for i, region in enumerate(regions):
+        values = np.asarray(data[region], dtype=float)
+        matrix[i, :len(values)] = values
+    return matrix
+
+
+# Parameter: task (tuple built by RegionPool.map)
+# Returns function applied to one region's rows of every shared table
+def _run_region(task):
+    function, handles, index, args = task
+    rows = []
+    for kind, handle in handles:
+        if kind == 'mapped':
+            path, columns = handle
+            rows.append(np.asarray(attach_mapped(path)[:, columns[index]], dtype=float))
+        else:
+            rows.append(attach(handle)[index])
+    return function(*(rows + list(args)))
+
+
+# Spreads independent per-region work over a pool of worker processes.
+# Every table (i.e. the female and male data) is copied once into shared memory as a
+# regions x values matrix, except MappedColumns tables, which workers map from disk; a task only
+# carries the region's row index, so no region data is pickled. Results come back in region order, and each one only depends on its own region's
+# data, so they are the same whatever the number of workers.
+class RegionPool:
+
+    # n_workers: number of worker processes (None = one per cpu core, 1 = run in this process)
+    def __init__(self, n_workers=N_WORKERS):
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        self.n_workers = max(int(n_workers), 1)
+
+    # Returns number of worker processes
+    def getNumWorkers(self):
+        return self.n_workers
+
+    # Parameters: function (module-level function called as function(*rows, *args), where rows
+    # holds the region's values (NaN padded) from each table); tables (list of maps from brain
+    # region (string) to its values); regions (list of brain regions); args (extra arguments,
+    # either one tuple for every region or a list with a tuple per region); memoize (look every
+    # region's result up in fitcache.FIT_CACHE first, keyed on its rows and args, and only run the
+    # regions that are not cached; for deterministic functions such as density fits)
+    # Returns list of results, one per region in the order of regions
+    def map(self, function, tables, regions, args=(), memoize=False):
+        regions = list(regions)
+        if isinstance(args, tuple):
+            args = [args] * len(regions)
+        cache = fitcache.FIT_CACHE
+        if memoize and cache.isEnabled():
+            keys = [cache.key(function, [table[region] for table in tables], args[i])
+                    for i, region in enumerate(regions)]
+            results = [cache.get(key) for key in keys]
+            missing = [i for i, result in enumerate(results) if result is None]
+            if missing:
+                computed = self.map(function, tables, [regions[i] for i in missing], [args[i] for i in missing])
+                for i, result in zip(missing, computed):
+                    results[i] = cache.put(keys[i], result)
+            return results
+        if self.n_workers == 1 or len(regions) <= 1:
+            return [function(*([np.asarray(table[region], dtype=float) for table in tables] + list(args[i])))
+                    for i, region in enumerate(regions)]
+        shared = []
+        try:
+            handles = []
+            for table in tables:
+                if isinstance(table, MappedColumns):
+                    handles.append(('mapped', table.handle(regions)))
+                else:
+                    shared.append(SharedArray(region_matrix(table, regions)))
+                    handles.append(('shared', shared[-1].handle()))
+            tasks = [(function, handles, i, args[i]) for i in range(len(regions))]
+            n_workers = min(self.n_workers, len(regions))
+            chunk_size = max(len(regions) // (4 * n_workers), 1)
+            pool = multiprocessing.Pool(n_workers)
+            try:
+                return pool.map(_run_region, tasks, chunk_size)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            for array in shared:
+                array.close()
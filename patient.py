@@ -1,13 +1,14 @@
-import numpy as np
-from scipy import stats
-from math import log
-import matplotlib.pyplot as plt
-import os
+from scoring import CohortScorer, fit_grids
+from parallel import RegionPool, N_WORKERS
+from brain import density_grids
+import density
+import plots
 
 class Patient:
     # patient_id = id of patient, type: string
     # gender = gender of patient, type: string
-    # data = map from name of brain region (string) to its value (float)
+    # data = map from name of brain region (string) to its value (float, NaN if missing),
+    # i.e. a dict or a view of the patient's row in a Cohort (Cohort.patient)
     def __init__(self, patient_id, gender, data):
         self.id = patient_id
         self.gender = gender
@@ -66,98 +67,39 @@ class Patient:
             elif (self.__region_zones[region] == 'F'):
                 n_female_end = n_female_end + 1
             else:
-                n_intermedaite = n_intermediate + 1
-        return (n_female_end == 0 and n_intermediate == 0) or (n_male_end == 0 and n_intermediate == 0) or (
-        n_male_end == 0 and n_intermediate == 0)
-
-    def plotProbDensity(self, female_data, male_data):
-        for region in self.data.keys():
-            f = sorted(female_data[region])
-            m = sorted(male_data[region])
-            f_kernel = stats.gaussian_kde(f)
-            m_kernel = stats.gaussian_kde(m)
-
-            # plot pdfs for every var
-            plots_path = 'results/pdfplots/'
-            if not os.path.exists(plots_path):
-                os.makedirs(plots_path)
-
-            figpath = plots_path + str(region)
-
-            plt.plot(f, f_kernel.evaluate(f), 'pink')
-            plt.plot(m, m_kernel.evaluate(m), 'blue')
-            plt.title(str(region))
-            plt.xlabel(region)
-            plt.ylabel('probability density')
-            plt.savefig(figpath)
-            plt.close()
-
-    def genderLikelihood(self, female_data, male_data):
-        ratio_map = {}
-        for region in self.data.keys():
-            f = sorted(female_data[region])
-            m = sorted(male_data[region])
-            value = self.data[region]
-
-            if(value == float("inf")):
-                ratio_map[region] = 'NA'
-                continue
-
-            f = [x for x in f if x != float("inf")]
-            m = [x for x in m if x != float("inf")]
-
-            # using gaussian kernel density estimate
-            f_kernel = stats.gaussian_kde(f)
-            m_kernel = stats.gaussian_kde(m)
-            f_pdf = f_kernel.evaluate(value)[0]
-            m_pdf = m_kernel.evaluate(value)[0]
-
-            # Calculate log likelihood ratio (add small amount to both values to prevent div0 and log(0) errors
-            llr = log((m_pdf + 0.0000000001)/ (f_pdf + 0.0000000001))
-            ratio_map[region] = llr
-
-            ## plot pdfs for every var (deprecated method)
-
-            # plots_path = 'results/sex_differences/pdfplots/'
-            # if not os.path.exists(plots_path):
-            #     os.makedirs(plots_path)
-            #
-            # figpath = plots_path + str(region)
-            #
-            # plt.plot(f, f_kernel.evaluate(f), 'pink')
-            # plt.plot(m, m_kernel.evaluate(m), 'blue')
-            # plt.title(str(region))
-            # plt.xlabel('measure')
-            # plt.ylabel('probability density')
-            # plt.savefig(figpath)
-            # plt.close()
-
-        return ratio_map
+                n_intermediate = n_intermediate + 1
+        return (n_female_end == 0 and n_intermediate == 0) or (n_male_end == 0 and n_intermediate == 0)
+
+    # Parameters: female_data, male_data (maps from brain region (string) to its values);
+    # n_workers (number of processes drawing regions in parallel, see parallel.RegionPool)
+    # Saves a plot of the female and male probability densities of every region in this
+    # patient's data to results/pdfplots/ (see plots.plot_densities; Brain.densityGrids reuses the
+    # densities Brain has already fitted)
+    def plotProbDensity(self, female_data, male_data, n_workers=N_WORKERS):
+        regions = list(self.data.keys())
+        pool = RegionPool(n_workers)
+        grids = density_grids(fit_grids(pool, female_data, male_data, regions, density.GRID_SIZE, 'scott'))
+        plots.plot_densities(dict(zip(regions, grids)), n_workers=n_workers)
+
+    # Parameters: female_data, male_data (maps from brain region (string) to its values (list of floats));
+    # scorer (optional CohortScorer already fitted on female_data and male_data, so the kernels
+    # are not refit for every patient); method (density estimator of the scorer fitted when none
+    # is given, see density.METHODS)
+    # Returns map from brain region (string) to the log likelihood ratio log(male pdf / female pdf)
+    # of this patient's value, or 'NA' if the value is missing
+    def genderLikelihood(self, female_data, male_data, scorer=None, method='exact'):
+        if scorer is None:
+            scorer = CohortScorer(female_data, male_data, list(self.data.keys()), method=method)
+        llr = scorer.logLikelihoodRatios(scorer.dataMatrix([self.data]))
+        return dict(zip(scorer.getRegions(), scorer.formatRows(llr)[0]))
 
     # (Deprecated) Method for calculating posterior probability using Bayes' Theorem. An alternative to using
     # the log likelihood ratio as a dimorphism score. This value would be between 0 and 1 and
     # reflects the percent chance that a subject is male given a data point.
-    def posteriorProb(self, female_data, male_data):
-        prob_map = {}
-
-        for region in self.data.keys():
-            f = sorted(female_data[region])
-            m = sorted(male_data[region])
-            value = self.data[region]
-
-            if(value == float("inf")):
-                prob_map[region] = 'NA'
-                continue
+    def posteriorProb(self, female_data, male_data, scorer=None, method='exact'):
+        if scorer is None:
+            scorer = CohortScorer(female_data, male_data, list(self.data.keys()), method=method)
+        prob = scorer.posteriorProbs(scorer.dataMatrix([self.data]))
+        return dict(zip(scorer.getRegions(), scorer.formatRows(prob)[0]))
 
-            f = [x for x in f if x != float("inf")]
-            m = [x for x in m if x != float("inf")]
 
-            #### using gaussian kernel density estimate
-            f_kernel = stats.gaussian_kde(f)
-            m_kernel = stats.gaussian_kde(m)
-            f_pdf = f_kernel.evaluate(value)[0] #likelihood
-            m_pdf = m_kernel.evaluate(value)[0] #likelihood
-            prior = 0.5
-            p_data = f_pdf*prior + m_pdf*prior
-            prob_map[region] = m_pdf*prior/p_data
-        return prob_map
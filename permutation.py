@@ -0,0 +1,88 @@
+import numpy as np
+import density
+from scoring import sorted_present
+
+# default number of label permutations per region
+N_PERMUTATIONS = 10000
+# number of permutations drawn and evaluated together
+BATCH_SIZE = 500
+
+
+# Parameters: f_counts, m_counts (k x grid_size matrices of female and male counts per grid point,
+# one row per labelling of the samples); grid (grid points); rule (bandwidth rule)
+# Returns array of k divergences: the area between the female and male kernel density estimates
+# of every row (see density.binned_densities)
+def binned_divergences(f_counts, m_counts, grid, rule='scott'):
+    f_densities = density.binned_densities(f_counts, grid, rule)
+    m_densities = density.binned_densities(m_counts, grid, rule)
+    return density.trapezoid(abs(f_densities - m_densities), dx=grid[1] - grid[0], axis=1)
+
+
+# Parameters: f, m (one region's female and male values, NaN for missing); n_permutations (number
+# of label permutations); seed (seed or np.random.SeedSequence of this region's permutations);
+# grid_size, rule (see density.grid_divergence); batch_size (permutations evaluated together)
+# Runs a permutation test of the region's divergence. Samples are binned once onto a grid over the
+# pooled range, and the statistic is the divergence of the binned densities. Shuffling the group
+# labels only moves counts between the two groups within each grid point, so a batch of
+# permutations is drawn directly as multivariate hypergeometric count matrices and all of them
+# are convolved by fft at once: the cost is O(n_permutations * grid_size log grid_size),
+# independent of the number of subjects
+# Returns (observed divergence, p-value); run per region by RegionPool workers
+def region_permutation_test(f, m, n_permutations, seed, grid_size=density.GRID_SIZE, rule='scott',
+                            batch_size=BATCH_SIZE):
+    f = sorted_present(f)
+    m = sorted_present(m)
+    lo = min(f[0], m[0])
+    hi = max(f[-1], m[-1])
+    if hi == lo:
+        return 0.0, 1.0
+    grid = np.linspace(lo, hi, grid_size)
+    delta = grid[1] - grid[0]
+    f_counts = density.nearest_counts(f, lo, delta, grid_size)
+    total = f_counts + density.nearest_counts(m, lo, delta, grid_size)
+    observed = binned_divergences(f_counts[None], (total - f_counts)[None], grid, rule)[0]
+    # permuted divergences equal to the observed one up to rounding count as exceeding it
+    threshold = observed * (1 - 1e-12)
+
+    rng = np.random.default_rng(seed)
+    n_exceeding = 0
+    for start in range(0, n_permutations, batch_size):
+        size = min(batch_size, n_permutations - start)
+        permuted = rng.multivariate_hypergeometric(total, len(f), size=size)
+        null = binned_divergences(permuted, total - permuted, grid, rule)
+        n_exceeding += int(np.count_nonzero(null >= threshold))
+    return observed, (1.0 + n_exceeding) / (1.0 + n_permutations)
+
+
+# Parameter: p_values (array of p-values)
+# Returns array of Benjamini-Hochberg false discovery rate adjusted p-values (q-values)
+def fdr_q_values(p_values):
+    p_values = np.asarray(p_values, dtype=float)
+    n = len(p_values)
+    if n == 0:
+        return p_values
+    order = np.argsort(p_values)
+    scaled = p_values[order] * n / np.arange(1, n + 1)
+    # q_i = min over j >= i of p_j * n / j
+    q_sorted = np.minimum(np.minimum.accumulate(scaled[::-1])[::-1], 1.0)
+    q_values = np.empty(n)
+    q_values[order] = q_sorted
+    return q_values
+
+
+# Parameters: female_data, male_data (maps from brain region (string) to its values, NaN for
+# missing); regions (list of brain regions); pool (parallel.RegionPool the regions are spread over);
+# n_permutations, grid_size, rule, batch_size (see region_permutation_test); seed (seed of the
+# whole test: every region gets its own stream spawned from it, so results do not depend on the
+# number of workers)
+# Returns (observed divergence map, p-value map, q-value map), each a map from brain region (string)
+def permutation_test(female_data, male_data, regions, pool, n_permutations=N_PERMUTATIONS, seed=0,
+                     grid_size=density.GRID_SIZE, rule='scott', batch_size=BATCH_SIZE):
+    regions = list(regions)
+    seeds = np.random.SeedSequence(seed).spawn(len(regions))
+    args = [(n_permutations, seeds[i], grid_size, rule, batch_size) for i in range(len(regions))]
+    results = pool.map(region_permutation_test, [female_data, male_data], regions, args, memoize=True)
+    p_values = np.array([p for (observed, p) in results])
+    q_values = fdr_q_values(p_values)
+    observed_map = dict((region, observed) for region, (observed, p) in zip(regions, results))
+    return observed_map, dict(zip(regions, p_values)), dict(zip(regions, q_values))
@@ -0,0 +1,259 @@
+import csv
+import logging
+import os
+import xml.etree.ElementTree as ET
+from cohort import bin_groups
+from cohort_cache import load_cohort
+from multigroup import GroupDensities
+from outofcore import load_disk_cohort, score_blocks
+from brain import Brain
+from scoring import CohortScorer
+from bootstrap import bootstrap_intervals
+from crossval import cross_validate, classification_summary
+from export import write_scores
+from model import build_model
+import plots
+import fitcache
+from instrument import Trace, timed
+import numpy as np
+
+
+def parse_xml(xml_file):
+    # Parses config.xml and sets relevant parameters.
+    config = ET.parse(xml_file)
+    root = config.getroot()
+    # dir to data file
+    data_file = root.find('data').text
+    # name of subject id variable in data file
+    subject_id = root.find('subjectId').text
+    # binary variable to define the groups
+    group_by = root.find('groups').text
+    # variables to be used in analysis
+    variables = []
+    for variable in root.find('variables').iter('variable'):
+        variables.append(variable.text)
+    return data_file, subject_id, group_by, variables
+
+
+def parse_option(xml_file, tag, default=None):
+    # Returns the text of an optional element of config.xml, or default if it is not there
+    node = ET.parse(xml_file).getroot().find(tag)
+    if node is None:
+        return default
+    return node.text
+
+
+def csv_to_map(csv_file, subject_id, group_by, variables):
+    # Loads the id, group and variable columns of the data into a Cohort: one subjects x variables
+    # float matrix (NaN for missing values), with the group label and id of every row.
+    # Memory-maps the arrays from cache/ instead when the data file and columns are unchanged.
+    return load_cohort(csv_file, subject_id, group_by, variables)
+
+
+# Parameters: config_file (path to the configuration, see config.xml); results_dir (directory
+# the results are written to); cohort (Cohort of the configuration's data file, subject id, group
+# column and variables, already loaded; defaults to loading it, see csv_to_map)
+# Runs the whole analysis the configuration describes and writes its results. Keeps no state
+# between calls, so one process can run any number of analyses (see batch.py)
+# Returns the run's Trace (every stage's wall time, cpu time, peak memory and item count)
+def run_analysis(config_file='config.xml', results_dir='results', cohort=None):
+    # every stage's wall time, cpu time, peak memory and item count is recorded (see instrument.Trace)
+    trace = Trace()
+    trace_file = None
+    try:
+        with trace.stage('config') as record:
+            data_file, subject_id, group_by, variables = parse_xml(config_file)
+            # number of processes computing regions in parallel
+            n_workers = int(parse_option(config_file, 'workers', 1))
+            # file the log likelihood ratios are written to (.csv, .csv.gz, .npy or .parquet)
+            output_file = parse_option(config_file, 'output', os.path.join(results_dir, 'loglikelihood.csv'))
+            # stream the data through files on disk instead of loading it into memory
+            out_of_core = (parse_option(config_file, 'outOfCore', 'false').lower() == 'true')
+            # density fits are memoized in memory (memoryMB, 0 turns it off) and, if a directory is
+            # given, on disk, so reruns on unchanged data reuse them
+            fit_cache = ET.parse(config_file).getroot().find('fitCache')
+            if fit_cache is not None:
+                max_bytes = int(float(fit_cache.get('memoryMB', fitcache.MAX_BYTES >> 20)) * (1 << 20))
+                cache_dir = (fit_cache.text or '').strip() or None
+                # a process running several analyses keeps its cache while the settings are the same
+                if (max_bytes, cache_dir) != (fitcache.FIT_CACHE.max_bytes, fitcache.FIT_CACHE.cache_dir):
+                    fitcache.configure(max_bytes, cache_dir)
+            # density estimator of the divergences and of the scores ('fft', 'exact' or 'gaussian';
+            # by default divergences are binned by fft and scores evaluated exactly), and the bandwidth
+            # rule of the kernels ('scott', 'silverman', 'robust' or a factor)
+            estimator = parse_option(config_file, 'estimator')
+            bandwidth = parse_option(config_file, 'bandwidth', 'scott')
+            if bandwidth not in ('scott', 'silverman', 'robust'):
+                bandwidth = float(bandwidth)
+            # number of equal-frequency bins if the group column is a continuous score
+            n_bins = ET.parse(config_file).getroot().find('groups').get('bins')
+            if out_of_core and n_bins is not None:
+                raise ValueError("<groups bins=...> is not supported with <outOfCore>: the disk cohort is "
+                                 "grouped by the labels of %s as they are in the data file" % group_by)
+            # optional JSON file the stage records are written to
+            trace_file = parse_option(config_file, 'trace')
+            # optional stages (separated by spaces, or 'all') to run under cProfile
+            trace.setProfiledStages((parse_option(config_file, 'profile') or '').split(),
+                                    os.path.join(results_dir, 'profiles'))
+            # stage records are also logged at INFO level
+            logging.basicConfig(level=parse_option(config_file, 'logLevel', 'WARNING').upper(),
+                                format='%(asctime)s %(name)s %(message)s')
+            record['items'] = len(variables)
+
+        with trace.stage('load') as record:
+            if out_of_core:
+                cohort = load_disk_cohort(data_file, subject_id, group_by, variables)
+            else:
+                if cohort is None:
+                    cohort = csv_to_map(data_file, subject_id, group_by, variables)
+                if n_bins is not None:
+                    cohort = bin_groups(cohort, int(n_bins))
+            record['items'] = len(cohort)
+
+        # subjects without a group label are scored but left out of every group's densities
+        levels = cohort.getLevels()
+        if cohort.countUnlabelled():
+            logging.warning('%d of %d subjects have no %s label and are left out of the group densities',
+                            cohort.countUnlabelled(), len(cohort), group_by)
+        if out_of_core and levels != ['F', 'M']:
+            raise ValueError("<outOfCore> compares the groups 'F' and 'M' only, but %s has the levels %s"
+                             % (group_by, ', '.join(levels)))
+        if out_of_core:
+            # Cohort larger than memory: fit and rank one region at a time from the sorted group
+            # values on disk, then stream the subjects through the reference model block by block
+            if not os.path.exists(results_dir):
+                os.makedirs(results_dir)
+            with trace.stage('divergence', len(variables)):
+                b = Brain(cohort.sortedGroupData('F'), cohort.sortedGroupData('M'), estimator or 'fft',
+                          bandwidth=bandwidth, n_workers=n_workers)
+            with trace.stage('end_ranges', b.getNumTopRegions()):
+                b.setEndPercentage(1.0 / 4.0)
+            with trace.stage('model', len(variables)):
+                model = build_model(b, subject_id, sorted(variables))
+                model.save(os.path.join(results_dir, 'reference_model.npz'))
+            with trace.stage('plot') as record:
+                plots_path = os.path.join(results_dir, 'pdfplots')
+                input_mtime = max(os.path.getmtime(data_file), os.path.getmtime(config_file))
+                record['items'] = len(plots.plot_densities(b.densityGrids(sorted(variables)), plots_path,
+                                                           input_mtime, n_workers))
+            with trace.stage('score', len(cohort)):
+                score_blocks(cohort, model, output_file, os.path.join(results_dir, 'mosaic.csv'))
+        elif levels != ['F', 'M']:
+            # Any other grouping (i.e. site x sex strata or bins of a continuous score): fit every
+            # level's densities once and compare every pair of levels
+            with trace.stage('levels', len(levels)):
+                if not os.path.exists(results_dir):
+                    os.makedirs(results_dir)
+                group_densities = GroupDensities(dict((level, cohort.groupData(level)) for level in levels),
+                                                 sorted(variables), bandwidth=bandwidth, n_workers=n_workers)
+                with open(os.path.join(results_dir, 'pairwise_divergence.csv'), 'w', newline='') as f:
+                    writer = csv.writer(f)
+                    writer.writerow(['Region', 'Level A', 'Level B', 'Divergence'])
+                    writer.writerows(group_densities.pairDivergences())
+                # log density of every subject's value under each level: the log likelihood ratio
+                # of any pair of levels is the difference of their two columns. Computed and written
+                # a block of subjects at a time, in the cohort's row order
+                write_scores(os.path.join(results_dir, 'level_loglikelihood.csv'),
+                             ['SubjectId', 'Group'] + [region + '_' + level for region in group_densities.getRegions()
+                                                       for level in levels],
+                             cohort.ids, cohort.groups, cohort.columns(group_densities.getRegions()),
+                             group_densities.logDensityRows, np.arange(len(cohort)))
+        else:
+            with trace.stage('group') as record:
+                female_data = cohort.groupData('F')
+                male_data = cohort.groupData('M')
+                record['items'] = len(cohort.getGroups())
+
+            with trace.stage('divergence', len(variables)):
+                b = Brain(female_data, male_data, estimator or 'fft', bandwidth=bandwidth, n_workers=n_workers)
+
+            with trace.stage('end_ranges', b.getNumTopRegions()):
+                b.setEndPercentage(1.0 / 4.0)
+
+            if not os.path.exists(results_dir):
+                os.makedirs(results_dir)
+
+            # Save the fitted reference model, so new subjects can be scored with score-subjects.py
+            # without rerunning this pipeline
+            with trace.stage('model', len(variables)):
+                build_model(b, subject_id, sorted(variables)).save(os.path.join(results_dir, 'reference_model.npz'))
+
+            # Optionally test every region's divergence against shuffled group labels
+            n_permutations = parse_option(config_file, 'permutations')
+            if n_permutations is not None:
+                with trace.stage('permutation', len(variables)):
+                    p_values, q_values = b.permutationTest(int(n_permutations))
+                    with open(os.path.join(results_dir, 'permutation.csv'), 'w', newline='') as f:
+                        writer = csv.writer(f)
+                        writer.writerow(['Region', 'Divergence', 'P', 'Q'])
+                        for divergence, region in b.divergence:
+                            writer.writerow([region, divergence, p_values[region], q_values[region]])
+
+            # Classify every subject's top regions into male-end, female-end or intermediate zones and
+            # export the proportions of internally consistent and mosaic brains per group
+            with trace.stage('zones', len(cohort)):
+                zones = b.classifyZones(cohort.columns(b.getTopRegions()))
+                zone_summary = b.zoneSummary(zones, cohort.groups)
+                with open(os.path.join(results_dir, 'mosaic.csv'), 'w', newline='') as f:
+                    writer = csv.writer(f)
+                    writer.writerow(['Group', 'Subjects', 'Consistent', 'Mosaic'])
+                    for group in sorted(zone_summary['groups'].keys()):
+                        writer.writerow([group] + list(zone_summary['groups'][group]))
+                    writer.writerow(['All', len(cohort), zone_summary['consistent_proportion'],
+                                     zone_summary['mosaic_proportion']])
+
+            column_names = ['SubjectId', 'Gender'] + sorted(variables)
+
+            # plot every region's densities from the grids Brain fitted; figures newer than the data file
+            # and config.xml are kept
+            with trace.stage('plot') as record:
+                plots_path = os.path.join(results_dir, 'pdfplots')
+                input_mtime = max(os.path.getmtime(data_file), os.path.getmtime(config_file))
+                record['items'] = len(plots.plot_densities(b.densityGrids(sorted(variables)), plots_path,
+                                                           input_mtime, n_workers))
+
+            # fit each region's female and male densities once, and score every subject against them:
+            # the log likelihood ratios are computed and written a block of subjects at a time, sorted
+            # by group and id through an index, and the time spent scoring the blocks (rather than
+            # writing them) is recorded in the stage's 'parts'
+            with trace.stage('score', len(cohort)) as record:
+                scorer = CohortScorer(female_data, male_data, column_names[2:], n_workers, estimator or 'exact', bandwidth)
+                write_scores(output_file, column_names, cohort.ids, cohort.groups, cohort.columns(column_names[2:]),
+                             timed(record, 'llr', scorer.logLikelihoodRatios))
+
+            # Optionally score every subject against densities fitted without it (k-fold, or 'loo'
+            # for leave-one-out), and report how well the held-out ratios classify the subjects
+            n_folds = parse_option(config_file, 'crossValidation')
+            if n_folds is not None:
+                with trace.stage('crossval', len(cohort)):
+                    f_llr, m_llr = cross_validate(female_data, male_data, column_names[2:],
+                                                  None if n_folds.strip().lower() == 'loo' else int(n_folds),
+                                                  method=estimator or 'exact', bandwidth=bandwidth, n_workers=n_workers)
+                    with open(os.path.join(results_dir, 'crossval.csv'), 'w', newline='') as f:
+                        writer = csv.writer(f)
+                        writer.writerow(['Region', 'Subjects', 'Accuracy', 'AUC'])
+                        writer.writerows(classification_summary(f_llr, m_llr, column_names[2:]))
+
+            # Optionally bootstrap percentile intervals for every log likelihood ratio
+            n_boot = parse_option(config_file, 'bootstrap')
+            if n_boot is not None:
+                with trace.stage('bootstrap', len(cohort)):
+                    lower, upper = bootstrap_intervals(scorer, cohort.columns(column_names[2:]), int(n_boot),
+                                                       rule=bandwidth)
+                    lower_rows = scorer.formatRows(lower)
+                    upper_rows = scorer.formatRows(upper)
+                    with open(os.path.join(results_dir, 'loglikelihood_ci.csv'), 'w', newline='') as f:
+                        writer = csv.writer(f)
+                        writer.writerow(column_names[:2] + [region + suffix for region in column_names[2:]
+                                                            for suffix in ('_lower', '_upper')])
+                        for i, patient_id in enumerate(cohort.ids):
+                            interval_row = [patient_id, str(cohort.groups[i])]
+                            for j in range(len(column_names) - 2):
+                                interval_row.extend([lower_rows[i][j], upper_rows[i][j]])
+                            writer.writerow(interval_row)
+    finally:
+        logging.info('fit cache: %d hits, %d misses', fitcache.FIT_CACHE.hits, fitcache.FIT_CACHE.misses)
+        # the trace is written even when a stage fails, with the failed stage as its last record
+        if trace_file is not None:
+            trace.save(trace_file)
+    return trace
@@ -0,0 +1,83 @@
+import os
+import numpy as np
+# the object-oriented Agg API draws without pyplot's global state or a display, so figures can be
+# rendered headless and in parallel worker processes
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from parallel import RegionPool, N_WORKERS
+
+# default directory of the density plots
+PLOTS_PATH = 'results/pdfplots/'
+# default directory of the histograms drawn by Brain.drawDistribution
+DISTRIBUTIONS_PATH = 'results/distributions/'
+
+
+# Parameters: plots_path (directory of the figures); region (name of the region)
+# Returns path of the region's figure
+def figure_path(plots_path, region):
+    return os.path.join(plots_path, str(region) + '.png')
+
+
+# Parameters: figpath (path of a figure); input_mtime (modification time of the newest input, or
+# None to always render)
+# Returns True if figpath exists and is newer than the inputs, so it does not need rendering again
+def is_current(figpath, input_mtime):
+    return input_mtime is not None and os.path.exists(figpath) and os.path.getmtime(figpath) > input_mtime
+
+
+# Parameters: grid, f_density, m_density (one region's densities on a grid, see
+# Brain.densityGrids; NaN padding from RegionPool is dropped); region (name of the region);
+# figpath (path of the figure to save)
+# Saves a plot of the female and male probability densities of the region; run per region by
+# RegionPool workers
+# Returns figpath
+def render_densities(grid, f_density, m_density, region, figpath):
+    present = np.isfinite(grid)
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot(111)
+    axes.plot(grid[present], f_density[present], 'pink', label='female')
+    axes.plot(grid[present], m_density[present], 'blue', label='male')
+    axes.set_title(str(region))
+    axes.set_xlabel(region)
+    axes.set_ylabel('probability density')
+    figure.savefig(figpath, bbox_inches='tight')
+    return figpath
+
+
+# Parameters: density_grids (map from brain region (string) to its (grid, female density, male
+# density), i.e. Brain.densityGrids()); plots_path (directory of the figures); input_mtime
+# (modification time of the newest input; regions whose figure is newer are skipped, None renders
+# every region); n_workers (number of processes rendering regions in parallel)
+# Saves a plot of the female and male probability densities of every region to plots_path, drawn
+# from the densities already fitted on their grids instead of refitting the kernels
+# Returns list of the regions that were rendered
+def plot_densities(density_grids, plots_path=PLOTS_PATH, input_mtime=None, n_workers=N_WORKERS):
+    if not os.path.exists(plots_path):
+        os.makedirs(plots_path)
+    regions = [region for region in sorted(density_grids)
+               if not is_current(figure_path(plots_path, region), input_mtime)]
+    tables = [dict((region, density_grids[region][k]) for region in regions) for k in range(3)]
+    RegionPool(n_workers).map(render_densities, tables, regions,
+                              [(region, figure_path(plots_path, region)) for region in regions])
+    return regions
+
+
+# Parameters: f, m (one region's female and male values, missing values left out); region (name
+# of the region); figpath (path of the figure to save)
+# Saves overlaid female and male histograms of the region, normalized to densities, with the
+# number of bins chosen from the data
+# Returns figpath
+def render_distribution(f, m, region, figpath):
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot(111)
+    axes.hist(f, bins='auto', density=True, histtype='stepfilled', lw=2, edgecolor="None", color="r", alpha=0.5,
+              label="female")
+    axes.hist(m, bins='auto', density=True, histtype='stepfilled', lw=2, edgecolor="None", color="b", alpha=0.5,
+              label="male")
+    axes.legend(loc="upper right")
+    axes.set_xlabel(region)
+    axes.set_ylabel('Probability')
+    figure.savefig(figpath, bbox_inches='tight')
+    return figpath
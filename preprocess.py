@@ -0,0 +1,284 @@
+# Cleans a raw data file (i.e. aseg_stats.xlsx exported from FreeSurfer) into the csv file the
+# analysis reads, as described by the <preprocess> element of config.xml:
+#
+#   <preprocess>
+#       <input sheet="aseg_stats">data/aseg_stats.xlsx</input>
+#       <idColumn>Measure:volume</idColumn>
+#       <groupFile id="SUBJID" column="Sex">data/subject_info_v2.txt</groupFile>
+#       <excludeColumns><column>Age</column><column>Height</column></excludeColumns>
+#       <excludeSubjects><subject>603061555716</subject></excludeSubjects>
+#       <rename from="3rd-Ventricle" to="Third-Ventricle"/>
+#       <dropZeroColumns>true</dropZeroColumns>
+#       <output>data/brain_data.csv</output>
+#       <xmlOutput>data/brain_data.xml</xmlOutput>
+#   </preprocess>
+#
+# The output has the id and group columns named as <subjectId> and <groups> of config.xml, then
+# every remaining column of the input. The input is streamed once, a chunk of rows at a time:
+# ids are normalized, group labels joined from the side file, subjects and columns filtered, all
+# with array operations on the chunk. Columns whose values are all zero are only known at the
+# end, so they are dropped by copying the cleaned file once more (only when there are any).
+# Replaces clean_files.py and csv_to_xml.py.
+
+import csv
+import itertools
+import os
+import sys
+import tempfile
+import xml.etree.ElementTree as ET
+import numpy as np
+
+try:
+    from lxml import etree
+except ImportError:
+    # xml output is only available with lxml installed
+    etree = None
+
+try:
+    import openpyxl
+except ImportError:
+    # .xlsx input is only available with openpyxl installed
+    openpyxl = None
+
+# number of rows cleaned at a time
+CHUNK_SIZE = 10000
+# cells treated as missing values (they do not make a column non-zero)
+MISSING = ('', 'NA', 'NaN', 'nan')
+
+
+# Settings of the <preprocess> element of config.xml
+class PreprocessConfig:
+
+    # xml_file: path to config.xml
+    def __init__(self, xml_file):
+        root = ET.parse(xml_file).getroot()
+        node = root.find('preprocess')
+        if node is None:
+            raise ValueError('%s has no <preprocess> element' % xml_file)
+        # names of the id and group columns written to the output (the ones the analysis reads)
+        self.subject_id = root.find('subjectId').text
+        self.group_by = root.find('groups').text
+        self.input_file = node.find('input').text.strip()
+        self.sheet = node.find('input').get('sheet')
+        # id column of the input (defaults to the output's id column)
+        self.id_column = text(node, 'idColumn', self.subject_id)
+        # optional side file with the group label of every subject
+        group_file = node.find('groupFile')
+        if group_file is None:
+            self.group_file = None
+        else:
+            self.group_file = group_file.text.strip()
+            self.group_file_id = group_file.get('id', self.subject_id)
+            self.group_file_column = group_file.get('column', self.group_by)
+        self.exclude_columns = [column.text for column in node.iter('column')]
+        self.exclude_subjects = normalize_ids([subject.text for subject in node.iter('subject')])
+        self.renames = dict((rename.get('from'), rename.get('to')) for rename in node.iter('rename'))
+        self.drop_zero_columns = text(node, 'dropZeroColumns', 'true').lower() == 'true'
+        self.output_file = text(node, 'output', root.find('data').text)
+        self.xml_file = text(node, 'xmlOutput')
+
+
+# Parameters: node (xml element); tag (name of a child element); default
+# Returns stripped text of the child, or default if it is not there
+def text(node, tag, default=None):
+    child = node.find(tag)
+    if child is None or child.text is None:
+        return default
+    return child.text.strip()
+
+
+# Parameters: path (.csv, tab delimited .txt/.tsv, or .xlsx file); sheet (sheet of an .xlsx file,
+# defaults to the first)
+# Yields every row of the file as a list of strings, header first, read one row at a time
+def read_rows(path, sheet=None):
+    if path.endswith('.xlsx'):
+        if openpyxl is None:
+            raise ValueError("reading %s needs openpyxl (pip install openpyxl), or export it to csv" % path)
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            worksheet = workbook[sheet] if sheet else workbook.worksheets[0]
+            for row in worksheet.iter_rows(values_only=True):
+                yield ['' if cell is None else str(cell) for cell in row]
+        finally:
+            workbook.close()
+        return
+    dialect = csv.excel_tab if path.endswith('.txt') or path.endswith('.tsv') else csv.excel
+    with open(path, 'r', newline='') as f:
+        for row in csv.reader(f, dialect=dialect):
+            yield row
+
+
+# Parameters: rows (iterator of lists of strings); width (number of columns); chunk_size
+# Yields chunk_size x width arrays of strings, blank rows left out and every row padded with
+# empty cells (or cut) to width
+def read_chunks(rows, width, chunk_size=CHUNK_SIZE):
+    while True:
+        lines = list(itertools.islice(rows, chunk_size))
+        if len(lines) == 0:
+            break
+        lines = [(line + [''] * (width - len(line)))[:width] for line in lines if ''.join(line).strip()]
+        if lines:
+            yield np.array(lines, dtype=str)
+
+
+# Parameter: ids (array of subject ids as strings)
+# Returns array of ids without surrounding spaces, and without the decimal part of integer ids
+# read as floats ('603061555716.0' becomes '603061555716')
+def normalize_ids(ids):
+    ids = np.char.strip(np.asarray(ids, dtype=str))
+    if len(ids) == 0:
+        return ids
+    parts = np.char.partition(ids, '.')
+    integral = (parts[:, 1] == '.') & np.char.isdigit(parts[:, 0]) & (np.char.strip(parts[:, 2], '0') == '')
+    return np.where(integral, parts[:, 0], ids)
+
+
+# Parameters: path, sheet (see read_rows); id_column, group_column (names of the id and group
+# columns of the file)
+# Returns (ids, groups): arrays of the normalized ids, sorted, and the group label of each (for an
+# id listed more than once, the last row's label)
+def read_group_labels(path, sheet, id_column, group_column):
+    rows = read_rows(path, sheet)
+    header = next(rows)
+    columns = [header.index(id_column), header.index(group_column)]
+    labels = {}
+    for chunk in read_chunks(rows, len(header)):
+        labels.update(zip(normalize_ids(chunk[:, columns[0]]).tolist(), np.char.strip(chunk[:, columns[1]]).tolist()))
+    ids = np.array(sorted(labels), dtype=str)
+    return ids, np.array([labels[subject] for subject in ids.tolist()], dtype=str)
+
+
+# Parameters: ids (array of normalized ids); label_ids, labels (see read_group_labels)
+# Returns (groups, found): the label of every id, and a mask of the ids the side file lists
+def join_labels(ids, label_ids, labels):
+    if len(label_ids) == 0:
+        return np.full(len(ids), '', dtype=str), np.zeros(len(ids), dtype=bool)
+    position = np.minimum(np.searchsorted(label_ids, ids), len(label_ids) - 1)
+    found = label_ids[position] == ids
+    return np.where(found, labels[position], ''), found
+
+
+# Parameter: cells (rows x columns array of strings)
+# Returns mask of the columns holding a value other than zero (text counts as non-zero, missing
+# values do not)
+def nonzero_columns(cells):
+    cells = np.char.strip(cells)
+    missing = np.isin(cells, MISSING)
+    cells = np.where(missing, '0', cells)
+    try:
+        numbers = cells.astype(np.float64)
+    except ValueError:
+        # only chunks holding text are parsed cell by cell, text becoming NaN (non-zero)
+        numbers = np.vectorize(parse_number, otypes=[np.float64])(cells)
+    return np.any(numbers != 0, axis=0)
+
+
+# Parameter: value (string)
+# Returns value as a float, or NaN if it is not a number
+def parse_number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+# Parameter: config (PreprocessConfig)
+# Streams config.input_file once into config.output_file: normalizes ids, sets every subject's
+# group label (from the side file, leaving out subjects it does not list, or from the input's own
+# group column, leaving out subjects without one), leaves out excluded subjects and columns,
+# renames columns, and drops columns that are all zero. Writes config.xml_file too if it is set
+# Returns (number of subjects written, list of the value columns written)
+def preprocess(config):
+    rows = read_rows(config.input_file, config.sheet)
+    header = [name.strip() for name in next(rows)]
+    id_index = header.index(config.id_column)
+    if config.group_file is not None:
+        label_ids, labels = read_group_labels(config.group_file, None, config.group_file_id,
+                                              config.group_file_column)
+        group_index = None
+    else:
+        group_index = header.index(config.group_by)
+    # a group column of the input is replaced by the joined labels
+    skipped = set(config.exclude_columns) | set([config.id_column, config.group_by])
+    value_indices = [j for j, name in enumerate(header) if name not in skipped]
+    value_names = [config.renames.get(header[j], header[j]) for j in value_indices]
+    nonzero = np.zeros(len(value_indices), dtype=bool)
+
+    parent = os.path.dirname(os.path.abspath(config.output_file))
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+    f, tmp_path = tempfile.mkstemp(dir=parent, suffix='.csv')
+    n_subjects = 0
+    try:
+        with os.fdopen(f, 'w', newline='') as tmp:
+            writer = csv.writer(tmp)
+            writer.writerow([config.subject_id, config.group_by] + value_names)
+            for chunk in read_chunks(rows, len(header)):
+                ids = normalize_ids(chunk[:, id_index])
+                if group_index is None:
+                    groups, keep = join_labels(ids, label_ids, labels)
+                else:
+                    groups = np.char.strip(chunk[:, group_index])
+                    keep = groups != ''
+                keep &= (ids != '') & ~np.isin(ids, config.exclude_subjects)
+                values = chunk[keep][:, value_indices]
+                # only columns still all zero so far need parsing
+                undecided = np.flatnonzero(~nonzero)
+                nonzero[undecided] = nonzero_columns(values[:, undecided])
+                writer.writerows(np.column_stack([ids[keep], groups[keep], values]).tolist())
+                n_subjects += int(np.count_nonzero(keep))
+        if config.drop_zero_columns and not nonzero.all():
+            # copy once more without the all-zero columns
+            kept = [0, 1] + [j + 2 for j in np.flatnonzero(nonzero)]
+            with open(tmp_path, 'r', newline='') as src, open(config.output_file, 'w', newline='') as dst:
+                writer = csv.writer(dst)
+                for chunk in read_chunks(csv.reader(src), len(value_names) + 2):
+                    writer.writerows(chunk[:, kept].tolist())
+            value_names = [name for name, keep in zip(value_names, nonzero) if keep]
+        else:
+            os.replace(tmp_path, config.output_file)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    if config.xml_file is not None:
+        write_xml(config.output_file, config.xml_file)
+    return n_subjects, value_names
+
+
+# Parameters: csv_file (path to csv file); xml_file (path of the xml file to write)
+# Writes every row of csv_file as a <prod> element of <root>, with a child element per column,
+# streamed row by row so the document is never built in memory. Needs lxml
+def write_xml(csv_file, xml_file):
+    if etree is None:
+        raise ValueError("writing %s needs lxml (pip install lxml)" % xml_file)
+    with open(csv_file, 'r', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        invalid = [name for name in header if not valid_tag(name)]
+        if invalid:
+            raise ValueError("columns %s are not valid xml element names; rename them with <rename>" % invalid)
+        with etree.xmlfile(xml_file, encoding='utf-8') as xf:
+            xf.write_declaration()
+            with xf.element('root'):
+                for row in reader:
+                    prod = etree.Element('prod')
+                    for name, value in zip(header, row):
+                        etree.SubElement(prod, name).text = value
+                    xf.write(prod, pretty_print=True)
+
+
+# Parameter: name (string)
+# Returns True if name can be an xml element name
+def valid_tag(name):
+    try:
+        etree.Element(name)
+    except ValueError:
+        return False
+    return True
+
+
+if __name__ == "__main__":
+
+    config = PreprocessConfig(sys.argv[1] if len(sys.argv) > 1 else 'config.xml')
+    n_subjects, columns = preprocess(config)
+    print('%d subjects, %d columns written to %s' % (n_subjects, len(columns), config.output_file))
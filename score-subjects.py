@@ -0,0 +1,20 @@
+import sys
+from model import load_model, score_stream
+
+# Scores new subjects against a reference model saved by sex-differences-xml.py, without reloading
+# the reference cohort:
+#     python score-subjects.py results/reference_model.npz new_subjects.csv > scores.csv
+#     cat new_subjects.csv | python score-subjects.py results/reference_model.npz > scores.csv
+# The input needs the subject id column and a column for every region of the model; rows are
+# scored and written as they are read.
+
+if __name__ == "__main__":
+
+    if len(sys.argv) not in (2, 3):
+        sys.exit("usage: python score-subjects.py MODEL [SUBJECTS.csv | -]")
+    model = load_model(sys.argv[1])
+    if len(sys.argv) == 2 or sys.argv[2] == '-':
+        score_stream(model, sys.stdin, sys.stdout)
+    else:
+        with open(sys.argv[2], 'r', newline='') as f:
+            score_stream(model, f, sys.stdout)
@@ -0,0 +1,193 @@
+import numpy as np
+import density
+from parallel import RegionPool, N_WORKERS
+
+# small amount added to both likelihoods to prevent div0 and log(0) errors
+EPSILON = 0.0000000001
+
+
+# Parameter: values (list or array of floats)
+# Returns sorted array of values, leaving out missing ones (NaN, or the older float("inf") placeholder)
+def sorted_present(values):
+    values = np.asarray(values, dtype=float)
+    return np.sort(values[np.isfinite(values)])
+
+
+# Parameters: f_kernel, m_kernel (fitted female and male densities, see density.fit_density);
+# points (array of values, NaN or float("inf") for missing)
+# Returns (female pdf, male pdf) arrays with both densities evaluated at every present point in
+# one batched call, 0 where the point is missing
+def evaluate_kernels(f_kernel, m_kernel, points):
+    points = np.asarray(points, dtype=float)
+    present = np.isfinite(points)
+    f_pdf = np.zeros(points.shape)
+    m_pdf = np.zeros(points.shape)
+    if present.any():
+        f_pdf[present] = f_kernel.evaluate(points[present])
+        m_pdf[present] = m_kernel.evaluate(points[present])
+    return f_pdf, m_pdf
+
+
+# Parameters: f_pdf, m_pdf (arrays of the female and male densities at the scored values); missing
+# (optional mask of the values that are missing)
+# Returns log likelihood ratios log(male pdf / female pdf), EPSILON keeping both densities above 0,
+# NaN where the value is missing. The ratio every scorer (CohortScorer, the reference model,
+# cross-validation and the bootstrap) reports
+def log_ratios(f_pdf, m_pdf, missing=None):
+    llr = np.log((m_pdf + EPSILON) / (f_pdf + EPSILON))
+    if missing is not None:
+        llr[missing] = np.nan
+    return llr
+
+
+# Parameters: f, m (one region's female and male values, NaN for missing); grid_size, rule (see
+# density.pair_grids)
+# Returns (lo, hi, female density, male density) of the region on one grid over both groups and
+# KERNEL_TAIL bandwidths past them; run per region by RegionPool workers
+def region_density_grids(f, m, grid_size, rule):
+    return density.pair_grids(sorted_present(f), sorted_present(m), grid_size, rule)
+
+
+# Parameters: pool (parallel.RegionPool); female_data, male_data (maps from brain region (string)
+# to its values, NaN for missing); regions (list of brain regions); grid_size, rule (see
+# density.pair_grids)
+# Returns list of region_density_grids, one per region. The grids are fitted by the pool and
+# memoized in fitcache.FIT_CACHE on the samples, grid size and bandwidth rule, so Brain, the
+# reference model, the plots and CohortScorer share one binned density per group and region
+def fit_grids(pool, female_data, male_data, regions, grid_size=density.GRID_SIZE, rule='scott'):
+    return pool.map(region_density_grids, [female_data, male_data], regions, (grid_size, rule), memoize=True)
+
+
+# Parameters: pool, female_data, male_data, regions (see fit_grids); method (one of
+# density.METHODS); rule, grid_size (see density.fit_density)
+# Returns list of (female density, male density) fitted pairs (see density.fit_pair), one per
+# region. 'fft' pairs are built on the shared grids of fit_grids; 'exact' and 'gaussian' fits only
+# take the spread of the samples, so they are made here
+def fit_regions(pool, female_data, male_data, regions, method='exact', rule='scott', grid_size=density.GRID_SIZE):
+    density.check_method(method)
+    regions = list(regions)
+    grids = fit_grids(pool, female_data, male_data, regions, grid_size, rule) if method == 'fft' else None
+    fits = []
+    for i, region in enumerate(regions):
+        f = sorted_present(female_data[region])
+        m = sorted_present(male_data[region])
+        fits.append(density.fit_pair(f, m, method, rule, grid_size, grids[i] if grids else None))
+    return fits
+
+
+# Parameter: kernel (fitted density, see density.fit_density)
+# Returns the bandwidth factor of an 'exact' kernel, None for a sample fitted with a NormalDensity
+# (one a kernel cannot be fitted to)
+def kernel_factor(kernel):
+    if isinstance(kernel, density.KernelDensity):
+        return kernel.getFactor()
+    return None
+
+
+# Parameters: f, m (one region's female and male values, NaN for missing); points (the region's
+# values to score); f_factor, m_factor (bandwidth factors of the region's fitted kernels, see
+# kernel_factor)
+# Returns (female pdf, male pdf) at every point (see evaluate_kernels) of the 'exact' kernels
+# rebuilt from the samples and factors; run per region by RegionPool workers, so a task carries two
+# floats rather than the fitted kernels and their samples
+def region_kernel_pdfs(f, m, points, f_factor, m_factor):
+    kernels = [density.NormalDensity(x) if factor is None else density.KernelDensity(x, factor=factor)
+               for x, factor in ((sorted_present(f), f_factor), (sorted_present(m), m_factor))]
+    return evaluate_kernels(kernels[0], kernels[1], points)
+
+
+# Fits the female and male density of every region once, and scores any number of subjects
+# against those densities in one batched evaluation per region (instead of refitting both
+# kernels for every patient, as Patient.genderLikelihood used to). Scores agree with the
+# per-subject evaluation up to floating point rounding (~1e-14).
+# The density method trades exactness for speed: 'exact' evaluates gaussian_kde (O(N) per scored
+# value), 'fft' interpolates a binned kernel density on a grid (O(1) per value, within ~1e-3 of
+# 'exact' in log likelihood ratio except far in the tails, see model.ReferenceModel) and 'gaussian'
+# uses a normal density per group. The 'fft' grids are the ones Brain and the reference model
+# use (see fit_grids), so with the same bandwidth and grid size they are not fitted again.
+class CohortScorer:
+
+    # female_data: map from brain region (string) to its values (list or array of floats, NaN or
+    # float("inf") for missing) for female patients
+    # male_data: same for male patients
+    # regions: list of brain regions to fit (defaults to every region in female_data, sorted)
+    # n_workers: number of processes scoring regions in parallel (see parallel.RegionPool); with
+    # more than one, 'exact' kernels are evaluated by the workers, which read the samples from
+    # shared memory and get only the fitted bandwidth factors (the other methods are O(1) per value
+    # and evaluated here)
+    # method: density estimator (see density.METHODS)
+    # bandwidth: bandwidth rule of the kernels ('scott', 'silverman', 'robust' or a float factor)
+    # grid_size: number of grid points of the 'fft' method
+    def __init__(self, female_data, male_data, regions=None, n_workers=N_WORKERS, method='exact', bandwidth='scott',
+                 grid_size=density.GRID_SIZE):
+        density.check_method(method)
+        if regions is None:
+            regions = sorted(female_data.keys())
+        self.female_data = female_data
+        self.male_data = male_data
+        self.regions = list(regions)
+        self.method = method
+        self.bandwidth = bandwidth
+        self.grid_size = grid_size
+        self.pool = RegionPool(n_workers)
+        # self.kernels = list of the (female density, male density) pair of every region, in
+        # self.regions order
+        self.kernels = fit_regions(self.pool, female_data, male_data, self.regions, method, bandwidth, grid_size)
+
+    # Returns list of regions (column order of every matrix this scorer produces)
+    def getRegions(self):
+        return self.regions
+
+    # Parameter: data_maps (list of maps from brain region (string) to its value (float))
+    # Returns subjects x regions float matrix in self.regions column order
+    def dataMatrix(self, data_maps):
+        values = np.empty((len(data_maps), len(self.regions)))
+        for i, data in enumerate(data_maps):
+            for j, region in enumerate(self.regions):
+                values[i, j] = data[region]
+        return values
+
+    # Parameter: values (subjects x regions matrix, NaN or float("inf") marks missing values)
+    # Returns (female pdf, male pdf, missing mask) matrices, each kernel evaluated once per region
+    def __evaluate(self, values):
+        values = np.atleast_2d(np.asarray(values, dtype=float))
+        missing = ~np.isfinite(values)
+        f_pdf = np.zeros(values.shape)
+        m_pdf = np.zeros(values.shape)
+        if self.method == 'exact' and self.pool.getNumWorkers() > 1:
+            columns = dict((region, values[:, j]) for j, region in enumerate(self.regions))
+            factors = [(kernel_factor(f_kernel), kernel_factor(m_kernel)) for f_kernel, m_kernel in self.kernels]
+            pdfs = self.pool.map(region_kernel_pdfs, [self.female_data, self.male_data, columns], self.regions,
+                                 factors)
+        else:
+            pdfs = [evaluate_kernels(f_kernel, m_kernel, values[:, j])
+                    for j, (f_kernel, m_kernel) in enumerate(self.kernels)]
+        for j, (f_column, m_column) in enumerate(pdfs):
+            f_pdf[:, j] = f_column
+            m_pdf[:, j] = m_column
+        return f_pdf, m_pdf, missing
+
+    # Parameter: values (subjects x regions matrix, NaN or float("inf") marks missing values)
+    # Returns subjects x regions matrix of log likelihood ratios log(male pdf / female pdf),
+    # NaN where the value is missing
+    def logLikelihoodRatios(self, values):
+        return log_ratios(*self.__evaluate(values))
+
+    # Parameter: values (subjects x regions matrix, NaN or float("inf") marks missing values)
+    # Returns subjects x regions matrix of posterior probabilities of being male (prior of 0.5),
+    # NaN where the value is missing
+    def posteriorProbs(self, values):
+        f_pdf, m_pdf, missing = self.__evaluate(values)
+        prior = 0.5
+        with np.errstate(divide='ignore', invalid='ignore'):
+            prob = m_pdf*prior / (f_pdf*prior + m_pdf*prior)
+        prob[missing] = np.nan
+        return prob
+
+    # Parameter: matrix (subjects x regions matrix returned by logLikelihoodRatios or posteriorProbs)
+    # Returns list of rows with 'NA' in place of missing values, as written to the results files
+    def formatRows(self, matrix):
+        rows = []
+        for row in matrix:
+            rows.append(['NA' if np.isnan(x) else float(x) for x in row])
+        return rows
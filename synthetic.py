@@ -0,0 +1,77 @@
+import csv
+import numpy as np
+
+# rows generated and written at a time by write_cohort_csv
+CHUNK_SIZE = 10000
+
+
+# Parameters: n_regions (number of brain regions); seed (random seed or np.random.Generator)
+# Returns map with one array per region parameter: 'mean' (female mean, spread over a few orders
+# of magnitude like volumes and thicknesses), 'sd' (female standard deviation), 'effect' (male
+# shift in female standard deviations, mostly small with either sign, as in Joel et al) and
+# 'skew' (shape of the gamma noise, smaller is more skewed)
+def region_parameters(n_regions, seed=0):
+    rng = np.random.default_rng(seed)
+    mean = 10 ** rng.uniform(0, 4.5, n_regions)
+    return {
+        'mean': mean,
+        'sd': mean * rng.uniform(0.05, 0.2, n_regions),
+        'effect': rng.normal(0, 0.4, n_regions),
+        'skew': rng.uniform(4, 50, n_regions),
+    }
+
+
+# Parameters: parameters (from region_parameters); groups (array of 'F'/'M' labels, one per
+# subject); missing_rate (fraction of values left missing, at random); rng (np.random.Generator)
+# Returns len(groups) x regions float matrix of values, NaN for missing. Every value is the region's
+# mean, plus the male shift for males, plus standardized gamma noise (right-skewed, unit variance)
+# scaled by the region's standard deviation
+def sample_values(parameters, groups, missing_rate, rng):
+    n_regions = len(parameters['mean'])
+    shape = parameters['skew']
+    noise = (rng.gamma(shape, size=(len(groups), n_regions)) - shape) / np.sqrt(shape)
+    male = (np.asarray(groups) == 'M')[:, None]
+    values = parameters['mean'] + parameters['sd'] * (noise + male * parameters['effect'])
+    values[rng.random(values.shape) < missing_rate] = np.nan
+    return values
+
+
+# Parameters: n_subjects (number of subjects); n_regions (number of brain regions);
+# female_fraction (expected fraction of female subjects); missing_rate (fraction of missing
+# values); seed (random seed, the same seed always gives the same cohort)
+# Returns (ids, groups, variables, values), the arguments of cohort.Cohort: ids are '1', '2', ...,
+# groups 'F' or 'M' in random order, variables 'Var1', 'Var2', ..., values NaN for missing
+def make_cohort(n_subjects, n_regions, female_fraction=0.5, missing_rate=0.01, seed=0):
+    region_seed, subject_seed = np.random.SeedSequence(seed).spawn(2)
+    parameters = region_parameters(n_regions, region_seed)
+    rng = np.random.default_rng(subject_seed)
+    groups = np.where(rng.random(n_subjects) < female_fraction, 'F', 'M')
+    ids = np.arange(1, n_subjects + 1).astype(str)
+    variables = ['Var%d' % (j + 1) for j in range(n_regions)]
+    return ids, groups, variables, sample_values(parameters, groups, missing_rate, rng)
+
+
+# Parameters: csv_file (path to write); n_subjects, n_regions, female_fraction, missing_rate, seed
+# (see make_cohort); subject_id, group_by (names of the id and group columns)
+# Writes a synthetic cohort in the layout of data/example_data.csv (missing values are empty
+# cells), chunk_size rows at a time so memory does not scale with n_subjects. The values are the
+# same as make_cohort's for the same arguments only when chunk_size >= n_subjects
+# Returns list of the variable names
+def write_cohort_csv(csv_file, n_subjects, n_regions, female_fraction=0.5, missing_rate=0.01, seed=0,
+                     subject_id='SUBJID', group_by='Sex', chunk_size=CHUNK_SIZE):
+    region_seed, subject_seed = np.random.SeedSequence(seed).spawn(2)
+    parameters = region_parameters(n_regions, region_seed)
+    rng = np.random.default_rng(subject_seed)
+    variables = ['Var%d' % (j + 1) for j in range(n_regions)]
+    with open(csv_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([subject_id, group_by] + variables)
+        for start in range(0, n_subjects, chunk_size):
+            size = min(chunk_size, n_subjects - start)
+            groups = np.where(rng.random(size) < female_fraction, 'F', 'M')
+            values = sample_values(parameters, groups, missing_rate, rng)
+            cells = np.char.mod('%.6g', values)
+            cells[np.isnan(values)] = ''
+            for i in range(size):
+                writer.writerow([str(start + i + 1), groups[i]] + cells[i].tolist())
+    return variables
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from scipy import stats
+import density
+from brain import Brain
+
+
+# Returns (f, m): two skewed samples of n values each, shifted apart by shift female standard
+# deviations (the shape of synthetic.sample_values)
+def make_pair(n, shift, skew=8.0, seed=0):
+    rng = np.random.default_rng(seed)
+    f = 100 + 10 * (rng.gamma(skew, size=n) - skew) / np.sqrt(skew)
+    m = 100 + 10 * (rng.gamma(skew, size=n) - skew) / np.sqrt(skew) + 10 * shift
+    return np.sort(f), np.sort(m)
+
+
+# Returns area between the two gaussian_kde integrated finely over the range of the pooled samples
+def fine_divergence(f, m, rule='scott', n_points=10001):
+    grid = np.linspace(min(f.min(), m.min()), max(f.max(), m.max()), n_points)
+    f_kernel = stats.gaussian_kde(f, bw_method=density.kde_factor(f, rule))
+    m_kernel = stats.gaussian_kde(m, bw_method=density.kde_factor(m, rule))
+    return density.trapezoid(abs(f_kernel.evaluate(grid) - m_kernel.evaluate(grid)), grid)
+
+
+@pytest.mark.parametrize('n', [400, 1000])
+@pytest.mark.parametrize('shift', [0.0, 0.3, 1.0])
+@pytest.mark.parametrize('rule', ['scott', 'robust'])
+def test_grid_divergence_matches_fine_integral(n, shift, rule):
+    f, m = make_pair(n, shift)
+    assert density.grid_divergence(f, m, rule=rule) == pytest.approx(fine_divergence(f, m, rule), abs=1e-4)
+
+
+@pytest.mark.parametrize('n, tolerance', [(400, 1e-2), (1000, 5e-3)])
+@pytest.mark.parametrize('shift', [0.0, 0.3, 1.0])
+def test_exact_divergence_within_documented_tolerance(n, tolerance, shift):
+    f, m = make_pair(n, shift)
+    assert density.exact_divergence(f, m) == pytest.approx(fine_divergence(f, m), abs=tolerance)
+
+
+def test_brain_fft_divergence_matches_fine_integral():
+    female_data = {}
+    male_data = {}
+    for j, shift in enumerate([0.0, 0.2, 0.5, 1.0]):
+        f, m = make_pair(400, shift, seed=j)
+        f[::50] = np.nan
+        female_data['Var%d' % j] = f
+        male_data['Var%d' % j] = m
+    fft = Brain(female_data, male_data, method='fft', n_workers=1)
+    exact = Brain(female_data, male_data, method='exact', n_workers=1)
+    for region in female_data:
+        f = female_data[region][np.isfinite(female_data[region])]
+        expected = fine_divergence(f, male_data[region])
+        assert fft.getDivergence(region) == pytest.approx(expected, abs=1e-4)
+        assert exact.getDivergence(region) == pytest.approx(expected, abs=1e-2)
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from scipy import stats
+import density
+from crossval import region_cv_llrs
+from scoring import EPSILON
+
+
+# Returns array of n skewed samples, in random order
+def make_sample(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return 50 + 5 * rng.gamma(6.0, size=n)
+
+
+# Parameters: x (array of samples); bandwidth (standard deviation of the kernel)
+# Returns array of the density at each sample under gaussian_kde refitted on the other samples,
+# with the kernel standard deviation fixed at bandwidth (the one fitted on all samples)
+def refitted_pdfs(x, bandwidth):
+    pdf = np.empty(len(x))
+    for i in range(len(x)):
+        rest = np.delete(x, i)
+        kernel = stats.gaussian_kde(rest, bw_method=bandwidth / np.std(rest, ddof=1))
+        pdf[i] = kernel.evaluate([x[i]])[0]
+    return pdf
+
+
+@pytest.mark.parametrize('rule', ['scott', 'robust', 0.4])
+def test_kernel_leave_one_out_matches_refit(rule):
+    x = make_sample(200)
+    expected = refitted_pdfs(x, density.kde_bandwidth(x, rule))
+    assert density.KernelDensity(x, rule).leaveOneOut() == pytest.approx(expected, rel=1e-10, abs=1e-15)
+
+
+def test_grid_leave_one_out_matches_refit():
+    x = make_sample(500)
+    expected = refitted_pdfs(x, density.kde_bandwidth(x))
+    assert abs(density.GridDensity(x).leaveOneOut() - expected).max() < 1e-4 * expected.max()
+
+
+def test_normal_leave_one_out_matches_refit():
+    x = make_sample(50)
+    expected = [stats.norm.pdf(x[i], np.mean(np.delete(x, i)), np.std(np.delete(x, i), ddof=1))
+                for i in range(len(x))]
+    assert density.NormalDensity(x).leaveOneOut() == pytest.approx(expected, rel=1e-10)
+
+
+def test_cross_validated_ratios_hold_out_each_subject():
+    f = make_sample(120, seed=1)
+    m = make_sample(100, seed=2) + 3
+    f[[3, 40]] = np.nan
+    m[7] = np.nan
+    f_llr, m_llr = region_cv_llrs(f, m, None, 0)
+    for x, other, llr, male in ((f, m, f_llr, False), (m, f, m_llr, True)):
+        present = np.isfinite(x)
+        assert np.array_equal(np.isnan(llr), ~present)
+        sample = x[present]
+        own = refitted_pdfs(sample, density.kde_bandwidth(sample))
+        kept = other[np.isfinite(other)]
+        rest = stats.gaussian_kde(kept).evaluate(sample)
+        m_pdf, f_pdf = (own, rest) if male else (rest, own)
+        assert llr[present] == pytest.approx(np.log((m_pdf + EPSILON) / (f_pdf + EPSILON)), abs=1e-10)
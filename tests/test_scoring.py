@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+from scipy import stats
+from patient import Patient
+from scoring import CohortScorer, EPSILON
+
+
+# Returns (female_data, male_data, regions, values): three regions of skewed samples with a few
+# missing values, and subjects x regions values to score (some missing, some far in the tails)
+def make_data(seed=0):
+    rng = np.random.default_rng(seed)
+    regions = ['Var1', 'Var2', 'Var3']
+    female_data = {}
+    male_data = {}
+    for j, region in enumerate(regions):
+        f = 10.0 ** j * (1 + 0.1 * rng.gamma(4 + j, size=150))
+        m = 10.0 ** j * (1.05 + 0.1 * rng.gamma(4 + j, size=120))
+        f[rng.random(len(f)) < 0.05] = np.nan
+        m[rng.random(len(m)) < 0.05] = np.nan
+        female_data[region] = f
+        male_data[region] = m
+    values = np.column_stack([np.concatenate((female_data[region][:20], male_data[region][:20],
+                                              [10.0 ** j * 0.5, 10.0 ** j * 3]))
+                              for j, region in enumerate(regions)])
+    return female_data, male_data, regions, values
+
+
+# Parameters: female_data, male_data, regions, values (see make_data); rule (bandwidth rule)
+# Returns subjects x regions log likelihood ratios with both gaussian_kde refitted for every
+# subject and value, as Patient.genderLikelihood used to
+def naive_ratios(female_data, male_data, regions, values, rule='scott'):
+    llr = np.full(values.shape, np.nan)
+    for i in range(len(values)):
+        for j, region in enumerate(regions):
+            if not np.isfinite(values[i, j]):
+                continue
+            f = female_data[region][np.isfinite(female_data[region])]
+            m = male_data[region][np.isfinite(male_data[region])]
+            f_pdf = stats.gaussian_kde(f, bw_method=rule).evaluate([values[i, j]])[0]
+            m_pdf = stats.gaussian_kde(m, bw_method=rule).evaluate([values[i, j]])[0]
+            llr[i, j] = np.log((m_pdf + EPSILON) / (f_pdf + EPSILON))
+    return llr
+
+
+@pytest.mark.parametrize('rule', ['scott', 'silverman', 0.3])
+def test_batched_ratios_match_per_subject_kde(rule):
+    female_data, male_data, regions, values = make_data()
+    scorer = CohortScorer(female_data, male_data, regions, n_workers=1, bandwidth=rule)
+    llr = scorer.logLikelihoodRatios(values)
+    expected = naive_ratios(female_data, male_data, regions, values, rule)
+    assert np.array_equal(np.isnan(llr), np.isnan(expected))
+    assert np.nanmax(abs(llr - expected)) < 1e-12
+
+
+def test_missing_values_are_nan():
+    female_data, male_data, regions, values = make_data()
+    values[0, 1] = np.nan
+    values[1, 2] = float('inf')
+    llr = CohortScorer(female_data, male_data, regions, n_workers=1).logLikelihoodRatios(values)
+    assert np.isnan(llr[0, 1]) and np.isnan(llr[1, 2])
+    assert np.isfinite(llr[0, 0]) and np.isfinite(llr[1, 0])
+
+
+def test_patient_likelihood_matches_scorer():
+    female_data, male_data, regions, values = make_data()
+    scorer = CohortScorer(female_data, male_data, regions, n_workers=1)
+    llr = scorer.logLikelihoodRatios(values)
+    for i in (0, 25, len(values) - 1):
+        patient = Patient(str(i), 'F', dict(zip(regions, values[i])))
+        likelihood = patient.genderLikelihood(female_data, male_data, scorer)
+        assert [likelihood[region] for region in regions] == pytest.approx(llr[i], abs=1e-12)
+
+
+@pytest.mark.parametrize('rule', ['scott', 'robust'])
+def test_workers_match_single_process(rule):
+    female_data, male_data, regions, values = make_data()
+    single = CohortScorer(female_data, male_data, regions, n_workers=1, bandwidth=rule)
+    pooled = CohortScorer(female_data, male_data, regions, n_workers=2, bandwidth=rule)
+    assert np.array_equal(single.logLikelihoodRatios(values), pooled.logLikelihoodRatios(values), equal_nan=True)